@@ -0,0 +1,106 @@
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from data_provider.data_loader import Dataset_Custom
+from data_provider.prefetch import BatchPrefetcher
+from data_provider.samplers import WindowSampler
+from data_provider.windows import collate_batch
+
+parser = argparse.ArgumentParser(description='Time-LLM data loader benchmark')
+
+parser.add_argument('--root_path', type=str, default='./datasets/', help='root path of the data file')
+parser.add_argument('--data_path', type=str, default='ETTh1.csv', help='data file')
+parser.add_argument('--features', type=str, default='M', help='forecasting task, options:[M, S, MS]')
+parser.add_argument('--target', type=str, default='OT', help='target feature in S or MS task')
+parser.add_argument('--embed', type=str, default='timeF', help='time features encoding, options:[timeF, fixed, learned]')
+parser.add_argument('--freq', type=str, default='h', help='freq for time features encoding')
+parser.add_argument('--seq_len', type=int, default=512, help='input sequence length')
+parser.add_argument('--label_len', type=int, default=48, help='start token length')
+parser.add_argument('--pred_len', type=int, default=96, help='prediction sequence length')
+parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
+parser.add_argument('--num_workers', type=int, default=0, help='data loader num workers')
+parser.add_argument('--storage_dtype', type=str, default='float64',
+                    help='dtype the dataset values are kept in, options:[float64, float32, float16, bfloat16, int16]')
+parser.add_argument('--prefetch', type=int, default=2, help='batches prepared ahead by the BatchPrefetcher')
+parser.add_argument('--compute_ms', type=float, default=5., help='simulated compute time per step for the prefetch run')
+parser.add_argument('--batches', type=int, default=500, help='number of batches timed per loader')
+
+args = parser.parse_args()
+
+
+class PerSample(Dataset):
+    """
+    Hides __getitems__, so the DataLoader falls back to one __getitem__ call per sample and the default collate.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def make_loader(dataset, batched):
+    return DataLoader(dataset if batched else PerSample(dataset), batch_size=args.batch_size,
+                      sampler=WindowSampler(dataset, seed=0), num_workers=args.num_workers, drop_last=True,
+                      collate_fn=collate_batch if batched else None)
+
+
+def run(loader):
+    batches = []
+    start = time.perf_counter()
+    for i, batch in enumerate(loader):
+        if i == args.batches:
+            break
+        batches.append([b.float() for b in batch])
+    return batches, (time.perf_counter() - start) / max(len(batches), 1)
+
+
+data_set = Dataset_Custom(args.root_path, flag='train', size=[args.seq_len, args.label_len, args.pred_len],
+                          features=args.features, data_path=args.data_path, target=args.target,
+                          timeenc=0 if args.embed != 'timeF' else 1, freq=args.freq,
+                          storage_dtype=args.storage_dtype)
+
+per_sample, per_sample_time = run(make_loader(data_set, batched=False))
+batched, batched_time = run(make_loader(data_set, batched=True))
+
+
+def data_wait(depth):
+    """
+    Mean time per step spent waiting for the next prepared batch, with compute_ms of simulated work per step.
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    loader = make_loader(data_set, batched=True)
+    prepare = lambda batch: [b.float().to(device, non_blocking=True) for b in batch]
+    iterator = iter(BatchPrefetcher(loader, prepare, depth))
+    waited, steps = 0., 0
+    for _ in range(args.batches):
+        start = time.perf_counter()
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        waited += time.perf_counter() - start
+        steps += 1
+        time.sleep(args.compute_ms / 1e3)
+    iterator.close()
+    return waited / max(steps, 1)
+
+
+same = all(torch.equal(a, b) for x, y in zip(per_sample, batched) for a, b in zip(x, y))
+print('samples: {}, batch_size: {}, num_workers: {}'.format(len(data_set), args.batch_size, args.num_workers))
+print('values: {}, {:.1f} MB'.format(data_set.data_x.dtype, data_set.data_x.base.nbytes / 2 ** 20
+                                     if data_set.data_x.base is not None else data_set.data_x.nbytes / 2 ** 20))
+print('per-sample __getitem__ + collate: {:.3f} ms/batch'.format(per_sample_time * 1e3))
+print('batched __getitems__:             {:.3f} ms/batch'.format(batched_time * 1e3))
+print('speedup: {:.1f}x, identical batches: {}'.format(per_sample_time / batched_time, same))
+
+sync_wait, prefetch_wait = data_wait(0), data_wait(args.prefetch)
+print('data wait with {:.1f} ms of compute per step: {:.3f} ms in the loop, {:.3f} ms with --prefetch {}'.format(
+    args.compute_ms, sync_wait * 1e3, prefetch_wait * 1e3, args.prefetch))
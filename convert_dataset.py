@@ -0,0 +1,21 @@
+import argparse
+
+from data_provider.memmap import convert_csv
+
+parser = argparse.ArgumentParser(description='Convert a csv dataset to an out-of-core memmap table')
+
+parser.add_argument('--csv', type=str, required=True, help='csv file with a leading date column')
+parser.add_argument('--out', type=str, required=True, help='output table directory, used as --data_path')
+parser.add_argument('--target', type=str, default='OT', help='target feature in S or MS task')
+parser.add_argument('--embed', type=str, default='timeF', help='time features encoding, options:[timeF, fixed, learned]')
+parser.add_argument('--freq', type=str, default='h', help='freq for time features encoding')
+parser.add_argument('--minute', action='store_true', default=False,
+                    help='add 15 minute buckets to the fixed time features, as the ETTm datasets do')
+parser.add_argument('--dtype', type=str, default='float32', help='storage dtype of the values, options:[float32, float64]')
+parser.add_argument('--chunksize', type=int, default=100000, help='rows read from the csv at a time')
+
+args = parser.parse_args()
+
+convert_csv(args.csv, args.out, target=args.target, timeenc=0 if args.embed != 'timeF' else 1, freq=args.freq,
+            minute=args.minute, dtype=args.dtype, chunksize=args.chunksize)
+print('wrote {}, train with --data Memmap --root_path <parent> --data_path <name>'.format(args.out))
@@ -1,4 +1,9 @@
-from data_provider.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_M4
+from data_provider.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Memmap, Dataset_M4, \
+    Dataset_M4_Joint
+from data_provider.m4 import M4Meta, group_config
+from data_provider.samplers import BlockShuffleSampler, GroupBatchSampler, WindowSampler
+from data_provider.windows import PromptCollate, collate_batch
+import torch
 from torch.utils.data import DataLoader
 
 data_dict = {
@@ -9,10 +14,34 @@ data_dict = {
     'ECL': Dataset_Custom,
     'Traffic': Dataset_Custom,
     'Weather': Dataset_Custom,
+    'Memmap': Dataset_Memmap,
     'm4': Dataset_M4,
 }
 
 
+def reads_timestamps(args):
+    """
+    Whether the model reads x_mark_enc or x_mark_dec, per the inputs its class declares (args.model_inputs).
+    """
+    return bool({'x_mark_enc', 'x_mark_dec'} & set(getattr(args, 'model_inputs', ('x_mark_enc', 'x_mark_dec'))))
+
+
+def loader_collate(args, collate=None):
+    """
+    collate_fn of the loaders. With --prompt_in_loader and a model that reads prompts (args.model_inputs),
+    the DataLoader workers also build and tokenize the prompts of every batch, see PromptCollate.
+    """
+    if not (getattr(args, 'prompt_in_loader', False) and 'prompt' in getattr(args, 'model_inputs', ())):
+        return collate
+    from models.TimeLLM import PromptBuilder, load_tokenizer
+    tokenizer = load_tokenizer(args.llm_model)
+    if args.data == 'm4' and args.seasonal_patterns == 'All':
+        # the prompts of joint M4 batches state the lengths of their seasonal pattern
+        return PromptCollate({group: PromptBuilder(group_config(args, group), tokenizer)
+                              for group in M4Meta.seasonal_patterns}, collate)
+    return PromptCollate(PromptBuilder(args, tokenizer), collate)
+
+
 def data_provider(args, flag):
     Data = data_dict[args.data]
     timeenc = 0 if args.embed != 'timeF' else 1
@@ -29,7 +58,33 @@ def data_provider(args, flag):
         batch_size = args.batch_size
         freq = args.freq
 
-    if args.data == 'm4':
+    if args.data == 'm4' and args.seasonal_patterns == 'All':
+        datasets = {}
+        for group in M4Meta.seasonal_patterns:
+            group_args = group_config(args, group)
+            datasets[group] = Data(
+                root_path=args.root_path,
+                data_path=args.data_path,
+                flag=flag,
+                size=[group_args.seq_len, group_args.label_len, group_args.pred_len],
+                features=args.features,
+                target=args.target,
+                timeenc=timeenc,
+                freq=freq,
+                seasonal_patterns=group
+            )
+        data_set = Dataset_M4_Joint(datasets)
+        # batches of a single seasonal pattern, the same one on every process at every step
+        batch_sampler = GroupBatchSampler(data_set.sizes, batch_size, shuffle=shuffle_flag,
+                                          rounds=getattr(args, 'num_processes', 1))
+        data_loader = DataLoader(
+            data_set,
+            batch_sampler=batch_sampler,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            collate_fn=loader_collate(args, collate_batch))
+        return data_set, data_loader
+    elif args.data == 'm4':
         drop_last = False
         data_set = Data(
             root_path=args.root_path,
@@ -53,12 +108,25 @@ def data_provider(args, flag):
             timeenc=timeenc,
             freq=freq,
             percent=percent,
-            seasonal_patterns=args.seasonal_patterns
+            seasonal_patterns=args.seasonal_patterns,
+            cache_dir=args.cache_dir,
+            shared_memory=args.shared_memory,
+            timestamps=reads_timestamps(args),
+            storage_dtype=args.storage_dtype
         )
+    if not shuffle_flag:
+        sampler = None
+    elif args.block_shuffle:
+        sampler = BlockShuffleSampler(data_set, block_size=args.block_shuffle)
+    else:
+        sampler = WindowSampler(data_set)
     data_loader = DataLoader(
         data_set,
         batch_size=batch_size,
-        shuffle=shuffle_flag,
+        sampler=sampler,
         num_workers=args.num_workers,
-        drop_last=drop_last)
+        drop_last=drop_last,
+        # pinned batches are copied to the device asynchronously, see data_provider.prefetch
+        pin_memory=torch.cuda.is_available(),
+        collate_fn=loader_collate(args, collate_batch if hasattr(data_set, '__getitems__') else None))
     return data_set, data_loader
@@ -1,10 +1,11 @@
 import os
 import numpy as np
-import pandas as pd
+import torch
 from torch.utils.data import Dataset
-from sklearn.preprocessing import StandardScaler
-from utils.timefeatures import time_features
-from data_provider.m4 import M4Dataset, M4Meta
+from data_provider.data_store import load_table, restore_scaler
+from data_provider.memmap import open_table, will_need
+from data_provider.m4 import M4Meta, M4Packed
+from data_provider.windows import decode, gather_windows, sample_m4_windows
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -14,7 +15,8 @@ class Dataset_ETT_hour(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
                  target='OT', scale=True, timeenc=0, freq='h', percent=100,
-                 seasonal_patterns=None):
+                 seasonal_patterns=None, cache_dir=None, shared_memory=False,
+                 timestamps=True, storage_dtype='float64'):
         if size == None:
             self.seq_len = 24 * 4 * 4
             self.label_len = 24 * 4
@@ -35,22 +37,18 @@ class Dataset_ETT_hour(Dataset):
         self.timeenc = timeenc
         self.freq = freq
 
-        # self.percent = percent
-        self.root_path = '/kaggle/working/Time-LLM'
-        self.data_path = '/datasets/ETTh1.csv'
+        self.root_path = root_path
+        self.data_path = data_path
+        self.cache_dir = cache_dir
+        self.shared_memory = shared_memory
+        self.timestamps = timestamps
+        self.storage_dtype = storage_dtype
         self.__read_data__()
 
         self.enc_in = self.data_x.shape[-1]
         self.tot_len = len(self.data_x) - self.seq_len - self.pred_len + 1
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-        # df_raw = pd.read_csv(os.path.join(self.root_path,
-        #                                   self.data_path))
-        df_raw = pd.read_csv('/kaggle/working/Time-LLM/datasets/ETTh1.csv')
-        # df_raw = pd.read_csv('/content/Time-LLM/datasets/ETTh1.csv')
-
-
         border1s = [0, 12 * 30 * 24 - self.seq_len, 12 * 30 * 24 + 4 * 30 * 24 - self.seq_len]
         border2s = [12 * 30 * 24, 12 * 30 * 24 + 4 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
 
@@ -60,35 +58,14 @@ class Dataset_ETT_hour(Dataset):
         if self.set_type == 0:
             border2 = (border2 - self.seq_len) * self.percent // 100 + self.seq_len
 
-        if self.features == 'M' or self.features == 'MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
-        elif self.features == 'S':
-            df_data = df_raw[[self.target]]
-
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        data, data_stamp, self.scaler, self.quant = load_table(
+            os.path.join(self.root_path, self.data_path), self.features, self.target, self.scale, self.timeenc,
+            self.freq, border2s[0], timestamps=self.timestamps, cache_dir=self.cache_dir,
+            shared_memory=self.shared_memory, storage_dtype=self.storage_dtype)
 
         self.data_x = data[border1:border2]
         self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
-
+        self.data_stamp = data_stamp[border1:border2]
 
     def __getitem__(self, index):
         feat_id = index // self.tot_len
@@ -97,13 +74,17 @@ class Dataset_ETT_hour(Dataset):
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
         r_end = r_begin + self.label_len + self.pred_len
-        seq_x = self.data_x[s_begin:s_end, feat_id:feat_id + 1]
-        seq_y = self.data_y[r_begin:r_end, feat_id:feat_id + 1]
+        seq_x = decode(self.data_x[s_begin:s_end, feat_id:feat_id + 1], self.quant, feat_id)
+        seq_y = decode(self.data_y[r_begin:r_end, feat_id:feat_id + 1], self.quant, feat_id)
         seq_x_mark = self.data_stamp[s_begin:s_end]
         seq_y_mark = self.data_stamp[r_begin:r_end]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
+    def __getitems__(self, indices):
+        return gather_windows(self.data_x, self.data_y, self.data_stamp, indices, self.tot_len,
+                              self.seq_len, self.label_len, self.pred_len, self.quant)
+
     def __len__(self):
         return (len(self.data_x) - self.seq_len - self.pred_len + 1) * self.enc_in
 
@@ -115,7 +96,8 @@ class Dataset_ETT_minute(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTm1.csv',
                  target='OT', scale=True, timeenc=0, freq='t', percent=100,
-                 seasonal_patterns=None):
+                 seasonal_patterns=None, cache_dir=None, shared_memory=False,
+                 timestamps=True, storage_dtype='float64'):
         if size == None:
             self.seq_len = 24 * 4 * 4
             self.label_len = 24 * 4
@@ -138,16 +120,16 @@ class Dataset_ETT_minute(Dataset):
 
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_dir = cache_dir
+        self.shared_memory = shared_memory
+        self.timestamps = timestamps
+        self.storage_dtype = storage_dtype
         self.__read_data__()
 
         self.enc_in = self.data_x.shape[-1]
         self.tot_len = len(self.data_x) - self.seq_len - self.pred_len + 1
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-
         border1s = [0, 12 * 30 * 24 * 4 - self.seq_len, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.seq_len]
         border2s = [12 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4, 12 * 30 * 24 * 4 + 8 * 30 * 24 * 4]
 
@@ -157,36 +139,14 @@ class Dataset_ETT_minute(Dataset):
         if self.set_type == 0:
             border2 = (border2 - self.seq_len) * self.percent // 100 + self.seq_len
 
-        if self.features == 'M' or self.features == 'MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
-        elif self.features == 'S':
-            df_data = df_raw[[self.target]]
-
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            df_stamp['minute'] = df_stamp.date.apply(lambda row: row.minute, 1)
-            df_stamp['minute'] = df_stamp.minute.map(lambda x: x // 15)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        data, data_stamp, self.scaler, self.quant = load_table(
+            os.path.join(self.root_path, self.data_path), self.features, self.target, self.scale, self.timeenc,
+            self.freq, border2s[0], minute=True, timestamps=self.timestamps, cache_dir=self.cache_dir,
+            shared_memory=self.shared_memory, storage_dtype=self.storage_dtype)
 
         self.data_x = data[border1:border2]
         self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+        self.data_stamp = data_stamp[border1:border2]
 
     def __getitem__(self, index):
         feat_id = index // self.tot_len
@@ -195,13 +155,17 @@ class Dataset_ETT_minute(Dataset):
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
         r_end = r_begin + self.label_len + self.pred_len
-        seq_x = self.data_x[s_begin:s_end, feat_id:feat_id + 1]
-        seq_y = self.data_y[r_begin:r_end, feat_id:feat_id + 1]
+        seq_x = decode(self.data_x[s_begin:s_end, feat_id:feat_id + 1], self.quant, feat_id)
+        seq_y = decode(self.data_y[r_begin:r_end, feat_id:feat_id + 1], self.quant, feat_id)
         seq_x_mark = self.data_stamp[s_begin:s_end]
         seq_y_mark = self.data_stamp[r_begin:r_end]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
+    def __getitems__(self, indices):
+        return gather_windows(self.data_x, self.data_y, self.data_stamp, indices, self.tot_len,
+                              self.seq_len, self.label_len, self.pred_len, self.quant)
+
     def __len__(self):
         return (len(self.data_x) - self.seq_len - self.pred_len + 1) * self.enc_in
 
@@ -213,7 +177,8 @@ class Dataset_Custom(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
                  target='OT', scale=True, timeenc=0, freq='h', percent=100,
-                 seasonal_patterns=None):
+                 seasonal_patterns=None, cache_dir=None, shared_memory=False,
+                 timestamps=True, storage_dtype='float64'):
         if size == None:
             self.seq_len = 24 * 4 * 4
             self.label_len = 24 * 4
@@ -236,62 +201,35 @@ class Dataset_Custom(Dataset):
 
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_dir = cache_dir
+        self.shared_memory = shared_memory
+        self.timestamps = timestamps
+        self.storage_dtype = storage_dtype
         self.__read_data__()
 
         self.enc_in = self.data_x.shape[-1]
         self.tot_len = len(self.data_x) - self.seq_len - self.pred_len + 1
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-
-        '''
-        df_raw.columns: ['date', ...(other features), target feature]
-        '''
-        cols = list(df_raw.columns)
-        cols.remove(self.target)
-        cols.remove('date')
-        df_raw = df_raw[['date'] + cols + [self.target]]
-        num_train = int(len(df_raw) * 0.7)
-        num_test = int(len(df_raw) * 0.2)
-        num_vali = len(df_raw) - num_train - num_test
-        border1s = [0, num_train - self.seq_len, len(df_raw) - num_test - self.seq_len]
-        border2s = [num_train, num_train + num_vali, len(df_raw)]
+        data, data_stamp, self.scaler, self.quant = load_table(
+            os.path.join(self.root_path, self.data_path), self.features, self.target, self.scale, self.timeenc,
+            self.freq, 0.7, target_last=True, timestamps=self.timestamps, cache_dir=self.cache_dir,
+            shared_memory=self.shared_memory, storage_dtype=self.storage_dtype)
+
+        num_train = int(len(data) * 0.7)
+        num_test = int(len(data) * 0.2)
+        num_vali = len(data) - num_train - num_test
+        border1s = [0, num_train - self.seq_len, len(data) - num_test - self.seq_len]
+        border2s = [num_train, num_train + num_vali, len(data)]
         border1 = border1s[self.set_type]
         border2 = border2s[self.set_type]
 
         if self.set_type == 0:
             border2 = (border2 - self.seq_len) * self.percent // 100 + self.seq_len
 
-        if self.features == 'M' or self.features == 'MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
-        elif self.features == 'S':
-            df_data = df_raw[[self.target]]
-
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
-
         self.data_x = data[border1:border2]
         self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+        self.data_stamp = data_stamp[border1:border2]
 
     def __getitem__(self, index):
         feat_id = index // self.tot_len
@@ -300,13 +238,17 @@ class Dataset_Custom(Dataset):
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
         r_end = r_begin + self.label_len + self.pred_len
-        seq_x = self.data_x[s_begin:s_end, feat_id:feat_id + 1]
-        seq_y = self.data_y[r_begin:r_end, feat_id:feat_id + 1]
+        seq_x = decode(self.data_x[s_begin:s_end, feat_id:feat_id + 1], self.quant, feat_id)
+        seq_y = decode(self.data_y[r_begin:r_end, feat_id:feat_id + 1], self.quant, feat_id)
         seq_x_mark = self.data_stamp[s_begin:s_end]
         seq_y_mark = self.data_stamp[r_begin:r_end]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
+    def __getitems__(self, indices):
+        return gather_windows(self.data_x, self.data_y, self.data_stamp, indices, self.tot_len,
+                              self.seq_len, self.label_len, self.pred_len, self.quant)
+
     def __len__(self):
         return (len(self.data_x) - self.seq_len - self.pred_len + 1) * self.enc_in
 
@@ -314,6 +256,136 @@ class Dataset_Custom(Dataset):
         return self.scaler.inverse_transform(data)
 
 
+class Dataset_Memmap(Dataset):
+    """
+    Out-of-core counterpart of Dataset_Custom over a table written by data_provider.memmap.convert_csv.
+    The split borders are row ranges of the memory-mapped table and windows are scaled when they are read.
+    """
+
+    def __init__(self, root_path, flag='train', size=None,
+                 features='S', data_path='ETTh1',
+                 target='OT', scale=True, timeenc=0, freq='h', percent=100,
+                 seasonal_patterns=None, cache_dir=None, shared_memory=False,
+                 timestamps=True, storage_dtype='float64'):
+        if size == None:
+            self.seq_len = 24 * 4 * 4
+            self.label_len = 24 * 4
+            self.pred_len = 24 * 4
+        else:
+            self.seq_len = size[0]
+            self.label_len = size[1]
+            self.pred_len = size[2]
+        # init
+        assert flag in ['train', 'test', 'val']
+        type_map = {'train': 0, 'val': 1, 'test': 2}
+        self.set_type = type_map[flag]
+
+        self.features = features
+        self.target = target
+        self.scale = scale
+        self.timeenc = timeenc
+        self.freq = freq
+        self.percent = percent
+
+        self.root_path = root_path
+        self.data_path = data_path
+        self.timestamps = timestamps
+        self.storage_dtype = storage_dtype
+        self.__read_data__()
+
+        self.enc_in = len(self.channels)
+        self.tot_len = self.border2 - self.border1 - self.seq_len - self.pred_len + 1
+
+    def __read_data__(self):
+        self.values, self.stamp, meta = open_table(os.path.join(self.root_path, self.data_path))
+        if meta['target'] != self.target or meta['timeenc'] != self.timeenc or meta['freq'] != self.freq:
+            raise ValueError('{} was converted with target={}, timeenc={}, freq={}'.format(
+                self.data_path, meta['target'], meta['timeenc'], meta['freq']))
+
+        if not self.timestamps:
+            self.stamp = self.stamp[:, :0]
+
+        rows = meta['rows']
+        num_train = int(rows * 0.7)
+        num_test = int(rows * 0.2)
+        num_vali = rows - num_train - num_test
+        border1s = [0, num_train - self.seq_len, rows - num_test - self.seq_len]
+        border2s = [num_train, num_train + num_vali, rows]
+        self.border1 = border1s[self.set_type]
+        self.border2 = border2s[self.set_type]
+
+        if self.set_type == 0:
+            self.border2 = (self.border2 - self.seq_len) * self.percent // 100 + self.seq_len
+
+        if self.features == 'M' or self.features == 'MS':
+            self.channels = np.arange(len(meta['columns']))
+        elif self.features == 'S':
+            self.channels = np.array([meta['columns'].index(self.target)])
+
+        self.mean = np.array(meta['mean'])[self.channels]
+        self.std = np.array(meta['std'])[self.channels]
+        if not self.scale:
+            self.mean = np.zeros_like(self.mean)
+            self.std = np.ones_like(self.std)
+        self.scaler = restore_scaler(self.mean, self.std, self.std ** 2, meta['train_end'])
+
+    def __getitem__(self, index):
+        feat_id = index // self.tot_len
+        s_begin = index % self.tot_len + self.border1
+
+        s_end = s_begin + self.seq_len
+        r_begin = s_end - self.label_len
+        r_end = r_begin + self.label_len + self.pred_len
+        channel = self.channels[feat_id]
+        seq_x = (self.values[channel, s_begin:s_end, None] - self.mean[feat_id]) / self.std[feat_id]
+        seq_y = (self.values[channel, r_begin:r_end, None] - self.mean[feat_id]) / self.std[feat_id]
+        seq_x_mark = self.stamp[s_begin:s_end]
+        seq_y_mark = self.stamp[r_begin:r_end]
+
+        return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        feat_id = indices // self.tot_len
+        s_begin = indices % self.tot_len + self.border1
+        r_begin = s_begin + self.seq_len - self.label_len
+        x_rows = s_begin[:, None] + np.arange(self.seq_len)
+        y_rows = r_begin[:, None] + np.arange(self.label_len + self.pred_len)
+        channel = self.channels[feat_id][:, None]
+        mean = self.mean[feat_id][:, None]
+        std = self.std[feat_id][:, None]
+
+        seq_x = (self.values[channel, x_rows] - mean) / std
+        seq_y = (self.values[channel, y_rows] - mean) / std
+        return (torch.from_numpy(seq_x[..., None].astype(np.float32)),
+                torch.from_numpy(seq_y[..., None].astype(np.float32)),
+                torch.from_numpy(self.stamp[x_rows].astype(np.float32)),
+                torch.from_numpy(self.stamp[y_rows].astype(np.float32)))
+
+    def prefetch(self, indices):
+        """
+        Read ahead the rows of the given windows, merged into one contiguous range per run of nearby windows.
+        """
+        indices = np.unique(indices)
+        if not len(indices):
+            return
+        window = self.seq_len + self.pred_len
+        breaks = np.flatnonzero((np.diff(indices) > window) | (np.diff(indices // self.tot_len) != 0)) + 1
+        rows, width = self.stamp.shape
+        for run in np.split(indices, breaks):
+            channel = self.channels[run[0] // self.tot_len]
+            first = run[0] % self.tot_len + self.border1
+            last = run[-1] % self.tot_len + self.border1 + window
+            will_need(self.values, channel * rows + first, channel * rows + last)
+            will_need(self.stamp, first * width, last * width)
+
+    def __len__(self):
+        return self.tot_len * self.enc_in
+
+    def inverse_transform(self, data):
+        return self.scaler.inverse_transform(data)
+
+
 class Dataset_M4(Dataset):
     def __init__(self, root_path, flag='pred', size=None,
                  features='S', data_path='ETTh1.csv',
@@ -338,16 +410,11 @@ class Dataset_M4(Dataset):
         self.__read_data__()
 
     def __read_data__(self):
-        # M4Dataset.initialize()
-        if self.flag == 'train':
-            dataset = M4Dataset.load(training=True, dataset_file=self.root_path)
-        else:
-            dataset = M4Dataset.load(training=False, dataset_file=self.root_path)
-        training_values = np.array(
-            [v[~np.isnan(v)] for v in
-             dataset.values[dataset.groups == self.seasonal_patterns]])  # split different frequencies
-        self.ids = np.array([i for i in dataset.ids[dataset.groups == self.seasonal_patterns]])
-        self.timeseries = [ts for ts in training_values]
+        # packed series of this seasonal pattern (M4Packed), memory-mapped from the cache next to the dataset
+        self.packed = M4Packed.load(training=self.flag == 'train', dataset_file=self.root_path) \
+            .group(self.seasonal_patterns)
+        self.ids = self.packed.ids
+        self.timeseries = self.packed.series()
 
     def __getitem__(self, index):
         insample = np.zeros((self.seq_len, 1))
@@ -369,6 +436,10 @@ class Dataset_M4(Dataset):
         outsample_mask[:len(outsample_window), 0] = 1.0
         return insample, outsample, insample_mask, outsample_mask
 
+    def __getitems__(self, indices):
+        return sample_m4_windows(self.packed.values, self.packed.offsets, self.packed.lengths, indices,
+                                 self.seq_len, self.label_len, self.pred_len, self.window_sampling_limit)
+
     def __len__(self):
         return len(self.timeseries)
 
@@ -382,11 +453,42 @@ class Dataset_M4(Dataset):
 
         :return: Last insample window of all timeseries. Shape "timeseries, insample size"
         """
-        insample = np.zeros((len(self.timeseries), self.seq_len))
-        insample_mask = np.zeros((len(self.timeseries), self.seq_len))
-        for i, ts in enumerate(self.timeseries):
-            ts_last_window = ts[-self.seq_len:]
-            insample[i, -len(ts):] = ts_last_window
-            insample_mask[i, -len(ts):] = 1.0
-        return insample, insample_mask
+        lengths = np.asarray(self.packed.lengths)[:, None]
+        positions = lengths - self.seq_len + np.arange(self.seq_len)
+        insample_mask = positions >= 0
+        index = np.asarray(self.packed.offsets)[:, None] + np.maximum(positions, 0)
+        insample = np.where(insample_mask, self.packed.values[index], 0).astype(np.float64)
+        return insample, insample_mask.astype(np.float64)
+
+
+class Dataset_M4_Joint(Dataset):
+    """
+    The seasonal patterns of M4 in one dataset, for joint training (--seasonal_patterns All): datasets maps every
+    pattern to its Dataset_M4, built with the lengths of its horizon (see data_provider.m4.group_config). Sample
+    indices run over the patterns in order. A batch must not mix patterns (see samplers.GroupBatchSampler) and
+    carries its pattern as {'group': pattern} after its four tensors.
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.groups = list(datasets)
+        self.sizes = [len(data_set) for data_set in datasets.values()]
+        self.starts = np.cumsum([0] + self.sizes[:-1])
+
+    def _group(self, index):
+        g = np.searchsorted(self.starts, index, side='right') - 1
+        while not self.sizes[g]:
+            g -= 1
+        return self.groups[g], self.starts[g]
+
+    def __getitem__(self, index):
+        group, start = self._group(index)
+        return self.datasets[group][index - start]
 
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        group, start = self._group(indices[0])
+        return tuple(self.datasets[group].__getitems__(indices - start)) + ({'group': group},)
+
+    def __len__(self):
+        return sum(self.sizes)
@@ -0,0 +1,403 @@
+"""
+Parsing, scaling and time feature extraction shared by the CSV datasets, with an optional on-disk cache.
+
+Besides CSV, the datasets read Parquet (.parquet, .pq) and Arrow IPC / Feather (.arrow, .feather, .ipc) files
+with the same columns, which needs pyarrow. Only the columns used by the task are read, and timestamp
+columns are used as they are instead of being parsed from text.
+
+The cache holds the scaled values, the time features of every row and the scaler parameters as .npy files,
+keyed by the content hash of the input file and every option that changes them. Cached arrays are memory-mapped,
+so a warm start does not parse the file at all.
+
+Within a process every table is also loaded once: the train, val and test datasets (and every --itr run)
+get views into the same arrays, their borders only select different row ranges.
+
+Tables can also be placed in named POSIX shared memory, keyed like the on-disk cache. The first process
+on a host creates the segment, the other ranks and concurrent jobs on the same data attach to it, and
+forked DataLoader workers inherit the mapping, so the memory use does not grow with processes or workers.
+Segments outlive the jobs for the next ones; they are files in /dev/shm named timellm_*.
+
+Tables can be stored in a smaller dtype than float64 (see encode_table), before they are cached or shared, and
+the windows are decoded to float32 when they are gathered (see data_provider.windows.decode).
+"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+from data_provider.windows import decode
+from utils.timefeatures import as_stamps, calendar_features, stamp_range
+
+CACHE_VERSION = 1
+
+SHM_PREFIX = 'timellm_'
+SHM_HEADER_BYTES = 4096
+SHM_TIMEOUT = 600
+
+STORAGE_DTYPES = ('float64', 'float32', 'float16', 'bfloat16', 'int16')
+
+COLUMNAR_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'ipc', '.feather': 'ipc', '.ipc': 'ipc'}
+
+# tables already loaded by this process, see load_table
+_tables = {}
+# shared memory segments mapped by this process, they must stay open while their arrays are used
+_segments = {}
+
+
+def file_digest(path, cache_dir=None):
+    """
+    sha256 of the file content. With a cache directory the digest is remembered per (path, size, mtime),
+    so unchanged files are only hashed once.
+    """
+    stat = os.stat(path)
+    memo = None
+    if cache_dir:
+        ident = '{}:{}:{}'.format(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+        memo = os.path.join(cache_dir, 'digests', hashlib.sha256(ident.encode()).hexdigest())
+        if os.path.exists(memo):
+            with open(memo) as f:
+                return f.read()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    if memo is not None:
+        os.makedirs(os.path.dirname(memo), exist_ok=True)
+        with open(memo + '.tmp{}'.format(os.getpid()), 'w') as f:
+            f.write(digest)
+        os.replace(memo + '.tmp{}'.format(os.getpid()), memo)
+    return digest
+
+
+def calendar_stamp(dates, timeenc, freq, minute=False):
+    """
+    Time features of every row: integer calendar fields for timeenc 0 (plus 15 minute buckets for the minute
+    datasets), normalized features of utils.timefeatures for timeenc 1. Evenly spaced dates are served from
+    the memo of stamp_range, the result may be read-only.
+    """
+    stamps = as_stamps(dates)
+    if len(stamps) > 1:
+        steps = np.diff(stamps)
+        if steps[0] > 0 and (steps == steps[0]).all():
+            return stamp_range(stamps[0], len(stamps), timeenc, freq, minute, step=int(steps[0]))
+    return calendar_features(stamps, timeenc, freq, minute)
+
+
+def read_frame(path, columns=None):
+    """
+    Read a table from CSV, Parquet or Arrow IPC, chosen by the file extension.
+
+    :param columns: the columns to read, in this order, or None for all of them
+    """
+    file_format = COLUMNAR_FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        if columns is None:
+            return pd.read_csv(path)
+        return pd.read_csv(path, usecols=columns)[columns]
+    try:
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('reading {} requires pyarrow, install it with: pip install pyarrow'.format(path))
+    if file_format == 'parquet':
+        table = pyarrow.parquet.read_table(path, columns=columns)
+    else:
+        table = pyarrow.feather.read_table(path, columns=columns, memory_map=True)
+    df_raw = table.to_pandas()
+    if df_raw.index.name is not None:
+        # a date index written by DataFrame.to_parquet
+        df_raw = df_raw.reset_index()
+    return df_raw if columns is None else df_raw[columns]
+
+
+def restore_scaler(mean, scale, var, n_samples):
+    scaler = StandardScaler()
+    scaler.mean_ = mean
+    scaler.scale_ = scale
+    scaler.var_ = var
+    scaler.n_samples_seen_ = n_samples
+    scaler.n_features_in_ = len(mean)
+    return scaler
+
+
+def parse_table(path, features, target, scale, timeenc, freq, train_end, target_last=False, minute=False,
+                timestamps=True):
+    """
+    Read a table with a leading date column the way the Dataset_* classes do, see read_frame. For features S
+    only the date and target columns are read.
+
+    :param train_end: rows used to fit the scaler, or a fraction of the rows if a float
+    :param target_last: move the target column last, as Dataset_Custom does
+    :param timestamps: compute the time features, otherwise they have zero width
+    :return: (values, time features, scaler) over all rows
+    """
+    df_raw = read_frame(path, ['date', target] if features == 'S' else None)
+    if target_last:
+        cols = list(df_raw.columns)
+        cols.remove(target)
+        cols.remove('date')
+        df_raw = df_raw[['date'] + cols + [target]]
+    if isinstance(train_end, float):
+        train_end = int(len(df_raw) * train_end)
+
+    if features == 'M' or features == 'MS':
+        cols_data = df_raw.columns[1:]
+        df_data = df_raw[cols_data]
+    elif features == 'S':
+        df_data = df_raw[[target]]
+
+    scaler = StandardScaler()
+    if scale:
+        train_data = df_data[0:train_end]
+        scaler.fit(train_data.values)
+        data = scaler.transform(df_data.values)
+    else:
+        data = df_data.values
+
+    if not timestamps:
+        return data, np.zeros((len(df_raw), 0)), scaler
+    return data, calendar_stamp(df_raw['date'], timeenc, freq, minute), scaler
+
+
+def encode_table(data, data_stamp, storage_dtype):
+    """
+    Convert the values of a table to storage_dtype. bfloat16 values are kept as the upper half of their float32
+    bits in a uint16 array, numpy has no bfloat16. int16 values are quantised per channel, the range of every
+    channel mapped to [-32767, 32767]. The stamps are kept as float32 unless storage_dtype is float64.
+    Decoded bfloat16 values are within 2 ** -8 of their float32 values relatively, int16 values within half a
+    quantisation step, (max - min) / 131068 of their channel, plus the float32 rounding of the dequantisation.
+
+    :return: (values, stamps, quant), quant is the per-channel (scale, offset) of int16 values and None otherwise
+    """
+    quant = None
+    if storage_dtype == 'float64':
+        return data, data_stamp, quant
+    data = np.asarray(data, dtype=np.float64)
+    if storage_dtype == 'bfloat16':
+        # round to nearest even on the 16 dropped bits
+        bits = data.astype(np.float32).view(np.uint32).astype(np.uint64)
+        values = ((bits + 0x7fff + (bits >> 16 & 1)) >> 16).astype(np.uint16)
+    elif storage_dtype == 'int16':
+        low, high = data.min(0), data.max(0)
+        scale = (high - low) / 65534
+        scale[scale == 0] = 1.
+        offset = (high + low) / 2
+        values = np.clip(np.rint((data - offset) / scale), -32767, 32767).astype(np.int16)
+        quant = (scale.astype(np.float32), offset.astype(np.float32))
+    else:
+        values = data.astype(storage_dtype)
+    return values, np.asarray(data_stamp, dtype=np.float32), quant
+
+
+def storage_error(data, values, quant):
+    """
+    :return: (max abs, rms) error of the decoded values against the float32 values the loaders used to return
+    """
+    error = decode(values, quant) - np.asarray(data, dtype=np.float32)
+    return float(np.abs(error).max(initial=0)), float(np.sqrt(np.mean(np.square(error, dtype=np.float64))))
+
+
+def load_table(path, features, target, scale, timeenc, freq, train_end, target_last=False, minute=False,
+               timestamps=True, cache_dir=None, shared_memory=False, storage_dtype='float64'):
+    """
+    parse_table, shared with the previous calls of this process for the same file and options, and served from
+    shared memory or the on-disk cache when another process already prepared it. The returned arrays are
+    shared, callers only take views of them.
+
+    :param storage_dtype: one of STORAGE_DTYPES, see encode_table
+    :return: (values, time features, scaler, quant) where quant is the (scale, offset) of int16 values
+    """
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError('storage_dtype must be one of {}, got {}'.format(STORAGE_DTYPES, storage_dtype))
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns, features, target, scale, timeenc, freq,
+           train_end, target_last, minute, timestamps, storage_dtype)
+    if key not in _tables:
+        args = (path, features, target, scale, timeenc, freq, train_end, target_last, minute, timestamps,
+                storage_dtype, cache_dir)
+        if shared_memory:
+            name = SHM_PREFIX + table_options(*args[:-1], cache_dir=cache_dir)[1][:24]
+            _tables[key] = attach_or_create(name, lambda: _load_table(*args))
+        else:
+            _tables[key] = _load_table(*args)
+    return _tables[key]
+
+
+def clear_tables():
+    """
+    Drop the tables shared in this process, the datasets built from them keep their own references.
+    """
+    _tables.clear()
+
+
+def table_options(path, features, target, scale, timeenc, freq, train_end, target_last, minute, timestamps=True,
+                  storage_dtype='float64', cache_dir=None):
+    """
+    :return: (options, key) identifying a prepared table by the content of its file
+    """
+    options = {'version': CACHE_VERSION, 'file': file_digest(path, cache_dir), 'features': features,
+               'target': target, 'scale': scale, 'timeenc': timeenc, 'freq': freq, 'train_end': train_end,
+               'target_last': target_last, 'minute': minute}
+    if storage_dtype != 'float64':
+        # keeps the keys of the float64 tables cached before storage dtypes existed
+        options['storage_dtype'] = storage_dtype
+    if not timestamps:
+        options['timestamps'] = False
+    return options, hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def _parse_and_encode(path, features, target, scale, timeenc, freq, train_end, target_last, minute, timestamps,
+                      storage_dtype):
+    data, data_stamp, scaler = parse_table(path, features, target, scale, timeenc, freq, train_end, target_last,
+                                           minute, timestamps)
+    values, data_stamp, quant = encode_table(data, data_stamp, storage_dtype)
+    if storage_dtype in ('float16', 'bfloat16', 'int16'):
+        print('{} stored as {}: max abs error {:.3g}, rms error {:.3g}'.format(
+            os.path.basename(path), storage_dtype, *storage_error(data, values, quant)))
+    return values, data_stamp, scaler, quant
+
+
+def _load_table(path, features, target, scale, timeenc, freq, train_end, target_last, minute, timestamps,
+                storage_dtype, cache_dir):
+    """
+    parse_table and encode_table, served from the on-disk cache when the same file was already prepared with
+    the same options. Cached arrays are copy-on-write memory maps.
+    """
+    args = (path, features, target, scale, timeenc, freq, train_end, target_last, minute, timestamps, storage_dtype)
+    if not cache_dir:
+        return _parse_and_encode(*args)
+
+    options, key = table_options(*args, cache_dir=cache_dir)
+    folder = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '-' + key[:16])
+
+    if not os.path.exists(os.path.join(folder, 'meta.json')):
+        data, data_stamp, scaler, quant = _parse_and_encode(*args)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(dir=cache_dir)
+        np.save(os.path.join(tmp_folder, 'data.npy'), np.ascontiguousarray(data))
+        np.save(os.path.join(tmp_folder, 'stamp.npy'), np.ascontiguousarray(data_stamp))
+        if scale:
+            np.savez(os.path.join(tmp_folder, 'scaler.npz'), mean=scaler.mean_, scale=scaler.scale_,
+                     var=scaler.var_, n_samples=scaler.n_samples_seen_)
+        if quant is not None:
+            np.savez(os.path.join(tmp_folder, 'quant.npz'), scale=quant[0], offset=quant[1])
+        # meta.json is written last, a folder without it is incomplete
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(options, f)
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # prepared concurrently by another process
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        return data, data_stamp, scaler, quant
+
+    data = np.load(os.path.join(folder, 'data.npy'), mmap_mode='c')
+    data_stamp = np.load(os.path.join(folder, 'stamp.npy'), mmap_mode='c')
+    scaler = StandardScaler()
+    if scale:
+        with np.load(os.path.join(folder, 'scaler.npz')) as params:
+            scaler = restore_scaler(params['mean'], params['scale'], params['var'], params['n_samples'])
+    quant = None
+    if os.path.exists(os.path.join(folder, 'quant.npz')):
+        with np.load(os.path.join(folder, 'quant.npz')) as params:
+            quant = (params['scale'], params['offset'])
+    return data, data_stamp, scaler, quant
+
+
+def _untrack(segment):
+    # the resource tracker would unlink the segment when this process exits, while other jobs may use it
+    resource_tracker.unregister(segment._name, 'shared_memory')
+
+
+def _segment_arrays(segment, layout):
+    return {name: np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=segment.buf,
+                             offset=spec['offset'])
+            for name, spec in layout.items()}
+
+
+def _table_from_arrays(arrays, n_samples):
+    scaler = StandardScaler()
+    if 'mean' in arrays:
+        scaler = restore_scaler(arrays['mean'], arrays['scale'], arrays['var'], n_samples)
+    quant = (arrays['quant_scale'], arrays['quant_offset']) if 'quant_scale' in arrays else None
+    return arrays['data'], arrays['stamp'], scaler, quant
+
+
+def attach_or_create(name, load):
+    """
+    Map the table stored in the shared memory segment `name`, creating it from load() if no process did yet.
+
+    The segment starts with a header: a ready flag, the length of a JSON layout and the layout itself, followed
+    by the 64-byte aligned arrays. The creator sets the ready flag last, attaching processes wait for it.
+    """
+    # mapped already by this process, e.g. for the same content under another path or mtime: a second mapping
+    # would replace it in _segments and unmap the arrays of the first
+    segment = _segments.get(name)
+    deadline = time.time() + SHM_TIMEOUT
+    while segment is None:
+        try:
+            segment = SharedMemory(name=name)
+        except FileNotFoundError:
+            break
+        except ValueError:
+            # opened between its creation and its resize by the creator
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+    if segment is None:
+        data, data_stamp, scaler, quant = load()
+        arrays = {'data': np.ascontiguousarray(data), 'stamp': np.ascontiguousarray(data_stamp)}
+        if hasattr(scaler, 'mean_'):
+            arrays.update(mean=scaler.mean_, scale=scaler.scale_, var=scaler.var_)
+        if quant is not None:
+            arrays.update(quant_scale=quant[0], quant_offset=quant[1])
+        layout, offset = {}, SHM_HEADER_BYTES
+        for key, array in arrays.items():
+            layout[key] = {'shape': list(array.shape), 'dtype': array.dtype.str, 'offset': offset}
+            offset += (array.nbytes + 63) // 64 * 64
+        meta = json.dumps({'layout': layout, 'n_samples': int(getattr(scaler, 'n_samples_seen_', 0))}).encode()
+        assert len(meta) + 16 <= SHM_HEADER_BYTES
+        try:
+            segment = SharedMemory(name=name, create=True, size=offset)
+        except FileExistsError:
+            # created concurrently by another process
+            return attach_or_create(name, load)
+        _untrack(segment)
+        for key, array in _segment_arrays(segment, layout).items():
+            array[...] = arrays[key]
+        segment.buf[16:16 + len(meta)] = meta
+        struct.pack_into('<QQ', segment.buf, 0, 0, len(meta))
+        struct.pack_into('<Q', segment.buf, 0, 1)
+    elif name not in _segments:
+        _untrack(segment)
+        while struct.unpack_from('<Q', segment.buf, 0)[0] != 1:
+            if time.time() > deadline:
+                raise RuntimeError('Shared memory segment {} is not ready after {} s, its creator may have died; '
+                                   'remove /dev/shm/{} and retry'.format(name, SHM_TIMEOUT, name))
+            time.sleep(0.05)
+
+    _segments[name] = segment
+    meta_len = struct.unpack_from('<Q', segment.buf, 8)[0]
+    meta = json.loads(bytes(segment.buf[16:16 + meta_len]))
+    return _table_from_arrays(_segment_arrays(segment, meta['layout']), meta['n_samples'])
+
+
+def unlink_shared():
+    """
+    Remove every timellm_* segment from this host, e.g. at the end of a sweep. Processes still mapping them
+    keep their memory until they exit.
+    """
+    for name in os.listdir('/dev/shm'):
+        if name.startswith(SHM_PREFIX):
+            os.unlink(os.path.join('/dev/shm', name))
@@ -15,16 +15,24 @@
 """
 M4 Dataset
 """
+import copy
 from dataclasses import dataclass
 
 import numpy as np
 import pandas as pd
+import hashlib
+import json
 import logging
 import os
 import pathlib
+import shutil
 import sys
+import tempfile
 from urllib import request
 
+# version of the packed cache layout, part of its folder name
+PACKED_VERSION = 2
+
 
 def url_file_name(url: str) -> str:
     """
@@ -92,6 +100,100 @@ class M4Dataset:
                              allow_pickle=True))
 
 
+@dataclass()
+class M4Packed:
+    """
+    One part of M4 in CSR layout: the values of series i, without NaNs, are
+    values[offsets[i]:offsets[i] + lengths[i]], kept in float64 like the unpacked series so the scores are
+    unchanged. Series are grouped by seasonal pattern, in the order of
+    M4Meta.seasonal_patterns, and keep the M4-info order within a group.
+    """
+    ids: np.ndarray
+    groups: np.ndarray
+    offsets: np.ndarray
+    lengths: np.ndarray
+    values: np.ndarray
+
+    def group(self, seasonal_pattern: str) -> 'M4Packed':
+        """
+        The series of one seasonal pattern, views into the arrays of this part with offsets into their own values.
+        """
+        index = np.flatnonzero(self.groups == seasonal_pattern)
+        first, last = (index[0], index[-1] + 1) if len(index) else (0, 0)
+        start = self.offsets[first] if last > first else 0
+        end = self.offsets[last - 1] + self.lengths[last - 1] if last > first else 0
+        return M4Packed(ids=self.ids[first:last],
+                        groups=self.groups[first:last],
+                        offsets=self.offsets[first:last] - start,
+                        lengths=self.lengths[first:last],
+                        values=self.values[start:end])
+
+    def series(self) -> list:
+        """
+        :return: the values of every series, as views into values.
+        """
+        return [self.values[o:o + n] for o, n in zip(self.offsets.tolist(), self.lengths.tolist())]
+
+    @staticmethod
+    def pack(dataset: M4Dataset) -> 'M4Packed':
+        """
+        Pack the ragged values of a loaded M4 part.
+        """
+        order = np.argsort([M4Meta.seasonal_patterns.index(g) for g in dataset.groups], kind='stable')
+        series = [np.asarray(v, dtype=np.float64).reshape(-1) for v in dataset.values[order]]
+        values = np.concatenate(series) if series else np.zeros(0)
+        valid = ~np.isnan(values)
+        # NaNs are dropped wherever they are, the length of a series is its count of valid values
+        sizes = np.array([len(v) for v in series], dtype=np.int64)
+        ends = np.cumsum(sizes)
+        kept = np.concatenate([[0], np.cumsum(valid, dtype=np.int64)])
+        lengths = kept[ends] - kept[ends - sizes]
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        return M4Packed(ids=np.asarray(dataset.ids[order], dtype=str),
+                        groups=np.asarray(dataset.groups[order], dtype=str),
+                        offsets=offsets,
+                        lengths=lengths.astype(np.int64),
+                        values=values[valid])
+
+    @staticmethod
+    def load(training: bool = True, dataset_file: str = '../dataset/m4', cache_dir: str = None) -> 'M4Packed':
+        """
+        Load a packed M4 part, memory-mapped from its cache of .npy files. The cache folder is named after
+        PACKED_VERSION and the size and mtime of M4-info.csv and the part, so a changed source gets a new folder
+        and a folder is never rewritten while other processes read it.
+
+        :param training: Load training part if training is True, test part otherwise.
+        :param cache_dir: Folder of the cache, dataset_file if None.
+        """
+        part = 'training' if training else 'test'
+        sources = [os.path.join(dataset_file, 'M4-info.csv'), os.path.join(dataset_file, part + '.npz')]
+        stamp = [[os.path.realpath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in sources]
+        key = hashlib.sha256(json.dumps([PACKED_VERSION, stamp]).encode()).hexdigest()
+        folder = os.path.join(cache_dir or dataset_file, part + '-packed-' + key[:16])
+
+        if os.path.exists(os.path.join(folder, 'meta.json')):
+            return M4Packed(**{field: np.load(os.path.join(folder, field + '.npy'), mmap_mode='r')
+                               for field in M4Packed.__dataclass_fields__})
+
+        packed = M4Packed.pack(M4Dataset.load(training=training, dataset_file=dataset_file))
+        tmp_folder = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(folder)), exist_ok=True)
+            tmp_folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(folder)))
+            for field in M4Packed.__dataclass_fields__:
+                np.save(os.path.join(tmp_folder, field + '.npy'), getattr(packed, field))
+            # meta.json is written last, a folder without it is incomplete
+            with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+                json.dump({'version': PACKED_VERSION, 'sources': stamp}, f)
+            os.rename(tmp_folder, folder)
+        except OSError as e:
+            # most likely written concurrently by another process, whose folder is kept
+            logging.info(f'M4 cache not written to {folder}: {e}')
+            if tmp_folder is not None:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+        return packed
+
+
 @dataclass()
 class M4Meta:
     seasonal_patterns = ['Yearly', 'Quarterly', 'Monthly', 'Weekly', 'Daily', 'Hourly']
@@ -123,6 +225,20 @@ class M4Meta:
     }  # from interpretable.gin
 
 
+def group_config(configs, seasonal_pattern: str):
+    """
+    A copy of the run arguments with the horizon, input and label lengths and the frequency of one seasonal
+    pattern, as run_m4.py sets them for a single pattern.
+    """
+    configs = copy.copy(configs)
+    configs.seasonal_patterns = seasonal_pattern
+    configs.pred_len = M4Meta.horizons_map[seasonal_pattern]
+    configs.seq_len = 2 * configs.pred_len
+    configs.label_len = configs.pred_len
+    configs.frequency_map = M4Meta.frequency_map[seasonal_pattern]
+    return configs
+
+
 def load_m4_info() -> pd.DataFrame:
     """
     Load M4Info file.
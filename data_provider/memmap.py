@@ -0,0 +1,119 @@
+"""
+Column-major on-disk tables for datasets that do not fit in memory.
+
+A table is a directory with
+    values.npy  (channels, rows) array, every channel contiguous, target channel last
+    stamp.npy   (rows, time features) array for the timeenc/freq it was converted with
+    meta.json   column names, row count, scaler fit range and the per-channel mean and std of the train rows
+Both arrays are opened with np.memmap, only the pages of the windows that are read are loaded, and values
+are scaled per window from the stored mean and std.
+"""
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from utils.timefeatures import as_stamps, calendar_features
+
+
+def _count_rows(csv_path, chunksize):
+    # parsed like the conversion pass, so quoted newlines and blank lines are not counted as rows
+    return sum(len(chunk) for chunk in pd.read_csv(csv_path, usecols=['date'], chunksize=chunksize))
+
+
+def convert_csv(csv_path, out_dir, target='OT', timeenc=1, freq='h', minute=False, train_ratio=0.7,
+                dtype='float32', chunksize=100000):
+    """
+    Stream a CSV with a leading date column into a memmap table, chunksize rows at a time. The mean and std
+    of the first int(rows * train_ratio) rows are accumulated per chunk, as Dataset_Custom fits its scaler.
+    """
+    header = list(pd.read_csv(csv_path, nrows=0).columns)
+    columns = [c for c in header if c not in ('date', target)] + [target]
+    rows = _count_rows(csv_path, chunksize)
+    if not rows:
+        raise ValueError('{} has no rows'.format(csv_path))
+    train_end = int(rows * train_ratio)
+
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        values = open_memmap(os.path.join(tmp_dir, 'values.npy'), mode='w+', dtype=dtype, shape=(len(columns), rows))
+        stamp = None
+        count, mean, m2 = 0, np.zeros(len(columns)), np.zeros(len(columns))
+
+        start = 0
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+            chunk_values = chunk[columns].values.astype(np.float64)
+            end = start + len(chunk_values)
+            values[:, start:end] = chunk_values.T
+            # not memoised, every chunk starts at a different stamp
+            chunk_stamp = calendar_features(as_stamps(chunk['date']), timeenc, freq, minute)
+            if stamp is None:
+                stamp = open_memmap(os.path.join(tmp_dir, 'stamp.npy'), mode='w+', dtype=chunk_stamp.dtype,
+                                    shape=(rows, chunk_stamp.shape[1]))
+            stamp[start:end] = chunk_stamp
+
+            # merge the statistics of the train rows of this chunk (Chan et al.)
+            train_rows = chunk_values[:max(min(end, train_end) - start, 0)]
+            if len(train_rows):
+                n = len(train_rows)
+                delta = train_rows.mean(0) - mean
+                total = count + n
+                mean = mean + delta * n / total
+                m2 = m2 + ((train_rows - train_rows.mean(0)) ** 2).sum(0) + delta ** 2 * count * n / total
+                count = total
+            start = end
+
+        std = np.sqrt(m2 / max(count, 1))
+        std[std == 0] = 1.
+        values.flush()
+        stamp.flush()
+        del values, stamp
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'columns': columns, 'target': target, 'rows': rows, 'train_end': train_end,
+                       'mean': mean.tolist(), 'std': std.tolist(), 'timeenc': timeenc, 'freq': freq,
+                       'minute': minute}, f)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return out_dir
+
+
+def open_table(path):
+    """
+    :return: (values, stamp, meta) of a memmap table, the arrays are read-only memory maps
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+    stamp = np.load(os.path.join(path, 'stamp.npy'), mmap_mode='r')
+    return values, stamp, meta
+
+
+def will_need(array, first, last):
+    """
+    Ask the kernel to read ahead the flat element range [first, last) of an array opened by open_table,
+    or read it if madvise is not available.
+    """
+    first, last = max(first, 0), min(last, array.size)
+    if last <= first:
+        return
+    buffer = getattr(array, '_mmap', None)
+    if buffer is not None and hasattr(buffer, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+        # np.memmap maps the file from the allocation boundary below the array offset
+        base = array.offset % mmap.ALLOCATIONGRANULARITY
+        begin = base + first * array.itemsize
+        begin -= begin % mmap.PAGESIZE
+        end = min(base + last * array.itemsize, len(buffer))
+        buffer.madvise(mmap.MADV_WILLNEED, begin, end - begin)
+    else:
+        np.asarray(array).reshape(-1)[first:last].sum()
@@ -0,0 +1,136 @@
+import queue
+import threading
+from contextlib import nullcontext
+
+import torch
+
+from utils.prometheus import loader_queue_depth
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for item in batch:
+            _record_stream(item, stream)
+
+
+class BatchPrefetcher:
+    """
+    Iterates over a dataloader in a background thread that keeps the next `depth` batches ready while the
+    current step computes. Every batch goes through prepare(batch) in that thread, e.g. the dtype conversion,
+    the device copy and the decoder input of the training loops.
+
+    With CUDA the thread runs on a side stream: the copies of the next batches (from pinned memory if the
+    dataloader pins it) overlap the kernels of the current step, and the consuming stream only waits for a batch
+    when it takes it. depth=0 prepares every batch synchronously when it is requested.
+
+    Accelerate marks the end of a prepared dataloader when its last batch is fetched, which the prefetch
+    thread does ahead of the loop, so only wrap loaders whose loop does not use gather_for_metrics.
+    Other attributes (set_epoch, sampler, ...) are those of the wrapped dataloader.
+
+    With a StepTimer, every prepare(batch) is recorded as its background 'h2d' phase.
+    """
+
+    def __init__(self, loader, prepare=None, depth=2, timer=None):
+        self.loader = loader
+        self.prepare = prepare
+        self.depth = depth
+        self.timer = timer
+        # the queue and the dataloader iterator of the running iteration, see queue_depth
+        self._ready = None
+        self._iterator = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def _prepare(self, batch):
+        if self.prepare is None:
+            return batch
+        if self.timer is None:
+            return self.prepare(batch)
+        with self.timer.background('h2d'):
+            return self.prepare(batch)
+
+    def queue_depth(self):
+        """
+        Batches prepared ahead of the loop: those waiting in the prefetch queue plus those prefetched by the
+        workers of the wrapped dataloader, or -1 if the latter is unknown.
+        """
+        ready = self._ready.qsize() if self._ready is not None else 0
+        if self._iterator is None:
+            return ready
+        prefetched = loader_queue_depth(self._iterator)
+        return -1 if prefetched < 0 else ready + prefetched
+
+    def __iter__(self):
+        if self.depth <= 0:
+            self._iterator = iter(self.loader)
+            try:
+                for batch in self._iterator:
+                    yield self._prepare(batch)
+            finally:
+                self._iterator = None
+            return
+
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        ready = queue.Queue(maxsize=self.depth)
+        self._ready = ready
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            iterator = iter(self.loader)
+            self._iterator = iterator
+            try:
+                with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                    for batch in iterator:
+                        batch = self._prepare(batch)
+                        event = None
+                        if stream is not None:
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                        if not put((batch, event)):
+                            return
+                # only the batches of the queue are left
+                self._iterator = None
+                put((end, None))
+            except BaseException as e:
+                self._iterator = None
+                put((e, None))
+            finally:
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event = ready.get()
+                if batch is end:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                if event is not None:
+                    current = torch.cuda.current_stream()
+                    current.wait_event(event)
+                    _record_stream(batch, current)
+                yield batch
+        finally:
+            # the loop may stop early, release the thread blocked on a full queue
+            stop.set()
+            thread.join()
+            self._ready = self._iterator = None
@@ -0,0 +1,186 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class WindowSampler(Sampler):
+    """
+    Seeded, epoch-aware and resumable sampler over the (channel, window) index space of the datasets,
+    where index = feat_id * tot_len + s_begin.
+
+    The order of an epoch only depends on (seed, epoch), so it can be replayed after a restart. The training
+    loop reports the samples it has trained on with advance(); state_dict() records them and the next
+    iteration over the same epoch only yields the remaining ones. The sampler is not sharded itself, accelerate
+    splits its batches between the processes.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=None):
+        """
+        :param seed: base seed of the shuffle order, drawn from the torch RNG if None
+        """
+        self.num_samples = len(data_source)
+        self.shuffle = shuffle
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.epoch = 0
+        self.consumed = 0
+        # position in the order where the current iteration starts, see __len__
+        self.start = 0
+
+    def order(self):
+        """
+        :return: the global sample order of the current epoch
+        """
+        if not self.shuffle:
+            return np.arange(self.num_samples)
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return torch.randperm(self.num_samples, generator=generator).numpy()
+
+    def __iter__(self):
+        self.start = self.consumed
+        return iter(self.order()[self.start:].tolist())
+
+    def __len__(self):
+        # the samples left in the epoch, fixed while an iteration runs even though advance() moves on
+        return self.num_samples - self.start
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.consumed = self.start = 0
+
+    def advance(self, n):
+        """
+        Mark the next n samples of the global order (all replicas together) as consumed.
+        """
+        self.consumed = min(self.consumed + n, self.num_samples)
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'consumed': self.consumed}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.consumed = self.start = state_dict['consumed']
+
+
+class BlockShuffleSampler(WindowSampler):
+    """
+    WindowSampler for datasets read from disk. Instead of a full permutation, the windows of every channel
+    are cut into contiguous blocks of block_size windows, the blocks are shuffled, and the windows of every
+    buffer_blocks consecutive blocks are shuffled together. Reads stay sequential within a block, and while
+    one buffer is consumed a single background worker asks the dataset to prefetch the next one if it has a
+    prefetch(indices) method.
+    """
+
+    def __init__(self, data_source, block_size=1024, buffer_blocks=16, shuffle=True, seed=None):
+        super().__init__(data_source, shuffle, seed)
+        self.data_source = data_source
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+
+    def order(self):
+        if not self.shuffle:
+            return np.arange(self.num_samples)
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # blocks never straddle two channels, every channel starts a new block
+        tot_len = getattr(self.data_source, 'tot_len', self.num_samples)
+        starts = np.concatenate([np.arange(c, min(c + tot_len, self.num_samples), self.block_size)
+                                 for c in range(0, self.num_samples, tot_len)])
+        ends = np.minimum(starts + self.block_size, (starts // tot_len + 1) * tot_len)
+        ends = np.minimum(ends, self.num_samples)
+        blocks = rng.permutation(len(starts))
+        order = []
+        for i in range(0, len(blocks), self.buffer_blocks):
+            buffer = np.concatenate([np.arange(starts[b], ends[b]) for b in blocks[i:i + self.buffer_blocks]])
+            order.append(rng.permutation(buffer))
+        return np.concatenate(order) if order else np.arange(0)
+
+    def __iter__(self):
+        indices = np.fromiter(super().__iter__(), dtype=np.int64)
+        prefetch = getattr(self.data_source, 'prefetch', None)
+        step = self.block_size * self.buffer_blocks
+        if prefetch is None or len(indices) <= step:
+            yield from indices.tolist()
+            return
+        # one worker for the whole iteration, at most one buffer prefetched ahead
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending = None
+        try:
+            for start in range(0, len(indices), step):
+                if start + step < len(indices):
+                    if pending is not None:
+                        pending.result()
+                    pending = executor.submit(prefetch, indices[start + step:start + 2 * step])
+                yield from indices[start:start + step].tolist()
+        finally:
+            executor.shutdown()
+
+
+class GroupBatchSampler(Sampler):
+    """
+    Batch sampler over a dataset made of groups whose samples cannot share a batch, as the seasonal patterns of
+    joint M4 training, whose windows have different lengths. Sample indices run over the groups in order.
+
+    Batches come in runs of `rounds` full batches of the same group: accelerate hands the i-th batch to process
+    i % num_processes, so with rounds = num_processes every process trains on the same group at every step.
+    An epoch has as many runs as it takes to cover every sample once, shared out between the groups in
+    proportion to their sizes, every group getting at least one (see runs). Every epoch the samples of each
+    group are shuffled and cut into its runs, and the runs of all groups are shuffled together. A group whose
+    share is short of its size by part of a run skips a different few of its samples every epoch, one whose
+    share exceeds it fills its last run with samples from its start.
+    """
+
+    def __init__(self, group_sizes, batch_size, shuffle=True, seed=None, rounds=1):
+        """
+        :param group_sizes: number of samples of every group
+        :param seed: base seed of the shuffle order, drawn from the torch RNG if None
+        """
+        self.group_sizes = list(group_sizes)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.rounds = rounds
+        self.drop_last = False
+        self.epoch = 0
+        self.runs = self._share_runs()
+
+    def _share_runs(self):
+        """
+        :return: runs of every group per epoch, in proportion to the group sizes by the largest remainder method
+        """
+        sizes = np.array(self.group_sizes, dtype=np.int64)
+        quotas = sizes / (self.rounds * self.batch_size)
+        runs = np.floor(quotas).astype(np.int64)
+        left = math.ceil(sizes.sum() / (self.rounds * self.batch_size)) - runs.sum()
+        runs[np.argsort(runs - quotas, kind='stable')[:left]] += 1
+        runs[(runs == 0) & (sizes > 0)] = 1
+        return runs.tolist()
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        runs = []
+        start = 0
+        for size, group_runs in zip(self.group_sizes, self.runs):
+            if size:
+                indices = start + (rng.permutation(size) if self.shuffle else np.arange(size))
+                length = group_runs * self.rounds * self.batch_size
+                indices = np.resize(indices, length).reshape(-1, self.rounds, self.batch_size)
+                runs.extend(indices)
+            start += size
+        order = rng.permutation(len(runs)) if self.shuffle else range(len(runs))
+        for run in order:
+            yield from runs[run].tolist()
+
+    def __len__(self):
+        return sum(self.runs) * self.rounds
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
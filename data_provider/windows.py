@@ -0,0 +1,109 @@
+import numpy as np
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+from torch.utils.data import default_collate
+
+
+def decode(values, quant=None, channels=slice(None)):
+    """
+    values stored by data_store.encode_table as float32: uint16 values are bfloat16 bits, int16 values are
+    dequantised with the per-channel (scale, offset) of quant, indexed by channels so that they broadcast
+    against values.
+    """
+    if values.dtype == np.uint16:
+        return (values.astype(np.uint32) << 16).view(np.float32)
+    values = values.astype(np.float32, copy=False)
+    if quant is not None:
+        values = values * quant[0][channels] + quant[1][channels]
+    return values
+
+
+def gather_windows(data_x, data_y, data_stamp, indices, tot_len, seq_len, label_len, pred_len, quant=None):
+    """
+    Whole-batch equivalent of Dataset_*.__getitem__: builds the input, target and mark windows of every index
+    with one fancy index per array into a strided window view, so no per-sample slicing or stacking is needed.
+
+    :param indices: flat sample indices, index = feat_id * tot_len + s_begin
+    :param quant: per-channel (scale, offset) of int16 values, see decode
+    :return: float32 tensors of shapes (B, seq_len, 1), (B, label_len + pred_len, 1),
+             (B, seq_len, n_marks) and (B, label_len + pred_len, n_marks)
+    """
+    indices = np.asarray(indices)
+    feat_id = indices // tot_len
+    s_begin = indices % tot_len
+    r_begin = s_begin + seq_len - label_len
+    y_len = label_len + pred_len
+
+    # (windows, channels, length) views sharing memory with the data
+    seq_x = sliding_window_view(data_x, seq_len, axis=0)[s_begin, feat_id]
+    seq_y = sliding_window_view(data_y, y_len, axis=0)[r_begin, feat_id]
+    seq_x_mark = sliding_window_view(data_stamp, seq_len, axis=0)[s_begin]
+    seq_y_mark = sliding_window_view(data_stamp, y_len, axis=0)[r_begin]
+
+    return (torch.from_numpy(decode(seq_x, quant, feat_id[:, None])[..., None]),
+            torch.from_numpy(decode(seq_y, quant, feat_id[:, None])[..., None]),
+            torch.from_numpy(seq_x_mark.transpose(0, 2, 1).astype(np.float32)),
+            torch.from_numpy(seq_y_mark.transpose(0, 2, 1).astype(np.float32)))
+
+
+def sample_m4_windows(values, offsets, lengths, indices, seq_len, label_len, pred_len, window_sampling_limit):
+    """
+    Whole-batch equivalent of Dataset_M4.__getitem__ over packed series (data_provider.m4.M4Packed): draws the
+    cut point of every series of the batch with one np.random.randint call, from the same range, and gathers
+    the insample and outsample windows and their masks with one fancy index into values each.
+
+    :param indices: series indices
+    :return: float32 tensors insample, outsample, insample_mask, outsample_mask of shapes (B, seq_len, 1) and
+             (B, label_len + pred_len, 1)
+    """
+    indices = np.asarray(indices)
+    offset = np.asarray(offsets)[indices]
+    length = np.asarray(lengths)[indices]
+    cut_point = np.random.randint(low=np.maximum(1, length - window_sampling_limit), high=length)
+
+    # insample: the seq_len values before the cut point, right aligned
+    positions = cut_point[:, None] + np.arange(-seq_len, 0)
+    insample_mask = positions >= 0
+    # outsample: the values from cut_point - label_len, left aligned. A negative start counts from the end of
+    # the series, as the slice of __getitem__ does.
+    start = cut_point - label_len
+    start = np.where(start < 0, np.maximum(start + length, 0), start)
+    count = np.minimum(length, cut_point + pred_len) - start
+    steps = np.arange(label_len + pred_len)
+    outsample_mask = steps < count[:, None]
+
+    def gather(positions, mask):
+        index = offset[:, None] + np.clip(positions, 0, length[:, None] - 1)
+        return torch.from_numpy(np.where(mask, values[index], 0).astype(np.float32)[..., None])
+
+    return (gather(positions, insample_mask),
+            gather(start[:, None] + steps, outsample_mask),
+            torch.from_numpy(insample_mask.astype(np.float32)[..., None]),
+            torch.from_numpy(outsample_mask.astype(np.float32)[..., None]))
+
+
+def collate_batch(batch):
+    """
+    The datasets with __getitems__ return whole batches already, the DataLoader only has to pass them on.
+    """
+    return batch
+
+
+class PromptCollate:
+    """
+    collate_fn that also builds the prompts of every batch in the DataLoader workers: the batch is collated
+    with collate (default_collate if None) and the prompt input_ids of its inputs, prompt_builder(batch_x),
+    are appended to it. prompt_builder can also map the groups of joint M4 batches to their builders, the
+    group of a batch is the {'group': pattern} it carries after its four tensors.
+    """
+
+    def __init__(self, prompt_builder, collate=None):
+        self.prompt_builder = prompt_builder
+        self.collate = collate
+
+    def __call__(self, batch):
+        batch = tuple((self.collate or default_collate)(batch))
+        prompt_builder = self.prompt_builder
+        if isinstance(prompt_builder, dict):
+            prompt_builder = prompt_builder[batch[4]['group']]
+        return batch + (prompt_builder(batch[0]),)
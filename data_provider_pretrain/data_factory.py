@@ -1,6 +1,10 @@
+import torch
 from torch.utils.data import DataLoader
 
 from data_provider_pretrain.data_loader import Dataset_ETT_hour, Dataset_ETT_minute
+from data_provider.data_factory import loader_collate, reads_timestamps
+from data_provider.samplers import WindowSampler
+from data_provider.windows import collate_batch
 
 data_dict = {
     'ETTh1': Dataset_ETT_hour,
@@ -37,12 +41,18 @@ def data_provider(args, data, data_path, pretrain=True, flag='train'):
         freq=freq,
         percent=percent,
         seasonal_patterns=args.seasonal_patterns,
-        pretrain=pretrain
+        pretrain=pretrain,
+        cache_dir=args.cache_dir,
+        shared_memory=args.shared_memory,
+        timestamps=reads_timestamps(args),
+        storage_dtype=args.storage_dtype
     )
     data_loader = DataLoader(
         data_set,
         batch_size=batch_size,
-        shuffle=shuffle_flag,
+        sampler=WindowSampler(data_set) if shuffle_flag else None,
         num_workers=args.num_workers,
-        drop_last=drop_last)
+        drop_last=drop_last,
+        pin_memory=torch.cuda.is_available(),
+        collate_fn=loader_collate(args, collate_batch if hasattr(data_set, '__getitems__') else None))
     return data_set, data_loader
@@ -1,8 +1,7 @@
 import os
-import pandas as pd
 from torch.utils.data import Dataset
-from sklearn.preprocessing import StandardScaler
-from utils.timefeatures import time_features
+from data_provider.data_store import load_table
+from data_provider.windows import decode, gather_windows
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -12,7 +11,8 @@ class Dataset_ETT_hour(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
                  target='OT', scale=True, timeenc=0, freq='h', percent=100,
-                 seasonal_patterns=None, pretrain=True):
+                 seasonal_patterns=None, pretrain=True, cache_dir=None, shared_memory=False,
+                 timestamps=True, storage_dtype='float64'):
         if size == None:
             self.seq_len = 24 * 4 * 4
             self.label_len = 24 * 4
@@ -37,16 +37,16 @@ class Dataset_ETT_hour(Dataset):
         # self.percent = percent
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_dir = cache_dir
+        self.shared_memory = shared_memory
+        self.timestamps = timestamps
+        self.storage_dtype = storage_dtype
         self.__read_data__()
 
         self.enc_in = self.data_x.shape[-1]
         self.tot_len = len(self.data_x) - self.seq_len - self.pred_len + 1
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-
         if self.pretrain:
             # border1s = [0, 12 * 30 * 24 + 4 * 30 * 24 - self.seq_len, 12 * 30 * 24 + 4 * 30 * 24 - self.seq_len]
             # border2s = [12 * 30 * 24 + 8 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24, 12 * 30 * 24 + 8 * 30 * 24]
@@ -62,34 +62,14 @@ class Dataset_ETT_hour(Dataset):
         if self.set_type == 0:
             border2 = (border2 - self.seq_len) * self.percent // 100 + self.seq_len
 
-        if self.features == 'M' or self.features == 'MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
-        elif self.features == 'S':
-            df_data = df_raw[[self.target]]
-
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        data, data_stamp, self.scaler, self.quant = load_table(
+            os.path.join(self.root_path, self.data_path), self.features, self.target, self.scale, self.timeenc,
+            self.freq, border2s[0], timestamps=self.timestamps, cache_dir=self.cache_dir,
+            shared_memory=self.shared_memory, storage_dtype=self.storage_dtype)
 
         self.data_x = data[border1:border2]
         self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+        self.data_stamp = data_stamp[border1:border2]
 
     def __getitem__(self, index):
         feat_id = index // self.tot_len
@@ -98,13 +78,17 @@ class Dataset_ETT_hour(Dataset):
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
         r_end = r_begin + self.label_len + self.pred_len
-        seq_x = self.data_x[s_begin:s_end, feat_id:feat_id + 1]
-        seq_y = self.data_y[r_begin:r_end, feat_id:feat_id + 1]
+        seq_x = decode(self.data_x[s_begin:s_end, feat_id:feat_id + 1], self.quant, feat_id)
+        seq_y = decode(self.data_y[r_begin:r_end, feat_id:feat_id + 1], self.quant, feat_id)
         seq_x_mark = self.data_stamp[s_begin:s_end]
         seq_y_mark = self.data_stamp[r_begin:r_end]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
+    def __getitems__(self, indices):
+        return gather_windows(self.data_x, self.data_y, self.data_stamp, indices, self.tot_len,
+                              self.seq_len, self.label_len, self.pred_len, self.quant)
+
     def __len__(self):
         return (len(self.data_x) - self.seq_len - self.pred_len + 1) * self.enc_in
 
@@ -116,7 +100,8 @@ class Dataset_ETT_minute(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTm1.csv',
                  target='OT', scale=True, timeenc=0, freq='t', percent=100,
-                 seasonal_patterns=None, pretrain=True):
+                 seasonal_patterns=None, pretrain=True, cache_dir=None, shared_memory=False,
+                 timestamps=True, storage_dtype='float64'):
         if size == None:
             self.seq_len = 24 * 4 * 4
             self.label_len = 24 * 4
@@ -140,16 +125,16 @@ class Dataset_ETT_minute(Dataset):
 
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_dir = cache_dir
+        self.shared_memory = shared_memory
+        self.timestamps = timestamps
+        self.storage_dtype = storage_dtype
         self.__read_data__()
 
         self.enc_in = self.data_x.shape[-1]
         self.tot_len = len(self.data_x) - self.seq_len - self.pred_len + 1
 
     def __read_data__(self):
-        self.scaler = StandardScaler()
-        df_raw = pd.read_csv(os.path.join(self.root_path,
-                                          self.data_path))
-
         if self.pretrain:
             # border1s = [0, 12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.seq_len,
             #             12 * 30 * 24 * 4 + 4 * 30 * 24 * 4 - self.seq_len]
@@ -169,36 +154,14 @@ class Dataset_ETT_minute(Dataset):
         if self.set_type == 0:
             border2 = (border2 - self.seq_len) * self.percent // 100 + self.seq_len
 
-        if self.features == 'M' or self.features == 'MS':
-            cols_data = df_raw.columns[1:]
-            df_data = df_raw[cols_data]
-        elif self.features == 'S':
-            df_data = df_raw[[self.target]]
-
-        if self.scale:
-            train_data = df_data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data.values)
-            data = self.scaler.transform(df_data.values)
-        else:
-            data = df_data.values
-
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        if self.timeenc == 0:
-            df_stamp['month'] = df_stamp.date.apply(lambda row: row.month, 1)
-            df_stamp['day'] = df_stamp.date.apply(lambda row: row.day, 1)
-            df_stamp['weekday'] = df_stamp.date.apply(lambda row: row.weekday(), 1)
-            df_stamp['hour'] = df_stamp.date.apply(lambda row: row.hour, 1)
-            df_stamp['minute'] = df_stamp.date.apply(lambda row: row.minute, 1)
-            df_stamp['minute'] = df_stamp.minute.map(lambda x: x // 15)
-            data_stamp = df_stamp.drop(['date'], 1).values
-        elif self.timeenc == 1:
-            data_stamp = time_features(pd.to_datetime(df_stamp['date'].values), freq=self.freq)
-            data_stamp = data_stamp.transpose(1, 0)
+        data, data_stamp, self.scaler, self.quant = load_table(
+            os.path.join(self.root_path, self.data_path), self.features, self.target, self.scale, self.timeenc,
+            self.freq, border2s[0], minute=True, timestamps=self.timestamps, cache_dir=self.cache_dir,
+            shared_memory=self.shared_memory, storage_dtype=self.storage_dtype)
 
         self.data_x = data[border1:border2]
         self.data_y = data[border1:border2]
-        self.data_stamp = data_stamp
+        self.data_stamp = data_stamp[border1:border2]
 
     def __getitem__(self, index):
         feat_id = index // self.tot_len
@@ -207,13 +170,17 @@ class Dataset_ETT_minute(Dataset):
         s_end = s_begin + self.seq_len
         r_begin = s_end - self.label_len
         r_end = r_begin + self.label_len + self.pred_len
-        seq_x = self.data_x[s_begin:s_end, feat_id:feat_id + 1]
-        seq_y = self.data_y[r_begin:r_end, feat_id:feat_id + 1]
+        seq_x = decode(self.data_x[s_begin:s_end, feat_id:feat_id + 1], self.quant, feat_id)
+        seq_y = decode(self.data_y[r_begin:r_end, feat_id:feat_id + 1], self.quant, feat_id)
         seq_x_mark = self.data_stamp[s_begin:s_end]
         seq_y_mark = self.data_stamp[r_begin:r_end]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
+    def __getitems__(self, indices):
+        return gather_windows(self.data_x, self.data_y, self.data_stamp, indices, self.tot_len,
+                              self.seq_len, self.label_len, self.pred_len, self.quant)
+
     def __len__(self):
         return (len(self.data_x) - self.seq_len - self.pred_len + 1) * self.enc_in
 
@@ -0,0 +1,96 @@
+import argparse
+import os
+
+from utils.cost_model import BACKBONES, DEFAULT_DESCRIPTION, count_prompt_tokens, estimate, worst_case_prompt
+
+parser = argparse.ArgumentParser(description='Time-LLM static cost estimator')
+
+# accepts the same command line as run_main.py, arguments that do not affect the cost are ignored
+parser.add_argument('--model', type=str, default='TimeLLM', help='model name, only TimeLLM is estimated')
+parser.add_argument('--data', type=str, default='ETTh1', help='dataset type')
+parser.add_argument('--seq_len', type=int, default=96, help='input sequence length')
+parser.add_argument('--label_len', type=int, default=48, help='start token length')
+parser.add_argument('--pred_len', type=int, default=96, help='prediction sequence length')
+parser.add_argument('--enc_in', type=int, default=7, help='encoder input size')
+parser.add_argument('--d_model', type=int, default=16, help='dimension of model')
+parser.add_argument('--n_heads', type=int, default=8, help='num of heads')
+parser.add_argument('--d_ff', type=int, default=32, help='dimension of fcn')
+parser.add_argument('--patch_len', type=int, default=16, help='patch length')
+parser.add_argument('--stride', type=int, default=8, help='stride')
+parser.add_argument('--prompt_domain', type=int, default=0, help='')
+parser.add_argument('--llm_model', type=str, default='GPT2', help='LLM model')  # LLAMA, GPT2, BERT
+parser.add_argument('--llm_dim', type=int, default='768', help='LLM model dimension')
+parser.add_argument('--llm_layers', type=int, default=6)
+parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
+
+# estimator options
+parser.add_argument('--precision', type=str, default='bf16', help='weight and activation dtype, options:[bf16, fp16, fp32]')
+parser.add_argument('--num_processes', type=int, default=1, help='data parallel processes sharing ZeRO-2 states')
+parser.add_argument('--memory_budget', type=float, default=0, help='per-device memory in GiB, 0 to skip the check')
+parser.add_argument('--use_tokenizer', action='store_true', help='count prompt tokens with the locally cached tokenizer',
+                    default=False)
+
+args, _ = parser.parse_known_args()
+
+if args.model != 'TimeLLM':
+    raise SystemExit('only TimeLLM runs are estimated, got --model {}'.format(args.model))
+if args.llm_model not in BACKBONES:
+    raise SystemExit('LLM model is not defined')
+
+if args.prompt_domain:
+    file = 'ETT' if 'ETT' in args.data else args.data
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset', 'prompt_bank', file + '.txt')) as f:
+        description = f.read()
+else:
+    description = DEFAULT_DESCRIPTION
+
+tokenizer = None
+if args.use_tokenizer:
+    from transformers import AutoTokenizer
+
+    source = {'LLAMA': 'huggyllama/llama-7b', 'GPT2': 'openai-community/gpt2',
+              'BERT': 'google-bert/bert-base-uncased'}[args.llm_model]
+    tokenizer = AutoTokenizer.from_pretrained(source, local_files_only=True)
+
+prompt_tokens, method = count_prompt_tokens(worst_case_prompt(args, description), tokenizer)
+report = estimate(args, prompt_tokens, dtype=args.precision, num_processes=args.num_processes)
+
+GiB = 2 ** 30
+
+
+def show(title, values, scale, unit):
+    print(title)
+    for name, value in values.items():
+        print('\t{:<22} {:>14.3f} {}'.format(name, value / scale, unit))
+    print('\t{:<22} {:>14.3f} {}'.format('total', sum(values.values()) / scale, unit))
+
+
+print('backbone: {} ({} layers, hidden {})'.format(args.llm_model, report['backbone_layers'],
+                                                  BACKBONES[args.llm_model]['hidden']))
+print('tokens per sample: {} = {} prompt ({}) + {} patches'.format(
+    report['tokens_per_sample'], report['prompt_tokens'], method, report['patch_nums']))
+print('series per step: {} = batch_size {} x enc_in {}'.format(args.batch_size * args.enc_in, args.batch_size,
+                                                                 args.enc_in))
+show('forward FLOPs per step', report['forward_flops'], 1e12, 'TFLOP')
+show('training FLOPs per step', report['train_flops'], 1e12, 'TFLOP')
+show('activation memory per step', report['activation_bytes'], GiB, 'GiB')
+show('trainable parameters', report['trainable_params'], 1e6, 'M')
+print('backbone parameters: {:.3f} M (frozen)'.format(report['backbone_params'] / 1e6))
+
+total = (report['weight_bytes'] + report['gradient_bytes'] + report['optimizer_bytes'] +
+         sum(report['activation_bytes'].values()))
+print('memory per device ({}, {} processes)'.format(args.precision, args.num_processes))
+print('\t{:<22} {:>14.3f} GiB'.format('weights', report['weight_bytes'] / GiB))
+print('\t{:<22} {:>14.3f} GiB'.format('gradients', report['gradient_bytes'] / GiB))
+print('\t{:<22} {:>14.3f} GiB'.format('optimizer states', report['optimizer_bytes'] / GiB))
+print('\t{:<22} {:>14.3f} GiB'.format('activations', sum(report['activation_bytes'].values()) / GiB))
+print('\t{:<22} {:>14.3f} GiB'.format('total', total / GiB))
+
+if args.memory_budget:
+    # the prototype projection does not scale with the batch
+    shared = report['activation_bytes']['mapping_layer']
+    fixed = report['weight_bytes'] + report['gradient_bytes'] + report['optimizer_bytes'] + shared
+    per_sample = (sum(report['activation_bytes'].values()) - shared) / args.batch_size
+    max_batch = int((args.memory_budget * GiB - fixed) // per_sample) if per_sample else 0
+    print('fits in {:.1f} GiB: {} (largest batch_size about {})'.format(
+        args.memory_budget, 'yes' if total <= args.memory_budget * GiB else 'no', max(max_batch, 0)))
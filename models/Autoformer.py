@@ -14,6 +14,7 @@ class Model(nn.Module):
     with inherent O(LlogL) complexity
     Paper link: https://openreview.net/pdf?id=I55UqU-M11y
     """
+    inputs = ('x_enc', 'x_mark_enc', 'x_dec', 'x_mark_dec')
 
     def __init__(self, configs):
         super(Model, self).__init__()
@@ -8,6 +8,7 @@ class Model(nn.Module):
     """
     Paper link: https://arxiv.org/pdf/2205.13504.pdf
     """
+    inputs = ('x_enc',)
 
     def __init__(self, configs, individual=False):
         """
@@ -1,3 +1,4 @@
+import functools
 from math import sqrt
 
 import torch
@@ -8,6 +9,7 @@ from transformers import LlamaConfig, LlamaModel, LlamaTokenizer, GPT2Config, GP
 from layers.Embed import PatchEmbedding
 import transformers
 from layers.StandardNorm import Normalize
+from data_provider.m4 import M4Meta, group_config
 
 transformers.logging.set_verbosity_error()
 
@@ -27,7 +29,149 @@ class FlattenHead(nn.Module):
         return x
 
 
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(llm_model):
+    """
+    The tokenizer of the LLM backbone, padding with its eos token. Cached, so that the model and the DataLoader
+    prompt stage (see PromptBuilder) share it.
+    """
+    if llm_model == 'LLAMA':
+        try:
+            tokenizer = LlamaTokenizer.from_pretrained(
+                # "/mnt/alps/modelhub/pretrained_model/LLaMA/7B_hf/tokenizer.model",
+                'huggyllama/llama-7b',
+                trust_remote_code=True,
+                local_files_only=True
+            )
+        except EnvironmentError:  # downloads the tokenizer from HF if not already done
+            print("Local tokenizer files not found. Atempting to download them..")
+            tokenizer = LlamaTokenizer.from_pretrained(
+                # "/mnt/alps/modelhub/pretrained_model/LLaMA/7B_hf/tokenizer.model",
+                'huggyllama/llama-7b',
+                trust_remote_code=True,
+                local_files_only=False
+            )
+    elif llm_model == 'GPT2':
+        try:
+            tokenizer = GPT2Tokenizer.from_pretrained(
+                'openai-community/gpt2',
+                trust_remote_code=True,
+                local_files_only=True
+            )
+        except EnvironmentError:  # downloads the tokenizer from HF if not already done
+            print("Local tokenizer files not found. Atempting to download them..")
+            tokenizer = GPT2Tokenizer.from_pretrained(
+                'openai-community/gpt2',
+                trust_remote_code=True,
+                local_files_only=False
+            )
+    elif llm_model == 'BERT':
+        try:
+            tokenizer = BertTokenizer.from_pretrained(
+                'google-bert/bert-base-uncased',
+                trust_remote_code=True,
+                local_files_only=True
+            )
+        except EnvironmentError:  # downloads the tokenizer from HF if not already done
+            print("Local tokenizer files not found. Atempting to download them..")
+            tokenizer = BertTokenizer.from_pretrained(
+                'google-bert/bert-base-uncased',
+                trust_remote_code=True,
+                local_files_only=False
+            )
+    else:
+        raise Exception('LLM model is not defined')
+
+    if tokenizer.eos_token:
+        tokenizer.pad_token = tokenizer.eos_token
+    else:
+        pad_token = '[PAD]'
+        tokenizer.add_special_tokens({'pad_token': pad_token})
+        tokenizer.pad_token = pad_token
+    return tokenizer
+
+
+def calcute_lags(x_enc, top_k):
+    q_fft = torch.fft.rfft(x_enc.permute(0, 2, 1).contiguous(), dim=-1)
+    k_fft = torch.fft.rfft(x_enc.permute(0, 2, 1).contiguous(), dim=-1)
+    res = q_fft * torch.conj(k_fft)
+    corr = torch.fft.irfft(res, dim=-1)
+    mean_value = torch.mean(corr, dim=1)
+    _, lags = torch.topk(mean_value, top_k, dim=-1)
+    return lags
+
+
+class PromptBuilder:
+    """
+    The prompts of TimeLLM: the dataset and task description and the statistics of every channel of the
+    normalized input. The model builds them in forecast(); with --prompt_in_loader the DataLoader workers build
+    them from the raw batches instead (see data_provider.windows.PromptCollate), so they are computed in parallel
+    and ahead of the training step.
+    """
+
+    def __init__(self, configs, tokenizer, top_k=5):
+        self.tokenizer = tokenizer
+        self.seq_len = configs.seq_len
+        self.pred_len = configs.pred_len
+        self.top_k = top_k
+        if configs.prompt_domain:
+            self.description = configs.content
+        else:
+            self.description = 'The Electricity Transformer Temperature (ETT) is a crucial indicator in the electric power long-term deployment.'
+
+    def prompts(self, x_enc, lags=None):
+        """
+        :param x_enc: normalized input (batch, length, channels)
+        :param lags: function returning the top lags of the (batch * channels, length, 1) series, calcute_lags by
+                     default; the model passes its own calcute_lags so that the module profiler times it
+        :return: the prompt of every (batch, channel), batch major
+        """
+        B, T, N = x_enc.size()
+        x_enc = x_enc.permute(0, 2, 1).contiguous().reshape(B * N, T, 1)
+
+        min_values = torch.min(x_enc, dim=1)[0]
+        max_values = torch.max(x_enc, dim=1)[0]
+        medians = torch.median(x_enc, dim=1).values
+        lags = calcute_lags(x_enc, self.top_k) if lags is None else lags(x_enc)
+        trends = x_enc.diff(dim=1).sum(dim=1)
+
+        prompt = []
+        for b in range(x_enc.shape[0]):
+            min_values_str = str(min_values[b].tolist()[0])
+            max_values_str = str(max_values[b].tolist()[0])
+            median_values_str = str(medians[b].tolist()[0])
+            lags_values_str = str(lags[b].tolist())
+            prompt_ = (
+                f"<|start_prompt|>Dataset description: {self.description}"
+                f"Task description: forecast the next {str(self.pred_len)} steps given the previous {str(self.seq_len)} steps information; "
+                "Input statistics: "
+                f"min value {min_values_str}, "
+                f"max value {max_values_str}, "
+                f"median value {median_values_str}, "
+                f"the trend of input is {'upward' if trends[b] > 0 else 'downward'}, "
+                f"top 5 lags are : {lags_values_str}<|<end_prompt>|>"
+            )
+
+            prompt.append(prompt_)
+        return prompt
+
+    def tokenize(self, prompts):
+        return self.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True, max_length=2048).input_ids
+
+    def __call__(self, x_enc):
+        """
+        input_ids of the prompts of a raw input batch, normalized as Normalize(affine=False) does in the model.
+        """
+        x_enc = x_enc.float()
+        mean = torch.mean(x_enc, dim=1, keepdim=True)
+        stdev = torch.sqrt(torch.var(x_enc, dim=1, keepdim=True, unbiased=False) + 1e-5)
+        return self.tokenize(self.prompts((x_enc - mean) / stdev))
+
+
 class Model(nn.Module):
+    # forecast only reads x_enc (and the prompts if the loaders build them, and the seasonal pattern of joint M4
+    # batches), the loaders and training loops skip the marks and the decoder input
+    inputs = ('x_enc', 'prompt', 'group')
 
     def __init__(self, configs, patch_len=16, stride=8):
         super(Model, self).__init__()
@@ -65,21 +209,6 @@ class Model(nn.Module):
                     config=self.llama_config,
                     # load_in_4bit=True
                 )
-            try:
-                self.tokenizer = LlamaTokenizer.from_pretrained(
-                    # "/mnt/alps/modelhub/pretrained_model/LLaMA/7B_hf/tokenizer.model",
-                    'huggyllama/llama-7b',
-                    trust_remote_code=True,
-                    local_files_only=True
-                )
-            except EnvironmentError:  # downloads the tokenizer from HF if not already done
-                print("Local tokenizer files not found. Atempting to download them..")
-                self.tokenizer = LlamaTokenizer.from_pretrained(
-                    # "/mnt/alps/modelhub/pretrained_model/LLaMA/7B_hf/tokenizer.model",
-                    'huggyllama/llama-7b',
-                    trust_remote_code=True,
-                    local_files_only=False
-                )
         elif configs.llm_model == 'GPT2':
             self.gpt2_config = GPT2Config.from_pretrained('openai-community/gpt2')
 
@@ -103,20 +232,6 @@ class Model(nn.Module):
                     local_files_only=False,
                     config=self.gpt2_config,
                 )
-
-            try:
-                self.tokenizer = GPT2Tokenizer.from_pretrained(
-                    'openai-community/gpt2',
-                    trust_remote_code=True,
-                    local_files_only=True
-                )
-            except EnvironmentError:  # downloads the tokenizer from HF if not already done
-                print("Local tokenizer files not found. Atempting to download them..")
-                self.tokenizer = GPT2Tokenizer.from_pretrained(
-                    'openai-community/gpt2',
-                    trust_remote_code=True,
-                    local_files_only=False
-                )
         elif configs.llm_model == 'BERT':
             self.bert_config = BertConfig.from_pretrained('google-bert/bert-base-uncased')
 
@@ -138,37 +253,16 @@ class Model(nn.Module):
                     local_files_only=False,
                     config=self.bert_config,
                 )
-
-            try:
-                self.tokenizer = BertTokenizer.from_pretrained(
-                    'google-bert/bert-base-uncased',
-                    trust_remote_code=True,
-                    local_files_only=True
-                )
-            except EnvironmentError:  # downloads the tokenizer from HF if not already done
-                print("Local tokenizer files not found. Atempting to download them..")
-                self.tokenizer = BertTokenizer.from_pretrained(
-                    'google-bert/bert-base-uncased',
-                    trust_remote_code=True,
-                    local_files_only=False
-                )
         else:
             raise Exception('LLM model is not defined')
 
-        if self.tokenizer.eos_token:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        else:
-            pad_token = '[PAD]'
-            self.tokenizer.add_special_tokens({'pad_token': pad_token})
-            self.tokenizer.pad_token = pad_token
+        self.tokenizer = load_tokenizer(configs.llm_model)
 
         for param in self.llm_model.parameters():
             param.requires_grad = False
 
-        if configs.prompt_domain:
-            self.description = configs.content
-        else:
-            self.description = 'The Electricity Transformer Temperature (ETT) is a crucial indicator in the electric power long-term deployment.'
+        self.prompt_builder = PromptBuilder(configs, self.tokenizer, self.top_k)
+        self.description = self.prompt_builder.description
 
         self.dropout = nn.Dropout(configs.dropout)
 
@@ -185,7 +279,19 @@ class Model(nn.Module):
         self.patch_nums = int((configs.seq_len - self.patch_len) / self.stride + 2)
         self.head_nf = self.d_ff * self.patch_nums
 
-        if self.task_name == 'long_term_forecast' or self.task_name == 'short_term_forecast':
+        # joint M4 training (--seasonal_patterns All): one head and prompt per seasonal pattern, the forward pass
+        # uses those of the group of its batch
+        self.groups = {}
+        if self.task_name == 'short_term_forecast' and getattr(configs, 'seasonal_patterns', None) == 'All':
+            self.output_projections = nn.ModuleDict()
+            for group in M4Meta.seasonal_patterns:
+                group_configs = group_config(configs, group)
+                patch_nums = int((group_configs.seq_len - self.patch_len) / self.stride + 2)
+                self.output_projections[group] = FlattenHead(configs.enc_in, self.d_ff * patch_nums,
+                                                             group_configs.pred_len, head_dropout=configs.dropout)
+                self.groups[group] = (group_configs.pred_len, patch_nums,
+                                      PromptBuilder(group_configs, self.tokenizer, self.top_k))
+        elif self.task_name == 'long_term_forecast' or self.task_name == 'short_term_forecast':
             self.output_projection = FlattenHead(configs.enc_in, self.head_nf, self.pred_len,
                                                  head_dropout=configs.dropout)
         else:
@@ -193,47 +299,32 @@ class Model(nn.Module):
 
         self.normalize_layers = Normalize(configs.enc_in, affine=False)
 
-    def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec, mask=None):
+    def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec, mask=None, prompt=None, group=None):
         if self.task_name == 'long_term_forecast' or self.task_name == 'short_term_forecast':
-            dec_out = self.forecast(x_enc, x_mark_enc, x_dec, x_mark_dec)
-            return dec_out[:, -self.pred_len:, :]
+            dec_out = self.forecast(x_enc, x_mark_enc, x_dec, x_mark_dec, prompt, group)
+            pred_len = self.pred_len if group is None else self.groups[group][0]
+            return dec_out[:, -pred_len:, :]
         return None
 
-    def forecast(self, x_enc, x_mark_enc, x_dec, x_mark_dec):
+    def forecast(self, x_enc, x_mark_enc, x_dec, x_mark_dec, prompt=None, group=None):
+        """
+        :param prompt: input_ids of the prompts of x_enc tokenized by the DataLoader (see PromptBuilder.tokenize),
+                       built here if None
+        :param group: seasonal pattern of the batch in joint M4 training, selects its head and prompt
+        """
+        patch_nums, prompt_builder = self.patch_nums, self.prompt_builder
+        if group is not None:
+            _, patch_nums, prompt_builder = self.groups[group]
+            output_projection = self.output_projections[group]
+        else:
+            output_projection = self.output_projection
 
         x_enc = self.normalize_layers(x_enc, 'norm')
 
         B, T, N = x_enc.size()
-        x_enc = x_enc.permute(0, 2, 1).contiguous().reshape(B * N, T, 1)
-
-        min_values = torch.min(x_enc, dim=1)[0]
-        max_values = torch.max(x_enc, dim=1)[0]
-        medians = torch.median(x_enc, dim=1).values
-        lags = self.calcute_lags(x_enc)
-        trends = x_enc.diff(dim=1).sum(dim=1)
-
-        prompt = []
-        for b in range(x_enc.shape[0]):
-            min_values_str = str(min_values[b].tolist()[0])
-            max_values_str = str(max_values[b].tolist()[0])
-            median_values_str = str(medians[b].tolist()[0])
-            lags_values_str = str(lags[b].tolist())
-            prompt_ = (
-                f"<|start_prompt|>Dataset description: {self.description}"
-                f"Task description: forecast the next {str(self.pred_len)} steps given the previous {str(self.seq_len)} steps information; "
-                "Input statistics: "
-                f"min value {min_values_str}, "
-                f"max value {max_values_str}, "
-                f"median value {median_values_str}, "
-                f"the trend of input is {'upward' if trends[b] > 0 else 'downward'}, "
-                f"top 5 lags are : {lags_values_str}<|<end_prompt>|>"
-            )
-
-            prompt.append(prompt_)
-
-        x_enc = x_enc.reshape(B, N, T).permute(0, 2, 1).contiguous()
+        if prompt is None:
+            prompt = prompt_builder.tokenize(prompt_builder.prompts(x_enc, self.calcute_lags))
 
-        prompt = self.tokenizer(prompt, return_tensors="pt", padding=True, truncation=True, max_length=2048).input_ids
         prompt_embeddings = self.llm_model.get_input_embeddings()(prompt.to(x_enc.device))  # (batch, prompt_token, dim)
 
         source_embeddings = self.mapping_layer(self.word_embeddings.permute(1, 0)).permute(1, 0)
@@ -242,6 +333,7 @@ class Model(nn.Module):
         enc_out, n_vars = self.patch_embedding(x_enc.to(torch.bfloat16))
         enc_out = self.reprogramming_layer(enc_out, source_embeddings, source_embeddings)
         llama_enc_out = torch.cat([prompt_embeddings, enc_out], dim=1)
+        self.backbone_tokens = llama_enc_out.shape[0] * llama_enc_out.shape[1]
         dec_out = self.llm_model(inputs_embeds=llama_enc_out).last_hidden_state
         dec_out = dec_out[:, :, :self.d_ff]
 
@@ -249,7 +341,7 @@ class Model(nn.Module):
             dec_out, (-1, n_vars, dec_out.shape[-2], dec_out.shape[-1]))
         dec_out = dec_out.permute(0, 1, 3, 2).contiguous()
 
-        dec_out = self.output_projection(dec_out[:, :, :, -self.patch_nums:])
+        dec_out = output_projection(dec_out[:, :, :, -patch_nums:])
         dec_out = dec_out.permute(0, 2, 1).contiguous()
 
         dec_out = self.normalize_layers(dec_out, 'denorm')
@@ -257,13 +349,7 @@ class Model(nn.Module):
         return dec_out
 
     def calcute_lags(self, x_enc):
-        q_fft = torch.fft.rfft(x_enc.permute(0, 2, 1).contiguous(), dim=-1)
-        k_fft = torch.fft.rfft(x_enc.permute(0, 2, 1).contiguous(), dim=-1)
-        res = q_fft * torch.conj(k_fft)
-        corr = torch.fft.irfft(res, dim=-1)
-        mean_value = torch.mean(corr, dim=1)
-        _, lags = torch.topk(mean_value, self.top_k, dim=-1)
-        return lags
+        return calcute_lags(x_enc, self.top_k)
 
 
 class ReprogrammingLayer(nn.Module):
@@ -5,10 +5,11 @@ from accelerate import DistributedDataParallelKwargs
 from torch import optim
 from torch.optim import lr_scheduler
 
-from data_provider.m4 import M4Meta
+from data_provider.m4 import M4Meta, group_config
 from models import Autoformer, DLinear, TimeLLM
 
 from data_provider.data_factory import data_provider
+from data_provider.prefetch import BatchPrefetcher
 import time
 import random
 import numpy as np
@@ -21,7 +22,11 @@ import os
 os.environ['CURL_CA_BUNDLE'] = ''
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:64"
 
-from utils.tools import del_files, EarlyStopping, adjust_learning_rate, load_content, test
+from utils.tools import del_files, EarlyStopping, adjust_learning_rate, load_content, test, prepare_m4_batch, \
+    m4_forecast, m4_groups
+from utils.checkpoint import load_checkpoint
+from utils.profiling import StepTimer, ModuleProfiler
+from utils.prometheus import MetricsExporter
 
 parser = argparse.ArgumentParser(description='Time-LLM')
 
@@ -60,7 +65,8 @@ parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='l
 parser.add_argument('--seq_len', type=int, default=96, help='input sequence length')
 parser.add_argument('--label_len', type=int, default=48, help='start token length')
 parser.add_argument('--pred_len', type=int, default=96, help='prediction sequence length')
-parser.add_argument('--seasonal_patterns', type=str, default='Monthly', help='subset for M4')
+parser.add_argument('--seasonal_patterns', type=str, default='Monthly',
+                    help='subset for M4, All to train the six subsets jointly with one head each')
 
 # model define
 parser.add_argument('--enc_in', type=int, default=7, help='encoder input size')
@@ -86,12 +92,21 @@ parser.add_argument('--llm_dim', type=int, default='4096', help='LLM model dimen
 
 # optimization
 parser.add_argument('--num_workers', type=int, default=10, help='data loader num workers')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='training batches prepared ahead on a background thread, 0 to prepare them in the loop')
+parser.add_argument('--prompt_in_loader', action='store_true', default=False,
+                    help='build and tokenize the prompts in the data loader workers instead of the forward pass')
+parser.add_argument('--block_shuffle', type=int, default=0,
+                    help='shuffle blocks of this many consecutive windows for out-of-core data, 0 for a full shuffle')
 parser.add_argument('--itr', type=int, default=1, help='experiments times')
 parser.add_argument('--train_epochs', type=int, default=10, help='train epochs')
 parser.add_argument('--align_epochs', type=int, default=10, help='alignment epochs')
 parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
 parser.add_argument('--eval_batch_size', type=int, default=8, help='batch size of model evaluation')
 parser.add_argument('--patience', type=int, default=20, help='early stopping patience')
+parser.add_argument('--keep_checkpoints', type=int, default=1, help='number of best checkpoints kept on disk')
+parser.add_argument('--sync_checkpoint', action='store_true', help='write checkpoints on the training thread',
+                    default=False)
 parser.add_argument('--learning_rate', type=float, default=0.0001, help='optimizer learning rate')
 parser.add_argument('--des', type=str, default='test', help='exp description')
 parser.add_argument('--loss', type=str, default='MSE', help='loss function')
@@ -101,11 +116,43 @@ parser.add_argument('--use_amp', action='store_true', help='use automatic mixed
 parser.add_argument('--llm_layers', type=int, default=6)
 parser.add_argument('--percent', type=int, default=100)
 
+# profiling
+parser.add_argument('--step_timer', action='store_true', help='record per-phase step timings and export a Chrome trace',
+                    default=False)
+parser.add_argument('--trace_dir', type=str, default='./traces/', help='location of profiling outputs')
+parser.add_argument('--profile_modules', action='store_true', help='time every submodule and dump a cost table per epoch',
+                    default=False)
+parser.add_argument('--profile_backward', action='store_true', help='also time backward passes of every submodule',
+                    default=False)
+parser.add_argument('--metrics_file', type=str, default='', help='write Prometheus text-format metrics to this file')
+parser.add_argument('--metrics_port', type=int, default=0, help='serve Prometheus metrics on this local port')
+
 args = parser.parse_args()
 ddp_kwargs = DistributedDataParallelKwargs(find_unused_parameters=True)
 deepspeed_plugin = DeepSpeedPlugin(hf_ds_config='./ds_config_zero2.json')
 accelerator = Accelerator(kwargs_handlers=[ddp_kwargs], deepspeed_plugin=deepspeed_plugin)
 
+metrics = None
+if args.metrics_file or args.metrics_port:
+    metrics_file = args.metrics_file or None
+    if metrics_file and accelerator.num_processes > 1:
+        metrics_file = '{}_rank{}{}'.format(os.path.splitext(metrics_file)[0], accelerator.process_index,
+                                            os.path.splitext(metrics_file)[1])
+    metrics = MetricsExporter(path=metrics_file,
+                              port=args.metrics_port + accelerator.local_process_index if args.metrics_port else 0,
+                              labels={'rank': accelerator.process_index})
+
+# inputs read by the model, the data providers and training loops skip the others
+args.model_inputs = {'Autoformer': Autoformer, 'DLinear': DLinear}.get(args.model, TimeLLM).Model.inputs
+# joint M4 batches are drawn in runs of one per process, see GroupBatchSampler
+args.num_processes = accelerator.num_processes
+if args.seasonal_patterns == 'All' and 'group' not in args.model_inputs:
+    raise ValueError('joint training of the M4 seasonal patterns (--seasonal_patterns All) needs per-pattern '
+                     'heads, which {} does not have'.format(args.model))
+if args.seasonal_patterns == 'All' and accelerator.state.deepspeed_plugin is not None:
+    # the joint loader has a batch sampler and no batch_size for DeepSpeed to read its micro batch size from
+    accelerator.state.deepspeed_plugin.deepspeed_config['train_micro_batch_size_per_gpu'] = args.batch_size
+
 for ii in range(args.itr):
     # setting record of experiments
     setting = '{}_{}_{}_{}_ft{}_sl{}_ll{}_pl{}_dm{}_nh{}_el{}_dl{}_df{}_fc{}_eb{}_{}_{}'.format(
@@ -127,12 +174,19 @@ for ii in range(args.itr):
         args.des, ii)
 
     if args.data == 'm4':
-        args.pred_len = M4Meta.horizons_map[args.seasonal_patterns]  # Up to M4 config
+        # joint training (--seasonal_patterns All) uses the lengths of the pattern of every batch (group_config),
+        # these are those of the longest horizon
+        seasonal_patterns = 'Hourly' if args.seasonal_patterns == 'All' else args.seasonal_patterns
+        args.pred_len = M4Meta.horizons_map[seasonal_patterns]  # Up to M4 config
         args.seq_len = 2 * args.pred_len
         args.label_len = args.pred_len
-        args.frequency_map = M4Meta.frequency_map[args.seasonal_patterns]
+        args.frequency_map = M4Meta.frequency_map[seasonal_patterns]
 
+    # the dataset description of the prompts, built by the loaders with --prompt_in_loader
+    args.content = load_content(args)
     train_data, train_loader = data_provider(args, 'train')
+    train_sampler = train_loader.batch_sampler if args.seasonal_patterns == 'All' else train_loader.sampler
+    group_args = {group: group_config(args, group) for group in M4Meta.seasonal_patterns}
     vali_data, vali_loader = data_provider(args, 'val')
     test_data, test_loader = data_provider(args, 'test')
 
@@ -143,16 +197,18 @@ for ii in range(args.itr):
     else:
         model = TimeLLM.Model(args).float()
 
+    module_profiler = ModuleProfiler(model, backward=args.profile_backward) if args.profile_modules else None
+
     path = os.path.join(args.checkpoints,
                         setting + '-' + args.model_comment)  # unique checkpoint saving path
-    args.content = load_content(args)
     if not os.path.exists(path) and accelerator.is_local_main_process:
         os.makedirs(path)
 
     time_now = time.time()
 
     train_steps = len(train_loader)
-    early_stopping = EarlyStopping(accelerator=accelerator, patience=args.patience, verbose=True)
+    early_stopping = EarlyStopping(accelerator=accelerator, patience=args.patience, verbose=True,
+                                   async_save=not args.sync_checkpoint, keep_checkpoints=args.keep_checkpoints)
 
     model_optim = optim.Adam(model.parameters(), lr=args.learning_rate)
 
@@ -170,36 +226,42 @@ for ii in range(args.itr):
     train_loader, vali_loader, model, model_optim, scheduler = accelerator.prepare(
         train_loader, vali_loader, model, model_optim, scheduler)
 
+    step_timer = StepTimer(enabled=args.step_timer, pid=accelerator.process_index)
+
     for epoch in range(args.train_epochs):
+        # accelerate only forwards the epoch to the sampler when it does not shard the batches itself
+        train_loader.set_epoch(epoch)
+        train_sampler.set_epoch(epoch)
         iter_count = 0
         train_loss = []
 
         model.train()
         epoch_time = time.time()
-
-        for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(train_loader):
+        if module_profiler is not None:
+            module_profiler.reset()
+
+        # the next batches are moved to the device with their decoder input while the current step runs
+        train_batches = BatchPrefetcher(train_loader, lambda batch: prepare_m4_batch(args, batch, accelerator.device),
+                                        args.prefetch, timer=step_timer)
+        train_iter = train_batches if metrics is None else metrics.iterate(train_batches)
+        step_end = time.time()
+        for i, (batch_x, batch_y, batch_y_mark, dec_inp, kwargs) in enumerate(step_timer.iterate(train_iter)):
             iter_count += 1
             model_optim.zero_grad()
-            batch_x = batch_x.float().to(accelerator.device)
-
-            batch_y = batch_y.float().to(accelerator.device)
-            batch_y_mark = batch_y_mark.float().to(accelerator.device)
 
-            # decoder input
-            dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :]).float().to(accelerator.device)
-            dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1).float().to(
-                accelerator.device)
+            with step_timer.phase('forward'):
+                outputs = model(batch_x, None, dec_inp, None, **kwargs)
 
-            outputs = model(batch_x, None, dec_inp, None)
-
-            f_dim = -1 if args.features == 'MS' else 0
-            outputs = outputs[:, -args.pred_len:, f_dim:]
-            batch_y = batch_y[:, -args.pred_len:, f_dim:]
+            with step_timer.phase('loss'):
+                batch_args = group_args[kwargs['group']] if 'group' in kwargs else args
+                f_dim = -1 if args.features == 'MS' else 0
+                outputs = outputs[:, -batch_args.pred_len:, f_dim:]
+                batch_y = batch_y[:, -batch_args.pred_len:, f_dim:]
 
-            batch_y_mark = batch_y_mark[:, -args.pred_len:, f_dim:]
-            loss = criterion(batch_x, args.frequency_map, outputs, batch_y, batch_y_mark)
+                batch_y_mark = batch_y_mark[:, -batch_args.pred_len:, f_dim:]
+                loss = criterion(batch_x, batch_args.frequency_map, outputs, batch_y, batch_y_mark)
 
-            train_loss.append(loss.item())
+                train_loss.append(loss.item())
 
             if (i + 1) % 100 == 0:
                 accelerator.print(
@@ -208,24 +270,50 @@ for ii in range(args.itr):
                 speed = (time.time() - time_now) / iter_count
                 left_time = speed * ((args.train_epochs - epoch) * train_steps - i)
                 accelerator.print('\tspeed: {:.4f}s/iter; left time: {:.4f}s'.format(speed, left_time))
+                if args.step_timer:
+                    accelerator.print('\t' + step_timer.summary())
                 iter_count = 0
                 time_now = time.time()
 
-            accelerator.backward(loss)
-            model_optim.step()
+            with step_timer.phase('backward'):
+                accelerator.backward(loss)
+            with step_timer.phase('optim'):
+                model_optim.step()
 
             if args.lradj == 'TST':
-                adjust_learning_rate(accelerator, model_optim, scheduler, epoch + 1, args, printout=False)
-                scheduler.step()
+                with step_timer.phase('sched'):
+                    adjust_learning_rate(accelerator, model_optim, scheduler, epoch + 1, args, printout=False)
+                    scheduler.step()
+
+            step_timer.end_step()
+            if metrics is not None:
+                metrics.record_step(time.time() - step_end, batch_x.shape[0],
+                                    getattr(accelerator.unwrap_model(model), 'backbone_tokens', 0),
+                                    model_optim.param_groups[0]['lr'])
+                step_end = time.time()
 
         accelerator.print("Epoch: {} cost time: {}".format(epoch + 1, time.time() - epoch_time))
+        if args.step_timer:
+            accelerator.print(step_timer.summary())
+            step_timer.export_chrome_trace(os.path.join(
+                args.trace_dir, setting + '-' + args.model_comment, 'steps_rank{}.json'.format(accelerator.process_index)))
+        if module_profiler is not None:
+            accelerator.print(module_profiler.table())
+            module_profiler.dump_csv(os.path.join(
+                args.trace_dir, setting + '-' + args.model_comment,
+                'modules_rank{}_epoch{}.csv'.format(accelerator.process_index, epoch + 1)))
         train_loss = np.average(train_loss)
-        vali_loss = test(args, accelerator, model, train_loader, vali_loader, criterion)
+        vali_loss = test(args, accelerator, model, train_loader, vali_loader, criterion, metrics)
         test_loss = vali_loss
         accelerator.print(
             "Epoch: {0}, Steps: {1} | Train Loss: {2:.7f} Vali Loss: {3:.7f} Test Loss: {4:.7f}".format(
                 epoch + 1, train_steps, train_loss, vali_loss, test_loss))
         early_stopping(vali_loss, model, path)  # model saving
+        if metrics is not None:
+            metrics.set('epoch', epoch + 1)
+            metrics.set('train_loss', train_loss)
+            metrics.set('vali_loss', vali_loss)
+            metrics.record_early_stopping(early_stopping)
         if early_stopping.early_stop:
             accelerator.print("Early stopping")
             break
@@ -236,55 +324,40 @@ for ii in range(args.itr):
             accelerator.print('Updating learning rate to {}'.format(scheduler.get_last_lr()[0]))
 
     best_model_path = path + '/' + 'checkpoint'
+    early_stopping.close()
     accelerator.wait_for_everyone()
     unwrapped_model = accelerator.unwrap_model(model)
     torch.cuda.synchronize()
     torch.cuda.empty_cache()
-    unwrapped_model.load_state_dict(torch.load(best_model_path, map_location=lambda storage, loc: storage))
-
-    x, _ = train_loader.dataset.last_insample_window()
-    y = test_loader.dataset.timeseries
-    x = torch.tensor(x, dtype=torch.float32).to(accelerator.device)
-    x = x.unsqueeze(-1)
+    load_checkpoint(unwrapped_model, best_model_path, map_location=lambda storage, loc: storage)
 
     model.eval()
 
-    with torch.no_grad():
-        B, _, C = x.shape
-        dec_inp = torch.zeros((B, args.pred_len, C)).float().to(accelerator.device)
-        dec_inp = torch.cat([x[:, -args.label_len:, :], dec_inp], dim=1)
-        outputs = torch.zeros((B, args.pred_len, C)).float().to(accelerator.device)
-        id_list = np.arange(0, B, args.eval_batch_size)
-        id_list = np.append(id_list, B)
-        for i in range(len(id_list) - 1):
-            outputs[id_list[i]:id_list[i + 1], :, :] = model(
-                x[id_list[i]:id_list[i + 1]],
-                None,
-                dec_inp[id_list[i]:id_list[i + 1]],
-                None
-            )
-        accelerator.wait_for_everyone()
-        f_dim = -1 if args.features == 'MS' else 0
-        outputs = outputs[:, -args.pred_len:, f_dim:]
-        outputs = outputs.detach().cpu().numpy()
-
-        preds = outputs
-        trues = y
-        x = x.detach().cpu().numpy()
-
-    accelerator.print('test shape:', preds.shape)
-
     folder_path = './m4_results/' + args.model + '-' + args.model_comment + '/'
     if not os.path.exists(folder_path) and accelerator.is_local_main_process:
         os.makedirs(folder_path)
 
-    if accelerator.is_local_main_process:
-        forecasts_df = pandas.DataFrame(preds[:, :, 0], columns=[f'V{i + 1}' for i in range(args.pred_len)])
-        forecasts_df.index = test_loader.dataset.ids[:preds.shape[0]]
-        forecasts_df.index.name = 'id'
-        forecasts_df.set_index(forecasts_df.columns[0], inplace=True)
-        forecasts_df.to_csv(folder_path + args.seasonal_patterns + '_forecast.csv')
+    for seasonal_patterns, test_args, train_set, test_set, kwargs in m4_groups(args, train_loader.dataset,
+                                                                               test_loader.dataset):
+        x, _ = train_set.last_insample_window()
+        x = torch.tensor(x, dtype=torch.float32).unsqueeze(-1)
+
+        with torch.no_grad():
+            outputs = m4_forecast(test_args, accelerator, model, x, metrics, **kwargs)
+            f_dim = -1 if args.features == 'MS' else 0
+            outputs = outputs[:, -test_args.pred_len:, f_dim:]
+            preds = outputs.detach().cpu().numpy()
+
+        accelerator.print('test shape:', preds.shape)
+
+        if accelerator.is_local_main_process:
+            forecasts_df = pandas.DataFrame(preds[:, :, 0], columns=[f'V{i + 1}' for i in range(test_args.pred_len)])
+            forecasts_df.index = test_set.ids[:preds.shape[0]]
+            forecasts_df.index.name = 'id'
+            forecasts_df.set_index(forecasts_df.columns[0], inplace=True)
+            forecasts_df.to_csv(folder_path + seasonal_patterns + '_forecast.csv')
 
+    if accelerator.is_local_main_process:
         # calculate metrics
         accelerator.print(args.model)
         file_path = folder_path
@@ -304,6 +377,9 @@ for ii in range(args.itr):
         else:
             accelerator.print('After all 6 tasks are finished, you can calculate the averaged performance')
 
+if metrics is not None:
+    metrics.close()
+
 accelerator.wait_for_everyone()
 if accelerator.is_local_main_process:
     path = './checkpoints'  # unique checkpoint saving path
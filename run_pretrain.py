@@ -6,6 +6,8 @@ from torch import nn, optim
 from torch.optim import lr_scheduler
 
 from data_provider_pretrain.data_factory import data_provider
+from data_provider.data_store import unlink_shared
+from data_provider.prefetch import BatchPrefetcher
 from models import Autoformer, DLinear, TimeLLM
 
 import time
@@ -16,7 +18,9 @@ import os
 os.environ['CURL_CA_BUNDLE'] = ''
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:64"
 
-from utils.tools import del_files, EarlyStopping, adjust_learning_rate, vali, load_content
+from utils.tools import del_files, EarlyStopping, adjust_learning_rate, vali, load_content, prepare_batch
+from utils.profiling import StepTimer, ModuleProfiler
+from utils.prometheus import MetricsExporter
 
 parser = argparse.ArgumentParser(description='Time-LLM')
 
@@ -52,6 +56,16 @@ parser.add_argument('--freq', type=str, default='h',
                          'options:[s:secondly, t:minutely, h:hourly, d:daily, b:business days, w:weekly, m:monthly], '
                          'you can also use more detailed freq like 15min or 3h')
 parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='location of model checkpoints')
+parser.add_argument('--cache_dir', type=str, default='./cache/',
+                    help='location of preprocessed dataset arrays, empty to always parse the csv')
+parser.add_argument('--shared_memory', action='store_true', default=False,
+                    help='keep dataset arrays in POSIX shared memory shared by all processes of the host')
+parser.add_argument('--unlink_shared', action='store_true', default=False,
+                    help='remove the shared memory segments of the host at the end of the run, '
+                         'they are kept for the next jobs otherwise')
+parser.add_argument('--storage_dtype', type=str, default='float32',
+                    help='dtype the dataset values are kept in, options:[float64, float32, float16, bfloat16, int16], '
+                         'int16 is quantised per channel')
 
 # forecasting task
 parser.add_argument('--seq_len', type=int, default=96, help='input sequence length')
@@ -83,12 +97,21 @@ parser.add_argument('--llm_dim', type=int, default='4096', help='LLM model dimen
 
 # optimization
 parser.add_argument('--num_workers', type=int, default=10, help='data loader num workers')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='training batches prepared ahead on a background thread, 0 to prepare them in the loop')
+parser.add_argument('--prompt_in_loader', action='store_true', default=False,
+                    help='build and tokenize the prompts in the data loader workers instead of the forward pass')
+parser.add_argument('--block_shuffle', type=int, default=0,
+                    help='shuffle blocks of this many consecutive windows for out-of-core data, 0 for a full shuffle')
 parser.add_argument('--itr', type=int, default=1, help='experiments times')
 parser.add_argument('--train_epochs', type=int, default=10, help='train epochs')
 parser.add_argument('--align_epochs', type=int, default=10, help='alignment epochs')
 parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
 parser.add_argument('--eval_batch_size', type=int, default=8, help='batch size of model evaluation')
 parser.add_argument('--patience', type=int, default=5, help='early stopping patience')
+parser.add_argument('--keep_checkpoints', type=int, default=1, help='number of best checkpoints kept on disk')
+parser.add_argument('--sync_checkpoint', action='store_true', help='write checkpoints on the training thread',
+                    default=False)
 parser.add_argument('--learning_rate', type=float, default=0.0001, help='optimizer learning rate')
 parser.add_argument('--des', type=str, default='test', help='exp description')
 parser.add_argument('--loss', type=str, default='MSE', help='loss function')
@@ -98,11 +121,35 @@ parser.add_argument('--use_amp', action='store_true', help='use automatic mixed
 parser.add_argument('--llm_layers', type=int, default=6)
 parser.add_argument('--percent', type=int, default=100)
 
+# profiling
+parser.add_argument('--step_timer', action='store_true', help='record per-phase step timings and export a Chrome trace',
+                    default=False)
+parser.add_argument('--trace_dir', type=str, default='./traces/', help='location of profiling outputs')
+parser.add_argument('--profile_modules', action='store_true', help='time every submodule and dump a cost table per epoch',
+                    default=False)
+parser.add_argument('--profile_backward', action='store_true', help='also time backward passes of every submodule',
+                    default=False)
+parser.add_argument('--metrics_file', type=str, default='', help='write Prometheus text-format metrics to this file')
+parser.add_argument('--metrics_port', type=int, default=0, help='serve Prometheus metrics on this local port')
+
 args = parser.parse_args()
 ddp_kwargs = DistributedDataParallelKwargs(find_unused_parameters=True)
 deepspeed_plugin = DeepSpeedPlugin(hf_ds_config='./ds_config_zero2.json')
 accelerator = Accelerator(kwargs_handlers=[ddp_kwargs], deepspeed_plugin=deepspeed_plugin)
 
+metrics = None
+if args.metrics_file or args.metrics_port:
+    metrics_file = args.metrics_file or None
+    if metrics_file and accelerator.num_processes > 1:
+        metrics_file = '{}_rank{}{}'.format(os.path.splitext(metrics_file)[0], accelerator.process_index,
+                                            os.path.splitext(metrics_file)[1])
+    metrics = MetricsExporter(path=metrics_file,
+                              port=args.metrics_port + accelerator.local_process_index if args.metrics_port else 0,
+                              labels={'rank': accelerator.process_index})
+
+# inputs read by the model, the data providers and training loops skip the others
+args.model_inputs = {'Autoformer': Autoformer, 'DLinear': DLinear}.get(args.model, TimeLLM).Model.inputs
+
 for ii in range(args.itr):
     # setting record of experiments
     setting = '{}_{}_{}_{}_ft{}_sl{}_ll{}_pl{}_dm{}_nh{}_el{}_dl{}_df{}_fc{}_eb{}_{}_{}'.format(
@@ -123,7 +170,10 @@ for ii in range(args.itr):
         args.embed,
         args.des, ii)
 
+    # the dataset description of the prompts, built by the loaders with --prompt_in_loader
+    args.content = load_content(args)
     train_data, train_loader = data_provider(args, args.data_pretrain, args.data_path_pretrain, True, 'train')
+    train_sampler = train_loader.sampler
     vali_data, vali_loader = data_provider(args, args.data_pretrain, args.data_path_pretrain, True, 'val')
     test_data, test_loader = data_provider(args, args.data, args.data_path, False, 'test')
 
@@ -134,16 +184,18 @@ for ii in range(args.itr):
     else:
         model = TimeLLM.Model(args).float()
 
+    module_profiler = ModuleProfiler(model, backward=args.profile_backward) if args.profile_modules else None
+
     path = os.path.join(args.checkpoints,
                         setting + '-' + args.model_comment)  # unique checkpoint saving path
-    args.content = load_content(args)
     if not os.path.exists(path) and accelerator.is_local_main_process:
         os.makedirs(path)
 
     time_now = time.time()
 
     train_steps = len(train_loader)
-    early_stopping = EarlyStopping(accelerator=accelerator, patience=args.patience)
+    early_stopping = EarlyStopping(accelerator=accelerator, patience=args.patience,
+                                   async_save=not args.sync_checkpoint, keep_checkpoints=args.keep_checkpoints)
 
     trained_parameters = []
     for p in model.parameters():
@@ -170,51 +222,56 @@ for ii in range(args.itr):
     if args.use_amp:
         scaler = torch.cuda.amp.GradScaler()
 
+    step_timer = StepTimer(enabled=args.step_timer, pid=accelerator.process_index)
+
     for epoch in range(args.train_epochs):
+        # accelerate only forwards the epoch to the sampler when it does not shard the batches itself
+        train_loader.set_epoch(epoch)
+        train_sampler.set_epoch(epoch)
         iter_count = 0
         train_loss = []
 
         model.train()
         epoch_time = time.time()
-        for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(train_loader):
+        if module_profiler is not None:
+            module_profiler.reset()
+        # the next batches are moved to the device with their decoder input while the current step runs
+        train_batches = BatchPrefetcher(train_loader, lambda batch: prepare_batch(args, batch, accelerator.device),
+                                        args.prefetch, timer=step_timer)
+        train_iter = train_batches if metrics is None else metrics.iterate(train_batches)
+        step_end = time.time()
+        for i, (batch_x, batch_y, batch_x_mark, batch_y_mark, dec_inp, kwargs) in enumerate(step_timer.iterate(train_iter)):
             iter_count += 1
             model_optim.zero_grad()
 
-            batch_x = batch_x.float().to(accelerator.device)
-            batch_y = batch_y.float().to(accelerator.device)
-            batch_x_mark = batch_x_mark.float().to(accelerator.device)
-            batch_y_mark = batch_y_mark.float().to(accelerator.device)
-
-            # decoder input
-            dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :]).float().to(
-                accelerator.device)
-            dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1).float().to(
-                accelerator.device)
-
             # encoder - decoder
             if args.use_amp:
                 with torch.cuda.amp.autocast():
+                    with step_timer.phase('forward'):
+                        if args.output_attention:
+                            outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)[0]
+                        else:
+                            outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)
+
+                    with step_timer.phase('loss'):
+                        f_dim = -1 if args.features == 'MS' else 0
+                        outputs = outputs[:, -args.pred_len:, f_dim:]
+                        batch_y = batch_y[:, -args.pred_len:, f_dim:].to(accelerator.device)
+                        loss = criterion(outputs, batch_y)
+                        train_loss.append(loss.item())
+            else:
+                with step_timer.phase('forward'):
                     if args.output_attention:
-                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)[0]
                     else:
-                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)
 
+                with step_timer.phase('loss'):
                     f_dim = -1 if args.features == 'MS' else 0
                     outputs = outputs[:, -args.pred_len:, f_dim:]
-                    batch_y = batch_y[:, -args.pred_len:, f_dim:].to(accelerator.device)
+                    batch_y = batch_y[:, -args.pred_len:, f_dim:]
                     loss = criterion(outputs, batch_y)
                     train_loss.append(loss.item())
-            else:
-                if args.output_attention:
-                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
-                else:
-                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
-
-                f_dim = -1 if args.features == 'MS' else 0
-                outputs = outputs[:, -args.pred_len:, f_dim:]
-                batch_y = batch_y[:, -args.pred_len:, f_dim:]
-                loss = criterion(outputs, batch_y)
-                train_loss.append(loss.item())
 
             if (i + 1) % 100 == 0:
                 accelerator.print(
@@ -222,30 +279,61 @@ for ii in range(args.itr):
                 speed = (time.time() - time_now) / iter_count
                 left_time = speed * ((args.train_epochs - epoch) * train_steps - i)
                 accelerator.print('\tspeed: {:.4f}s/iter; left time: {:.4f}s'.format(speed, left_time))
+                if args.step_timer:
+                    accelerator.print('\t' + step_timer.summary())
                 iter_count = 0
                 time_now = time.time()
 
             if args.use_amp:
-                scaler.scale(loss).backward()
-                scaler.step(model_optim)
-                scaler.update()
+                with step_timer.phase('backward'):
+                    scaler.scale(loss).backward()
+                with step_timer.phase('optim'):
+                    scaler.step(model_optim)
+                    scaler.update()
             else:
-                accelerator.backward(loss)
-                model_optim.step()
+                with step_timer.phase('backward'):
+                    accelerator.backward(loss)
+                with step_timer.phase('optim'):
+                    model_optim.step()
 
             if args.lradj == 'TST':
-                adjust_learning_rate(accelerator, model_optim, scheduler, epoch + 1, args, printout=False)
-                scheduler.step()
+                with step_timer.phase('sched'):
+                    adjust_learning_rate(accelerator, model_optim, scheduler, epoch + 1, args, printout=False)
+                    scheduler.step()
+
+            step_timer.end_step()
+            if metrics is not None:
+                metrics.record_step(time.time() - step_end, batch_x.shape[0],
+                                    getattr(accelerator.unwrap_model(model), 'backbone_tokens', 0),
+                                    model_optim.param_groups[0]['lr'])
+                step_end = time.time()
 
         accelerator.print("Epoch: {} cost time: {}".format(epoch + 1, time.time() - epoch_time))
+        if args.step_timer:
+            accelerator.print(step_timer.summary())
+            step_timer.export_chrome_trace(os.path.join(
+                args.trace_dir, setting + '-' + args.model_comment, 'steps_rank{}.json'.format(accelerator.process_index)))
+        if module_profiler is not None:
+            accelerator.print(module_profiler.table())
+            module_profiler.dump_csv(os.path.join(
+                args.trace_dir, setting + '-' + args.model_comment,
+                'modules_rank{}_epoch{}.csv'.format(accelerator.process_index, epoch + 1)))
         train_loss = np.average(train_loss)
-        vali_loss, vali_mae_loss = vali(args, accelerator, model, vali_data, vali_loader, criterion, mae_metric)
-        test_loss, test_mae_loss = vali(args, accelerator, model, test_data, test_loader, criterion, mae_metric)
+        vali_loss, vali_mae_loss = vali(args, accelerator, model, vali_data, vali_loader, criterion, mae_metric,
+                                        metrics)
+        test_loss, test_mae_loss = vali(args, accelerator, model, test_data, test_loader, criterion, mae_metric,
+                                        metrics)
         accelerator.print(
             "Epoch: {0} | Train Loss: {1:.7f} Vali Loss: {2:.7f} Test Loss: {3:.7f} MAE Loss: {4:.7f}".format(
                 epoch + 1, train_loss, vali_loss, test_loss, test_mae_loss))
 
         early_stopping(vali_loss, model, path)
+        if metrics is not None:
+            metrics.set('epoch', epoch + 1)
+            metrics.set('train_loss', train_loss)
+            metrics.set('vali_loss', vali_loss)
+            metrics.set('test_loss', test_loss)
+            metrics.record_early_stopping(early_stopping)
         if early_stopping.early_stop:
             accelerator.print("Early stopping")
             break
@@ -263,8 +351,15 @@ for ii in range(args.itr):
         else:
             accelerator.print('Updating learning rate to {}'.format(scheduler.get_last_lr()[0]))
 
+    early_stopping.close()
+
+if metrics is not None:
+    metrics.close()
+
 accelerator.wait_for_everyone()
 if accelerator.is_local_main_process:
     path = './checkpoints'  # unique checkpoint saving path
     del_files(path)  # delete checkpoint files
-    accelerator.print('success delete checkpoints')
\ No newline at end of file
+    accelerator.print('success delete checkpoints')
+    if args.unlink_shared:
+        unlink_shared()
\ No newline at end of file
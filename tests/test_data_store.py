@@ -0,0 +1,174 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_provider import data_store
+from data_provider.data_store import SHM_PREFIX, clear_tables, encode_table, load_table, unlink_shared
+from data_provider.windows import decode
+
+
+def write_csv(path, rows, seed):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({'date': pd.date_range('2016-07-01', periods=rows, freq='h').astype(str),
+                          'HUFL': rng.normal(size=rows), 'OT': rng.normal(size=rows)})
+    frame.to_csv(path, index=False)
+
+
+def load(path, **kwargs):
+    return load_table(str(path), 'M', 'OT', True, 1, 'h', 100, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def fresh_tables():
+    clear_tables()
+    yield
+    clear_tables()
+
+
+def cached_folders(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name.startswith('data-'))
+
+
+def test_cache_is_keyed_by_content_and_options(tmp_path):
+    csv_path, cache_dir = tmp_path / 'data.csv', tmp_path / 'cache'
+    write_csv(csv_path, 200, seed=0)
+    data, stamp, scaler, _ = load(csv_path, cache_dir=str(cache_dir))
+    assert len(cached_folders(cache_dir)) == 1
+
+    # served from the cache, memory-mapped
+    clear_tables()
+    cached, cached_stamp, cached_scaler, _ = load(csv_path, cache_dir=str(cache_dir))
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, data)
+    np.testing.assert_array_equal(cached_stamp, stamp)
+    np.testing.assert_array_equal(cached_scaler.mean_, scaler.mean_)
+
+    # another option is another entry
+    clear_tables()
+    load(csv_path, cache_dir=str(cache_dir), storage_dtype='float32')
+    assert len(cached_folders(cache_dir)) == 2
+
+
+def test_cache_is_invalidated_when_the_source_changes(tmp_path):
+    csv_path, cache_dir = tmp_path / 'data.csv', tmp_path / 'cache'
+    write_csv(csv_path, 200, seed=0)
+    before = np.array(load(csv_path, cache_dir=str(cache_dir))[0])
+
+    write_csv(csv_path, 200, seed=1)
+    clear_tables()
+    after = load(csv_path, cache_dir=str(cache_dir))[0]
+    assert not isinstance(after, np.memmap)
+    assert not np.array_equal(before, after)
+    assert len(cached_folders(cache_dir)) == 2
+
+    clear_tables()
+    np.testing.assert_array_equal(load(csv_path, cache_dir=str(cache_dir))[0], after)
+
+
+def shared_segments():
+    return sorted(name for name in os.listdir('/dev/shm') if name.startswith(SHM_PREFIX))
+
+
+needs_shm = pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs POSIX shared memory in /dev/shm')
+
+
+@needs_shm
+def test_shared_memory_is_attached_then_unlinked(tmp_path):
+    csv_path = tmp_path / 'data.csv'
+    write_csv(csv_path, 200, seed=2)
+    unlink_shared()
+    try:
+        data, stamp, scaler, _ = load(csv_path, shared_memory=True)
+        segments = shared_segments()
+        assert len(segments) == 1
+
+        # another process attaches to the segment instead of parsing the file again
+        created = dict(data_store._segments)
+        data_store._segments.clear()
+        clear_tables()
+        parse_calls = []
+        original = data_store._load_table
+        data_store._load_table = lambda *args: parse_calls.append(args) or original(*args)
+        try:
+            attached, attached_stamp, attached_scaler, _ = load(csv_path, shared_memory=True)
+        finally:
+            data_store._load_table = original
+        assert parse_calls == []
+        assert shared_segments() == segments
+        np.testing.assert_array_equal(attached, data)
+        np.testing.assert_array_equal(attached_stamp, stamp)
+        np.testing.assert_array_equal(attached_scaler.mean_, scaler.mean_)
+    finally:
+        # what --unlink_shared does at the end of a run
+        unlink_shared()
+    assert shared_segments() == []
+    # mapped arrays stay readable until the process exits
+    np.testing.assert_array_equal(attached, data)
+    assert created
+
+
+@needs_shm
+def test_same_content_is_mapped_once_per_process(tmp_path):
+    csv_path = tmp_path / 'data.csv'
+    write_csv(csv_path, 200, seed=3)
+    try:
+        data = load(csv_path, shared_memory=True)[0]
+        # a new mtime is another table of this process, but the same segment
+        os.utime(csv_path, ns=(0, os.stat(csv_path).st_mtime_ns + 10 ** 9))
+        again = load(csv_path, shared_memory=True)[0]
+        assert np.shares_memory(data, again)
+        np.testing.assert_array_equal(data, again)
+    finally:
+        unlink_shared()
+
+
+def channels_of_every_scale(rows=5000):
+    rng = np.random.default_rng(4)
+    data = np.stack([rng.normal(size=rows), rng.normal(size=rows) * 1e4 + 3e5, rng.normal(size=rows) * 1e-4,
+                     np.full(rows, 7.), rng.standard_cauchy(size=rows)], 1)
+    data[::97, 0] = 0.
+    return data
+
+
+def test_bfloat16_round_trip_is_within_tolerance():
+    data = channels_of_every_scale()
+    values, stamp, quant = encode_table(data, np.zeros((len(data), 4)), 'bfloat16')
+    assert values.dtype == np.uint16 and quant is None and stamp.dtype == np.float32
+    decoded = decode(values)
+    assert decoded.dtype == np.float32
+    exact = data.astype(np.float32)
+    assert np.all(np.abs(decoded - exact) <= np.abs(exact) * 2 ** -8)
+    # already representable values are kept as they are
+    np.testing.assert_array_equal(decode(encode_table(decoded, stamp, 'bfloat16')[0]), decoded)
+
+
+def test_int16_round_trip_is_within_tolerance():
+    data = channels_of_every_scale()
+    values, _, quant = encode_table(data, np.zeros((len(data), 4)), 'int16')
+    assert values.dtype == np.int16 and np.abs(values).max() <= 32767
+    decoded = decode(values, quant)
+    step = (data.max(0) - data.min(0)) / 65534
+    rounding = np.abs(data).max(0) * np.finfo(np.float32).eps * 2
+    assert np.all(np.abs(decoded - data) <= step / 2 + rounding)
+    # a constant channel decodes exactly
+    np.testing.assert_array_equal(decoded[:, 3], data[:, 3])
+    # the channels of a window are decoded with their own (scale, offset)
+    channels = np.array([4, 1])
+    np.testing.assert_array_equal(decode(values[:, channels], quant, channels), decoded[:, channels])
+
+
+@pytest.mark.parametrize('storage_dtype', ['bfloat16', 'int16'])
+def test_storage_dtype_keeps_the_scaler(tmp_path, storage_dtype):
+    csv_path = tmp_path / 'data.csv'
+    write_csv(csv_path, 300, seed=5)
+    data, _, scaler, _ = load(csv_path)
+    stored, _, stored_scaler, quant = load(csv_path, storage_dtype=storage_dtype)
+    for name in ('mean_', 'scale_', 'var_', 'n_samples_seen_'):
+        np.testing.assert_array_equal(getattr(stored_scaler, name), getattr(scaler, name))
+    np.testing.assert_array_equal(stored_scaler.inverse_transform(data), scaler.inverse_transform(data))
+    decoded = decode(stored, quant)
+    tolerance = 2 ** -8 * np.abs(data) if storage_dtype == 'bfloat16' else \
+        (data.max(0) - data.min(0)) / 131068 + 1e-6
+    assert np.all(np.abs(decoded - data) <= tolerance + 1e-7)
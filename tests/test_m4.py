@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_provider.data_loader import Dataset_M4
+from data_provider.m4 import M4Dataset, M4Meta, M4Packed
+from utils.m4_summary import M4Summary, group_values, mape, mase, score_group, smape_2
+
+
+def write_m4(root, seed=0, count=60, lengths=(2, 3, 5, 11, 40, 130)):
+    """
+    A small M4 layout: patterns in a shuffled order, series of the given lengths, some with trailing NaNs.
+    """
+    rng = np.random.default_rng(seed)
+    rows, training, test = [], [], []
+    for k in range(count):
+        g = int(rng.integers(len(M4Meta.seasonal_patterns)))
+        pattern, horizon = M4Meta.seasonal_patterns[g], M4Meta.horizons[g]
+        rows.append(('{}{}'.format(pattern[0], k), pattern, M4Meta.frequencies[g], horizon))
+        values = rng.random(int(rng.choice(lengths))) * 1000 + 10
+        if k % 7 == 0:
+            values = np.concatenate([values, [np.nan] * 5])
+        training.append(values)
+        test.append(rng.random(horizon) * 1000 + 10)
+    pd.DataFrame(rows, columns=['M4id', 'SP', 'Frequency', 'Horizon']).to_csv(
+        os.path.join(root, 'M4-info.csv'), index=False)
+    for name, part in (('training', training), ('test', test)):
+        values = np.empty(len(part), dtype=object)
+        values[:] = part
+        values.dump(os.path.join(root, name + '.npz'))
+
+
+@pytest.fixture
+def m4_root(tmp_path):
+    write_m4(str(tmp_path))
+    return str(tmp_path)
+
+
+def expected_series(dataset, pattern):
+    return [v[~np.isnan(v)] for v, g in zip(dataset.values, dataset.groups) if g == pattern]
+
+
+@pytest.mark.parametrize('training', [True, False])
+def test_packed_series_match_the_unpacked_ones(m4_root, training):
+    dataset = M4Dataset.load(training=training, dataset_file=m4_root)
+    packed = M4Packed.pack(dataset)
+    assert list(packed.groups) == sorted(dataset.groups, key=M4Meta.seasonal_patterns.index)
+    for pattern in M4Meta.seasonal_patterns:
+        group = packed.group(pattern)
+        assert list(group.ids) == [i for i, g in zip(dataset.ids, dataset.groups) if g == pattern]
+        series = group.series()
+        expected = expected_series(dataset, pattern)
+        assert len(series) == len(expected)
+        for got, want in zip(series, expected):
+            np.testing.assert_array_equal(got, want)
+
+
+def packed_folders(root):
+    return sorted(name for name in os.listdir(root) if name.startswith('training-packed-'))
+
+
+def test_cache_is_rebuilt_when_the_source_changes(m4_root):
+    packed = M4Packed.load(training=True, dataset_file=m4_root)
+    assert len(packed_folders(m4_root)) == 1
+    cached = M4Packed.load(training=True, dataset_file=m4_root)
+    assert isinstance(cached.values, np.memmap)
+    for field in M4Packed.__dataclass_fields__:
+        np.testing.assert_array_equal(getattr(cached, field), getattr(packed, field))
+
+    write_m4(m4_root, seed=1, count=45)
+    rebuilt = M4Packed.load(training=True, dataset_file=m4_root)
+    assert not isinstance(rebuilt.values, np.memmap)
+    assert len(rebuilt.ids) == 45
+    # the previous folder is left to the processes still reading it
+    assert len(packed_folders(m4_root)) == 2
+    dataset = M4Dataset.load(training=True, dataset_file=m4_root)
+    for pattern in M4Meta.seasonal_patterns:
+        for got, want in zip(rebuilt.group(pattern).series(), expected_series(dataset, pattern)):
+            np.testing.assert_array_equal(got, want)
+
+
+@pytest.mark.parametrize('pattern', M4Meta.seasonal_patterns)
+def test_last_insample_window(m4_root, pattern):
+    horizon = M4Meta.horizons_map[pattern]
+    data_set = Dataset_M4(m4_root, 'train', [2 * horizon, horizon, horizon], seasonal_patterns=pattern)
+    insample, insample_mask = data_set.last_insample_window()
+
+    expected = np.zeros((len(data_set.timeseries), data_set.seq_len))
+    expected_mask = np.zeros((len(data_set.timeseries), data_set.seq_len))
+    for i, ts in enumerate(data_set.timeseries):
+        ts_last_window = ts[-data_set.seq_len:]
+        expected[i, -len(ts):] = ts_last_window
+        expected_mask[i, -len(ts):] = 1.0
+    np.testing.assert_array_equal(insample, expected)
+    np.testing.assert_array_equal(insample_mask, expected_mask)
+
+
+@pytest.mark.parametrize('pattern', M4Meta.seasonal_patterns)
+def test_sampled_windows_match_getitem(m4_root, pattern, monkeypatch):
+    horizon = M4Meta.horizons_map[pattern]
+    data_set = Dataset_M4(m4_root, 'train', [2 * horizon, horizon, horizon], seasonal_patterns=pattern)
+    indices = np.arange(len(data_set))
+    lengths = np.array([len(ts) for ts in data_set.timeseries])
+    low = np.maximum(1, lengths - data_set.window_sampling_limit)
+
+    # walk every series through each of its cut points
+    shift = 0
+
+    def randint(low, high, size=None):
+        cut = low + shift % (high - low)
+        return cut if size is None else np.full(size, cut)
+    monkeypatch.setattr(np.random, 'randint', randint)
+
+    cuts = set()
+    for shift in range(int((lengths - low).max())):
+        batch = data_set.__getitems__(indices)
+        expected = [data_set[i] for i in indices]
+        for k, tensor in enumerate(batch):
+            want = np.stack([sample[k] for sample in expected]).astype(np.float32)
+            np.testing.assert_array_equal(tensor.numpy(), want)
+        cuts.update(zip(lengths.tolist(), (low + shift % (lengths - low)).tolist()))
+
+    # short series, starts before the first value and cut points at both ends are all covered
+    assert any(length < data_set.seq_len for length, _ in cuts)
+    assert any(cut - data_set.label_len < 0 for _, cut in cuts)
+    assert any(cut == length - 1 for length, cut in cuts)
+
+
+def reference_scores(file_path, root_path):
+    """
+    The per-pattern scores of M4Summary.evaluate before the packed baselines, one series at a time.
+    """
+    training = M4Dataset.load(training=True, dataset_file=root_path)
+    test = M4Dataset.load(training=False, dataset_file=root_path)
+    naive2_forecasts = pd.read_csv(os.path.join(root_path, 'submission-Naive2.csv')).values[:, 1:].astype(np.float32)
+    naive2_forecasts = np.array([v[~np.isnan(v)] for v in naive2_forecasts] + [None], dtype=object)[:-1]
+    scores = {}
+    for group_name in M4Meta.seasonal_patterns:
+        model_forecast = pd.read_csv(file_path + group_name + '_forecast.csv').values
+        naive2_forecast = group_values(naive2_forecasts, test.groups, group_name)
+        target = group_values(test.values, test.groups, group_name)
+        frequency = training.frequencies[test.groups == group_name][0]
+        # ragged, group_values only stacks series of one length with this numpy
+        insample = [v[~np.isnan(v)] for v in training.values[test.groups == group_name]]
+        scores[group_name] = {
+            'smape': np.mean(smape_2(forecast=model_forecast, target=target)),
+            'mape': np.mean(mape(forecast=model_forecast, target=target)),
+            'mase': np.mean([mase(forecast=model_forecast[i], insample=insample[i], outsample=target[i],
+                                  frequency=frequency) for i in range(len(model_forecast))]),
+            'naive2_smape': np.mean(smape_2(naive2_forecast, target)),
+            'naive2_mase': np.mean([mase(forecast=naive2_forecast[i], insample=insample[i], outsample=target[i],
+                                         frequency=frequency) for i in range(len(model_forecast))]),
+        }
+    return scores
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_summary_matches_the_per_series_scores(tmp_path, workers):
+    root_path, file_path = str(tmp_path / 'm4'), str(tmp_path / 'results') + '/'
+    os.makedirs(root_path)
+    os.makedirs(file_path)
+    # longer than the Hourly frequency, so every MASE has a denominator
+    write_m4(root_path, seed=2, count=90, lengths=(30, 41, 97, 130))
+    info = pd.read_csv(os.path.join(root_path, 'M4-info.csv'))
+    rng = np.random.default_rng(3)
+    naive2 = np.full((len(info), max(M4Meta.horizons)), np.nan)
+    for i, horizon in enumerate(info.Horizon):
+        naive2[i, :horizon] = rng.random(horizon) * 1000
+    naive2 = pd.DataFrame(naive2, columns=['V{}'.format(i + 1) for i in range(naive2.shape[1])])
+    naive2.insert(0, 'id', info.M4id)
+    naive2.to_csv(os.path.join(root_path, 'submission-Naive2.csv'), index=False)
+    for pattern, horizon in M4Meta.horizons_map.items():
+        forecast = pd.DataFrame(rng.random(((info.SP == pattern).sum(), horizon)) * 1000,
+                                index=pd.Index(info.M4id[info.SP == pattern].values, name='id'),
+                                columns=['V{}'.format(i + 1) for i in range(horizon)])
+        forecast.set_index(forecast.columns[0]).to_csv(file_path + pattern + '_forecast.csv')
+
+    reference = reference_scores(file_path, root_path)
+    for pattern in M4Meta.seasonal_patterns:
+        scores = score_group(file_path, root_path, pattern)
+        assert set(scores) == set(reference[pattern])
+        for name, value in scores.items():
+            np.testing.assert_allclose(value, reference[pattern][name], rtol=1e-12, err_msg=pattern + ' ' + name)
+
+    summary = M4Summary(file_path, root_path, workers=workers)
+    expected_mases = summary.summarize_groups({g: reference[g]['mase'] for g in reference})
+    expected_smapes = summary.summarize_groups({g: reference[g]['smape'] for g in reference})
+    naive2_mases = summary.summarize_groups({g: reference[g]['naive2_mase'] for g in reference})
+    naive2_smapes = summary.summarize_groups({g: reference[g]['naive2_smape'] for g in reference})
+    expected_owa = {k: (expected_mases[k] / naive2_mases[k] + expected_smapes[k] / naive2_smapes[k]) / 2
+                    for k in expected_mases}
+    smapes, owa, mapes, mases = summary.evaluate()
+    for got, want in ((smapes, expected_smapes), (owa, expected_owa), (mases, expected_mases)):
+        assert list(got) == list(want)
+        np.testing.assert_array_equal(list(got.values()), np.round(list(want.values()), 3))
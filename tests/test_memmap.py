@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_provider.memmap import convert_csv, open_table
+
+
+def write_csv(path, rows):
+    dates = pd.date_range('2020-01-01', periods=rows, freq='h')
+    frame = pd.DataFrame({'date': dates.astype(str), 'HUFL': np.arange(rows, dtype=float),
+                          'OT': np.arange(rows, dtype=float) * 2})
+    frame.to_csv(path, index=False)
+
+
+def test_a_csv_without_rows_is_rejected(tmp_path):
+    csv_path = tmp_path / 'empty.csv'
+    csv_path.write_text('date,HUFL,OT\n')
+    with pytest.raises(ValueError, match='has no rows'):
+        convert_csv(str(csv_path), str(tmp_path / 'tables' / 'empty'))
+    assert not (tmp_path / 'tables').exists()
+
+
+def test_a_failed_conversion_leaves_no_temporary_folder(tmp_path):
+    csv_path = tmp_path / 'data.csv'
+    write_csv(csv_path, 30)
+    with pytest.raises(KeyError):
+        convert_csv(str(csv_path), str(tmp_path / 'tables' / 'data'), target='missing')
+    assert os.listdir(tmp_path / 'tables') == []
+
+
+def test_conversion_round_trip(tmp_path):
+    csv_path = tmp_path / 'data.csv'
+    write_csv(csv_path, 30)
+    out_dir = convert_csv(str(csv_path), str(tmp_path / 'tables' / 'data'), chunksize=7)
+    values, stamp, meta = open_table(out_dir)
+    assert meta['rows'] == 30 and meta['columns'] == ['HUFL', 'OT']
+    np.testing.assert_array_equal(values[1], np.arange(30) * 2)
+    assert stamp.shape[0] == 30
+    assert os.listdir(tmp_path / 'tables') == ['data']
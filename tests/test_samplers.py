@@ -0,0 +1,163 @@
+import threading
+
+import numpy as np
+import pytest
+from accelerate.data_loader import BatchSamplerShard
+from torch.utils.data import BatchSampler
+
+from data_provider.samplers import BlockShuffleSampler, GroupBatchSampler, WindowSampler
+
+# the M4 seasonal patterns, from Yearly to Hourly
+M4_SIZES = [23000, 24000, 48000, 359, 4227, 414]
+
+
+def group_of(sizes):
+    return np.repeat(np.arange(len(sizes)), sizes)
+
+
+@pytest.mark.parametrize('sizes, batch_size, rounds', [
+    (M4_SIZES, 24, 1),
+    (M4_SIZES, 24, 8),
+    ([5, 0, 130, 61], 4, 3),
+])
+def test_batches_are_full_and_of_one_group(sizes, batch_size, rounds):
+    sampler = GroupBatchSampler(sizes, batch_size, seed=0, rounds=rounds)
+    groups = group_of(sizes)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    for batch in batches:
+        assert len(batch) == batch_size
+        assert len(set(groups[batch])) == 1
+
+
+@pytest.mark.parametrize('rounds', [2, 3, 8])
+def test_every_process_draws_the_same_group_at_every_step(rounds):
+    sizes = [1000, 37, 590, 4]
+    sampler = GroupBatchSampler(sizes, 16, seed=1, rounds=rounds)
+    groups = group_of(sizes)
+    shards = [list(BatchSamplerShard(sampler, num_processes=rounds, process_index=rank)) for rank in range(rounds)]
+    steps = len(sampler) // rounds
+    assert all(len(shard) == steps for shard in shards)
+    for step in zip(*shards):
+        assert len({groups[batch[0]] for batch in step}) == 1
+
+
+@pytest.mark.parametrize('rounds', [1, 8])
+def test_groups_are_drawn_in_proportion_to_their_size(rounds):
+    batch_size = 24
+    sampler = GroupBatchSampler(M4_SIZES, batch_size, seed=2, rounds=rounds)
+    groups = group_of(M4_SIZES)
+    counts = np.bincount([groups[batch[0]] for batch in sampler], minlength=len(M4_SIZES))
+    # within one run of the exact share, no group gets a whole padding run of its own
+    expected = np.array(M4_SIZES) / sum(M4_SIZES) * len(sampler)
+    assert np.all(np.abs(counts - expected) <= rounds)
+    assert len(sampler) * batch_size - sum(M4_SIZES) < rounds * batch_size
+
+
+def test_samples_are_not_repeated_within_an_epoch():
+    sampler = GroupBatchSampler(M4_SIZES, 24, seed=3, rounds=8)
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        indices = np.concatenate(list(sampler))
+        groups = group_of(M4_SIZES)
+        for group, size in enumerate(M4_SIZES):
+            drawn = indices[groups[indices] == group]
+            assert len(np.unique(drawn)) == min(size, len(drawn))
+
+
+def test_order_depends_on_the_epoch_only():
+    sampler = GroupBatchSampler(M4_SIZES, 24, seed=4, rounds=2)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+class Windows:
+    def __init__(self, channels, tot_len):
+        self.tot_len = tot_len
+        self.channels = channels
+
+    def __len__(self):
+        return self.channels * self.tot_len
+
+
+def window_samplers():
+    return [WindowSampler(Windows(3, 170), seed=5),
+            BlockShuffleSampler(Windows(3, 170), block_size=16, buffer_blocks=4, seed=5)]
+
+
+@pytest.mark.parametrize('index', [0, 1])
+@pytest.mark.parametrize('consumed', [0, 1, 77, 509, 510])
+def test_resume_covers_every_index_once(index, consumed):
+    sampler = window_samplers()[index]
+    sampler.set_epoch(2)
+    trained = list(sampler)[:consumed]
+    sampler.advance(consumed)
+
+    resumed = window_samplers()[index]
+    resumed.load_state_dict(sampler.state_dict())
+    assert len(resumed) == 510 - consumed
+    rest = list(resumed)
+    assert len(rest) == len(resumed)
+    assert sorted(trained + rest) == list(range(510))
+
+
+@pytest.mark.parametrize('processes', [1, 2, 3])
+def test_sharded_resume_covers_every_index_once(processes):
+    batch_size, steps = 5, 7
+
+    def shards(sampler):
+        batches = BatchSampler(sampler, batch_size, drop_last=False)
+        return [iter(BatchSamplerShard(batches, num_processes=processes, process_index=rank))
+                for rank in range(processes)]
+
+    sampler = WindowSampler(Windows(2, 255), seed=6)
+    trained = []
+    for shard in shards(sampler):
+        for _ in range(steps):
+            trained += next(shard)
+    sampler.advance(steps * batch_size * processes)
+
+    resumed = WindowSampler(Windows(2, 255), seed=6)
+    resumed.load_state_dict(sampler.state_dict())
+    rest = [i for shard in shards(resumed) for batch in shard for i in batch]
+    assert sorted(trained + rest) == list(range(510))
+
+
+def test_len_is_fixed_while_iterating():
+    sampler = WindowSampler(Windows(1, 100), seed=7)
+    assert len(sampler) == 100
+    for _ in sampler:
+        sampler.advance(1)
+        assert len(sampler) == 100
+    sampler.set_epoch(1)
+    assert len(sampler) == 100
+
+
+class PrefetchedWindows(Windows):
+    def __init__(self, channels, tot_len):
+        super().__init__(channels, tot_len)
+        self.prefetched = []
+        self.threads = set()
+
+    def prefetch(self, indices):
+        self.threads.add(threading.get_ident())
+        self.prefetched.append(indices.tolist())
+
+
+def test_block_shuffle_prefetches_every_next_buffer_on_one_worker():
+    data = PrefetchedWindows(4, 300)
+    sampler = BlockShuffleSampler(data, block_size=8, buffer_blocks=5, seed=8)
+    order = list(sampler)
+    assert order == sampler.order().tolist()
+    buffers = [order[start:start + 40] for start in range(0, len(order), 40)]
+    assert data.prefetched == buffers[1:]
+    assert len(data.threads) == 1 and threading.get_ident() not in data.threads
+
+    # stopping early shuts the worker down
+    data.prefetched = []
+    iterator = iter(sampler)
+    next(iterator)
+    iterator.close()
+    assert data.prefetched == buffers[1:2]
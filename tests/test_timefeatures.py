@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.timefeatures import as_stamps, calendar_features, calendar_fields, time_features, \
+    time_features_from_frequency_str
+
+
+def around(day, days=4, freq='h'):
+    return pd.date_range(pd.Timestamp(day) - pd.Timedelta(days=days), pd.Timestamp(day) + pd.Timedelta(days=days),
+                         freq=freq)
+
+
+DATES = {
+    # 2000 is a leap year, 1900 and 2100 are not
+    'leap_days': around('2000-02-29').append([around('1900-02-28'), around('2016-02-29'), around('2100-02-28')]),
+    # ISO years with 53 weeks end in 2004, 2009, 2015, 2020 and 2026, week 1 of 2008 and 2019 starts in December
+    'year_boundaries': around('2005-01-01').append([around('2010-01-01'), around('2016-01-01'), around('2021-01-01'),
+                                                    around('2027-01-01'), around('2008-01-01'), around('2019-01-01')]),
+    'seconds': pd.date_range('2023-12-31 23:58:30', periods=200, freq='s'),
+    'random': pd.DatetimeIndex(np.random.default_rng(0).integers(
+        pd.Timestamp('1700-01-01').value, pd.Timestamp('2250-01-01').value, 20000)),
+}
+
+FIELDS = {
+    'year': lambda index: index.year,
+    'month': lambda index: index.month,
+    'day': lambda index: index.day,
+    'weekday': lambda index: index.dayofweek,
+    'hour': lambda index: index.hour,
+    'minute': lambda index: index.minute,
+    'second': lambda index: index.second,
+    'dayofyear': lambda index: index.dayofyear,
+    'week': lambda index: index.isocalendar().week,
+}
+
+# the per-feature encodings as computed from the pandas fields before calendar_fields
+ENCODINGS = {
+    'SecondOfMinute': lambda index: index.second / 59.0 - 0.5,
+    'MinuteOfHour': lambda index: index.minute / 59.0 - 0.5,
+    'HourOfDay': lambda index: index.hour / 23.0 - 0.5,
+    'DayOfWeek': lambda index: index.dayofweek / 6.0 - 0.5,
+    'DayOfMonth': lambda index: (index.day - 1) / 30.0 - 0.5,
+    'DayOfYear': lambda index: (index.dayofyear - 1) / 365.0 - 0.5,
+    'MonthOfYear': lambda index: (index.month - 1) / 11.0 - 0.5,
+    'WeekOfYear': lambda index: (index.isocalendar().week - 1) / 52.0 - 0.5,
+}
+
+
+@pytest.mark.parametrize('dates', DATES.values(), ids=DATES.keys())
+def test_calendar_fields_match_pandas(dates):
+    fields = calendar_fields(as_stamps(dates))
+    assert set(fields) == set(FIELDS)
+    for name, field in FIELDS.items():
+        np.testing.assert_array_equal(fields[name], np.asarray(field(dates), dtype=np.int64), err_msg=name)
+
+
+@pytest.mark.parametrize('dates', DATES.values(), ids=DATES.keys())
+@pytest.mark.parametrize('freq', ['q', 'm', 'w', 'd', 'b', 'h', 't', 's'])
+def test_time_features_match_pandas(dates, freq):
+    expected = np.vstack([np.asarray(ENCODINGS[type(feature).__name__](dates), dtype=np.float64)
+                          for feature in time_features_from_frequency_str(freq)])
+    np.testing.assert_array_equal(time_features(dates, freq), expected)
+    np.testing.assert_array_equal(calendar_features(as_stamps(dates), 1, freq), expected.T)
+
+
+@pytest.mark.parametrize('dates', DATES.values(), ids=DATES.keys())
+@pytest.mark.parametrize('minute', [False, True])
+def test_integer_calendar_features_match_pandas(dates, minute):
+    columns = [dates.month, dates.day, dates.dayofweek, dates.hour] + ([dates.minute // 15] if minute else [])
+    np.testing.assert_array_equal(calendar_features(as_stamps(dates), 0, 'h', minute),
+                                  np.stack([np.asarray(c, dtype=np.int64) for c in columns], 1))
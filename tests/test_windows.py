@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from torch.utils.data import default_collate
+
+from data_provider.data_loader import Dataset_Custom, Dataset_ETT_hour, Dataset_ETT_minute
+
+# rows of the ETT layouts, their borders are fixed; the custom one is split by ratio
+ROWS = {Dataset_ETT_hour: 20 * 30 * 24, Dataset_ETT_minute: 20 * 30 * 24 * 4, Dataset_Custom: 1500}
+FREQ = {Dataset_ETT_hour: 'h', Dataset_ETT_minute: 't', Dataset_Custom: 'h'}
+
+
+@pytest.fixture(scope='module')
+def root_path(tmp_path_factory):
+    root = tmp_path_factory.mktemp('datasets')
+    rng = np.random.default_rng(0)
+    for dataset, rows in ROWS.items():
+        step = '15min' if dataset is Dataset_ETT_minute else 'h'
+        frame = pd.DataFrame({'date': pd.date_range('2016-07-01', periods=rows, freq=step).astype(str)})
+        for column in ('HUFL', 'HULL', 'MUFL', 'OT'):
+            frame[column] = rng.normal(size=rows).cumsum()
+        frame.to_csv(root / '{}.csv'.format(dataset.__name__), index=False)
+    return str(root)
+
+
+@pytest.mark.parametrize('dataset', [Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom])
+@pytest.mark.parametrize('features', ['M', 'S', 'MS'])
+@pytest.mark.parametrize('flag, percent', [('train', 100), ('train', 10), ('val', 100), ('test', 100)])
+@pytest.mark.parametrize('timeenc, storage_dtype', [(0, 'float64'), (1, 'float64'), (1, 'int16')])
+def test_getitems_matches_collated_getitem(root_path, dataset, features, flag, percent, timeenc, storage_dtype):
+    data_set = dataset(root_path, flag, [48, 24, 12], features, '{}.csv'.format(dataset.__name__),
+                       timeenc=timeenc, freq=FREQ[dataset], percent=percent, storage_dtype=storage_dtype)
+    rng = np.random.default_rng(1)
+    indices = np.concatenate([[0, len(data_set) - 1, 0], rng.integers(0, len(data_set), 29)]).tolist()
+
+    expected = default_collate([data_set[i] for i in indices])
+    batch = data_set.__getitems__(indices)
+    assert len(batch) == len(expected) == 4
+    for got, want in zip(batch, expected):
+        assert got.dtype == torch.float32
+        assert got.shape == want.shape
+        assert torch.equal(got, want.to(torch.float32))
@@ -0,0 +1,265 @@
+import atexit
+import hashlib
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+from accelerate.utils import DistributedType
+
+
+def frozen_modules(model):
+    """
+    :return: names of the submodules whose parameters are all frozen, e.g. the LLM backbone and its blocks
+    """
+    frozen = set()
+    for name, module in model.named_modules():
+        params = list(module.parameters())
+        if params and not any(p.requires_grad for p in params):
+            frozen.add(name)
+    return frozen
+
+
+def trainable_state_dict(model):
+    """
+    Parameters with requires_grad=True, plus the buffers that do not belong to a frozen submodule.
+    """
+    frozen = frozen_modules(model)
+    state = {name: p.detach() for name, p in model.named_parameters() if p.requires_grad}
+    for name, buffer in model.named_buffers():
+        parts = name.split('.')
+        if not any('.'.join(parts[:i]) in frozen for i in range(1, len(parts))):
+            state[name] = buffer.detach()
+    return state
+
+
+def backbone_fingerprint(model, sample=16):
+    """
+    Hash of the names, shapes, dtypes and first `sample` values of every frozen parameter. Cheap enough to
+    compute once per run, and different whenever the backbone comes from another source or is truncated.
+    """
+    digest = hashlib.sha256()
+    for name, p in model.named_parameters():
+        if p.requires_grad:
+            continue
+        digest.update('{}:{}:{}'.format(name, tuple(p.shape), p.dtype).encode())
+        digest.update(p.detach().flatten()[:sample].float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def save_trainable(model, path, fingerprint=None, writer=None, keep=1):
+    """
+    Save only the trainable delta of a model. The frozen backbone is identified by its fingerprint and
+    rebuilt from its source at load time. With a CheckpointWriter the write happens in the background.
+    """
+    checkpoint = {
+        'format': 'trainable',
+        'state_dict': trainable_state_dict(model),
+        'fingerprint': fingerprint if fingerprint is not None else backbone_fingerprint(model),
+    }
+    if writer is not None:
+        writer.submit(checkpoint, path)
+    else:
+        atomic_save(checkpoint, path, keep)
+
+
+def load_trainable(model, checkpoint, path):
+    """
+    Load the trainable delta of a checkpoint written by save_trainable, after checking it was trained on
+    the same backbone. `path` is only used in error messages.
+    """
+    fingerprint = backbone_fingerprint(model)
+    if checkpoint['fingerprint'] != fingerprint:
+        raise RuntimeError('Checkpoint {} was trained on a different backbone (fingerprint {} != {})'.format(
+            path, checkpoint['fingerprint'][:12], fingerprint[:12]))
+    result = model.load_state_dict(checkpoint['state_dict'], strict=False)
+    trainable = set(trainable_state_dict(model))
+    missing = [k for k in result.missing_keys if k in trainable]
+    if missing or result.unexpected_keys:
+        raise RuntimeError('Error(s) in loading checkpoint {}: missing keys {}, unexpected keys {}'.format(
+            path, missing, result.unexpected_keys))
+    return model
+
+
+def load_checkpoint(model, path, map_location='cpu'):
+    """
+    Load a checkpoint written by save_trainable into a freshly built model, or a full state_dict
+    written by older versions.
+    """
+    checkpoint = torch.load(path, map_location=map_location)
+    if not (isinstance(checkpoint, dict) and checkpoint.get('format') == 'trainable'):
+        model.load_state_dict(checkpoint)
+        return model
+    return load_trainable(model, checkpoint, path)
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_resume(path, accelerator, model, optimizer, scheduler, early_stopping, epoch, step, **extra):
+    """
+    Snapshot everything needed to continue training from the given position, into one of two folders next to
+    `path` used in turn. Like save_trainable, only the trainable parameters are written, the frozen backbone is
+    identified by its fingerprint. Under DeepSpeed the engine writes them with the ZeRO shards of the optimizer
+    of every process, otherwise the main process writes them with the optimizer and scheduler states. Every
+    process adds its RNG states. Once all of them are done, the main process writes the manifest `path` with the
+    loop state and the folder it belongs to, so an interrupted save leaves the previous snapshot usable and every
+    process resumes from the same one.
+
+    :param model: the prepared model
+    :param step: number of batches of `epoch` already trained on
+    :param extra: other picklable loop state such as the sampler position, returned as is by load_resume
+    """
+    unwrapped = accelerator.unwrap_model(model)
+    if early_stopping.fingerprint is None:
+        early_stopping.fingerprint = backbone_fingerprint(unwrapped)
+    previous = torch.load(path, map_location='cpu')['state'] if os.path.exists(path) else None
+    state_dir = 'resume_state1' if previous == 'resume_state0' else 'resume_state0'
+    folder = os.path.join(os.path.dirname(path), state_dir)
+    os.makedirs(folder, exist_ok=True)
+
+    if accelerator.distributed_type == DistributedType.DEEPSPEED:
+        accelerator.save_state(folder, exclude_frozen_parameters=True)
+    elif accelerator.is_main_process:
+        atomic_save({'model': trainable_state_dict(unwrapped), 'optimizer': optimizer.state_dict(),
+                     'scheduler': scheduler.state_dict()}, os.path.join(folder, 'state'))
+    atomic_save(rng_state(), os.path.join(folder, 'rng_rank{}'.format(accelerator.process_index)))
+    accelerator.wait_for_everyone()
+
+    if accelerator.is_main_process:
+        state = {
+            'format': 'resume',
+            'state': state_dir,
+            'fingerprint': early_stopping.fingerprint,
+            'early_stopping': early_stopping.state_dict(),
+            'epoch': epoch,
+            'step': step,
+        }
+        state.update(extra)
+        atomic_save(state, path)
+    # the next snapshot picks its folder from this manifest
+    accelerator.wait_for_everyone()
+
+
+def load_resume(path, accelerator, model, optimizer, scheduler, early_stopping):
+    """
+    Restore a snapshot written by save_resume into the prepared model, optimizer and scheduler, after checking
+    it was trained on the same backbone. The RNG states are not applied, the caller restores them once the
+    data position is restored.
+
+    :return: the manifest, with its epoch, step and extra loop state, and the RNG states of this process
+    """
+    state = torch.load(path, map_location='cpu')
+    if not (isinstance(state, dict) and state.get('format') == 'resume' and 'state' in state):
+        raise RuntimeError('{} is not a resume snapshot'.format(path))
+    folder = os.path.join(os.path.dirname(path), state['state'])
+    unwrapped = accelerator.unwrap_model(model)
+    fingerprint = backbone_fingerprint(unwrapped)
+    if state['fingerprint'] != fingerprint:
+        raise RuntimeError('Snapshot {} was trained on a different backbone (fingerprint {} != {})'.format(
+            path, state['fingerprint'][:12], fingerprint[:12]))
+
+    if accelerator.distributed_type == DistributedType.DEEPSPEED:
+        # the frozen parameters are not in the snapshot
+        accelerator.load_state(folder, load_module_strict=False)
+    else:
+        checkpoint = torch.load(os.path.join(folder, 'state'), map_location='cpu')
+        load_trainable(unwrapped, {'state_dict': checkpoint['model'], 'fingerprint': fingerprint}, path)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    early_stopping.fingerprint = fingerprint
+    early_stopping.load_state_dict(state['early_stopping'])
+    state['rng'] = torch.load(os.path.join(folder, 'rng_rank{}'.format(accelerator.process_index)))
+    return state
+
+
+def to_cpu(obj):
+    """
+    Detached CPU copy of every tensor in a (nested) dict/list/tuple, so training can keep updating the originals.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path, keep=1):
+    """
+    torch.save through a temporary file and a rename, so `path` is either the old or the new checkpoint but
+    never a partial one. With keep > 1 the previous checkpoints are rotated to path.1 ... path.{keep-1}.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    for i in range(keep - 1, 0, -1):
+        src = path if i == 1 else '{}.{}'.format(path, i - 1)
+        if os.path.exists(src):
+            os.replace(src, '{}.{}'.format(path, i))
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread. submit() only snapshots the tensors to CPU memory; the
+    serialization and filesystem I/O happen off the training loop. Pending writes are flushed at exit.
+    """
+
+    def __init__(self, keep=1):
+        self.keep = keep
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                atomic_save(obj, path, self.keep)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Background checkpoint write failed') from error
+
+    def submit(self, obj, path):
+        self._raise()
+        self.queue.put((to_cpu(obj), path))
+
+    def flush(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        atexit.unregister(self.close)
+        self._raise()
@@ -0,0 +1,167 @@
+"""
+Static cost model for Time-LLM runs.
+
+Estimates backbone tokens, FLOPs, activation memory and parameter/optimizer memory of a run
+configuration from its hyperparameters alone, without loading any weights.
+"""
+import re
+from collections import OrderedDict
+
+# shapes of the supported backbones, taken from their public configs
+BACKBONES = {
+    'LLAMA': {'hidden': 4096, 'intermediate': 11008, 'heads': 32, 'vocab': 32000, 'positions': 0,
+              'layers': 32, 'gated_mlp': True},
+    'GPT2': {'hidden': 768, 'intermediate': 3072, 'heads': 12, 'vocab': 50257, 'positions': 1024,
+             'layers': 12, 'gated_mlp': False},
+    'BERT': {'hidden': 768, 'intermediate': 3072, 'heads': 12, 'vocab': 30522, 'positions': 512,
+             'layers': 12, 'gated_mlp': False},
+}
+
+DTYPE_BYTES = {'fp32': 4, 'bf16': 2, 'fp16': 2}
+
+NUM_PROTOTYPES = 1000  # TimeLLM.Model.num_tokens
+TOP_K = 5  # TimeLLM.Model.top_k
+
+DEFAULT_DESCRIPTION = 'The Electricity Transformer Temperature (ETT) is a crucial indicator in the electric power ' \
+                      'long-term deployment.'
+
+
+def patch_nums(args):
+    return int((args.seq_len - args.patch_len) / args.stride + 2)
+
+
+def backbone_layers(args):
+    # GPT2 is loaded with from_pretrained("gpt2") without the truncated config, so it always keeps all layers
+    if args.llm_model == 'GPT2':
+        return BACKBONES['GPT2']['layers']
+    return min(args.llm_layers, BACKBONES[args.llm_model]['layers'])
+
+
+def worst_case_prompt(args, description):
+    """
+    The longest prompt TimeLLM.Model.forecast can build for this configuration: every statistic printed
+    as a negative float with full float32 repr precision, lags with the largest number of digits.
+    """
+    value = '-' + '1.2345678901234567'
+    lag = str(max(args.seq_len // 2, 1))
+    return (
+        f"<|start_prompt|>Dataset description: {description}"
+        f"Task description: forecast the next {str(args.pred_len)} steps given the previous {str(args.seq_len)} steps information; "
+        "Input statistics: "
+        f"min value {value}, "
+        f"max value {value}, "
+        f"median value {value}, "
+        f"the trend of input is downward, "
+        f"top 5 lags are : {str([int(lag)] * TOP_K)}<|<end_prompt>|>"
+    )
+
+
+def count_prompt_tokens(prompt, tokenizer=None):
+    """
+    :return: (number of tokens, method) using the tokenizer if given, otherwise a heuristic that counts
+             every digit, word and punctuation character as one token (LLaMA splits digits individually)
+    """
+    if tokenizer is not None:
+        return len(tokenizer(prompt).input_ids), 'tokenizer'
+    return len(re.findall(r"\d|[A-Za-z]+|[^\sA-Za-z\d]", prompt)), 'heuristic'
+
+
+def trainable_params(args):
+    spec = BACKBONES[args.llm_model]
+    d_llm, d_keys, heads = args.llm_dim, args.d_ff, args.n_heads
+    params = OrderedDict()
+    params['patch_embedding'] = args.patch_len * args.d_model * 3
+    params['mapping_layer'] = spec['vocab'] * NUM_PROTOTYPES + NUM_PROTOTYPES
+    params['reprogramming_layer'] = (args.d_model * heads * d_keys + heads * d_keys +
+                                     2 * (d_llm * heads * d_keys + heads * d_keys) +
+                                     heads * d_keys * d_llm + d_llm)
+    params['output_projection'] = args.d_ff * patch_nums(args) * args.pred_len + args.pred_len
+    return params
+
+
+def backbone_params(args):
+    spec = BACKBONES[args.llm_model]
+    d, i = spec['hidden'], spec['intermediate']
+    mlp = (3 if spec['gated_mlp'] else 2) * d * i
+    per_layer = 4 * d * d + mlp + 4 * d
+    return (spec['vocab'] + spec['positions']) * d + backbone_layers(args) * per_layer
+
+
+def forward_flops(args, prompt_tokens):
+    """
+    Multiply-accumulates counted as 2 FLOPs. Normalization, prompt statistics and elementwise ops are ignored.
+    """
+    spec = BACKBONES[args.llm_model]
+    series = args.batch_size * args.enc_in
+    patches = patch_nums(args)
+    tokens = prompt_tokens + patches
+    d, i, heads, d_keys = spec['hidden'], spec['intermediate'], args.n_heads, args.d_ff
+    mlp = (3 if spec['gated_mlp'] else 2) * d * i
+
+    flops = OrderedDict()
+    flops['patch_embedding'] = 2 * series * patches * args.patch_len * args.d_model * 3
+    flops['mapping_layer'] = 2 * spec['vocab'] * NUM_PROTOTYPES * d
+    flops['reprogramming_layer'] = (2 * series * patches * args.d_model * heads * d_keys +
+                                    2 * 2 * NUM_PROTOTYPES * d * heads * d_keys +
+                                    2 * 2 * series * heads * patches * NUM_PROTOTYPES * d_keys +
+                                    2 * series * patches * heads * d_keys * d)
+    flops['backbone'] = backbone_layers(args) * (2 * series * tokens * (4 * d * d + mlp) +
+                                                 2 * 2 * series * tokens * tokens * d)
+    flops['output_projection'] = 2 * series * d_keys * patches * args.pred_len
+    return flops
+
+
+def train_flops(args, prompt_tokens):
+    """
+    Trainable components cost forward + input grad + weight grad (3x forward). The frozen backbone still
+    back-propagates to its inputs, since the reprogramming layer sits before it (2x forward).
+    """
+    return OrderedDict((name, value * (2 if name == 'backbone' else 3))
+                       for name, value in forward_flops(args, prompt_tokens).items())
+
+
+def activation_bytes(args, prompt_tokens, dtype_bytes=2):
+    """
+    Activations kept for backward in one training step, following Korthikanti et al. (2022) for the
+    transformer blocks with the MLP term scaled by the real intermediate size.
+    """
+    spec = BACKBONES[args.llm_model]
+    series = args.batch_size * args.enc_in
+    patches = patch_nums(args)
+    tokens = prompt_tokens + patches
+    d, i, heads = spec['hidden'], spec['intermediate'], spec['heads']
+    mlp_term = (6 if spec['gated_mlp'] else 4) * i
+    per_layer = series * tokens * (dtype_bytes / 2) * (18 * d + mlp_term + 5 * heads * tokens)
+
+    activations = OrderedDict()
+    activations['patch_embedding'] = series * patches * (args.patch_len + args.d_model) * dtype_bytes
+    activations['mapping_layer'] = NUM_PROTOTYPES * d * dtype_bytes
+    # queries, scores, softmax, dropout output (dtype) plus the dropout mask (1 byte)
+    activations['reprogramming_layer'] = (series * patches * args.n_heads * args.d_ff * dtype_bytes +
+                                          series * args.n_heads * patches * NUM_PROTOTYPES * (3 * dtype_bytes + 1))
+    activations['backbone'] = backbone_layers(args) * per_layer
+    activations['output_projection'] = series * args.d_ff * patches * dtype_bytes
+    return activations
+
+
+def estimate(args, prompt_tokens, dtype='bf16', num_processes=1):
+    dtype_bytes = DTYPE_BYTES[dtype]
+    trainable = trainable_params(args)
+    n_trainable = sum(trainable.values())
+    n_backbone = backbone_params(args)
+    # ZeRO-2 (ds_config_zero2.json) partitions gradients and optimizer states across processes
+    optimizer_bytes = n_trainable * 12 / num_processes  # fp32 master weights, Adam exp_avg and exp_avg_sq
+    return {
+        'tokens_per_sample': prompt_tokens + patch_nums(args),
+        'prompt_tokens': prompt_tokens,
+        'patch_nums': patch_nums(args),
+        'backbone_layers': backbone_layers(args),
+        'forward_flops': forward_flops(args, prompt_tokens),
+        'train_flops': train_flops(args, prompt_tokens),
+        'activation_bytes': activation_bytes(args, prompt_tokens, dtype_bytes),
+        'trainable_params': trainable,
+        'backbone_params': n_backbone,
+        'weight_bytes': (n_backbone + n_trainable) * dtype_bytes,
+        'gradient_bytes': n_trainable * dtype_bytes / num_processes,
+        'optimizer_bytes': optimizer_bytes,
+    }
@@ -16,12 +16,14 @@
 M4 Summary
 """
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
 import numpy as np
 import pandas as pd
 
-from data_provider.m4 import M4Dataset
-from data_provider.m4 import M4Meta
+from data_provider.m4 import PACKED_VERSION, M4Meta, M4Packed
+import json
 import os
 
 
@@ -47,12 +49,89 @@ def mape(forecast, target):
     return 100 * np.abs(forecast - target) / denom
 
 
+def _sources_stamp(files):
+    return json.dumps([PACKED_VERSION] + [[os.path.realpath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns]
+                                          for f in files])
+
+
+def naive2_baseline(root_path, group_name):
+    """
+    The model independent part of the scores of one seasonal pattern: the test targets (series, horizon), the
+    MASE denominators of every series (mean absolute seasonal difference of its training values, NaN if the
+    series is not longer than its frequency) and the sMAPE and MASE of the Naive2 forecasts. The arrays are
+    computed from the packed M4 parts (data_provider.m4.M4Packed) and cached next to them, until the
+    sources change.
+    """
+    info_file = os.path.join(root_path, 'M4-info.csv')
+    naive_path = os.path.join(root_path, 'submission-Naive2.csv')
+    sources = [info_file, naive_path] + [os.path.join(root_path, part + '.npz') for part in ('training', 'test')]
+    stamp = _sources_stamp(sources)
+    cache_file = os.path.join(root_path, 'naive2-packed', group_name + '.npz')
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            if str(cached['sources']) == stamp:
+                return {k: cached[k] for k in ('target', 'scale', 'naive2_smape', 'naive2_mase')}
+
+    m4_info = pd.read_csv(info_file)
+    in_group = m4_info.SP.values == group_name
+    # all timeseries within group have same frequency
+    frequency = int(m4_info.Frequency.values[in_group][0])
+    horizon = int(m4_info.Horizon.values[in_group][0])
+
+    test = M4Packed.load(training=False, dataset_file=root_path).group(group_name)
+    target = np.asarray(test.values, dtype=np.float64).reshape(len(test.lengths), horizon)
+
+    # seasonal differences of the concatenated series, summed per series through their cumulative sum
+    training = M4Packed.load(training=True, dataset_file=root_path).group(group_name)
+    values = np.asarray(training.values, dtype=np.float64)
+    lengths = np.asarray(training.lengths)
+    cumsum = np.concatenate([[0.], np.cumsum(np.abs(values[frequency:] - values[:-frequency]))])
+    count = lengths - frequency
+    valid = count > 0
+    start = np.asarray(training.offsets)
+    end = np.where(valid, start + count, start)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(valid, (cumsum[end] - cumsum[start]) / count, np.nan)
+
+    naive2_forecast = pd.read_csv(naive_path).values[:, 1:].astype(np.float32)[in_group][:, :horizon]
+    baseline = {'target': target,
+                'scale': scale,
+                'naive2_smape': np.mean(smape_2(naive2_forecast, target)),
+                'naive2_mase': np.mean(np.mean(np.abs(naive2_forecast - target), axis=1) / scale)}
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + '.tmp{}.npz'.format(os.getpid())
+        np.savez(tmp_file, sources=stamp, **baseline)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+    return baseline
+
+
+def score_group(file_path, root_path, group_name):
+    """
+    sMAPE, MAPE and MASE of the forecasts of one seasonal pattern and of its Naive2 forecasts.
+    """
+    baseline = naive2_baseline(root_path, group_name)
+    forecast = pd.read_csv(file_path + group_name + "_forecast.csv").values
+    target = baseline['target']
+    return {'smape': np.mean(smape_2(forecast=forecast, target=target)),
+            'mape': np.mean(mape(forecast=forecast, target=target)),
+            'mase': np.mean(np.mean(np.abs(forecast - target), axis=1) / baseline['scale']),
+            'naive2_smape': baseline['naive2_smape'],
+            'naive2_mase': baseline['naive2_mase']}
+
+
 class M4Summary:
-    def __init__(self, file_path, root_path):
+    def __init__(self, file_path, root_path, workers=1):
+        """
+        :param workers: processes scoring the seasonal patterns in parallel, 1 to score them in this process.
+                        The pool is forked, only use it from a process without CUDA or other threads running.
+        """
         self.file_path = file_path
-        self.training_set = M4Dataset.load(training=True, dataset_file=root_path)
-        self.test_set = M4Dataset.load(training=False, dataset_file=root_path)
-        self.naive_path = os.path.join(root_path, 'submission-Naive2.csv')
+        self.root_path = root_path
+        self.workers = workers
+        self.groups = pd.read_csv(os.path.join(root_path, 'M4-info.csv')).SP.values
 
     def evaluate(self):
         """
@@ -63,37 +142,21 @@ class M4Summary:
         """
         grouped_owa = OrderedDict()
 
-        naive2_forecasts = pd.read_csv(self.naive_path).values[:, 1:].astype(np.float32)
-        naive2_forecasts = np.array([v[~np.isnan(v)] for v in naive2_forecasts])
-
-        model_mases = {}
-        naive2_smapes = {}
-        naive2_mases = {}
-        grouped_smapes = {}
-        grouped_mapes = {}
-        for group_name in M4Meta.seasonal_patterns:
-            file_name = self.file_path + group_name + "_forecast.csv"
-            if os.path.exists(file_name):
-                model_forecast = pd.read_csv(file_name).values
-
-            naive2_forecast = group_values(naive2_forecasts, self.test_set.groups, group_name)
-            target = group_values(self.test_set.values, self.test_set.groups, group_name)
-            # all timeseries within group have same frequency
-            frequency = self.training_set.frequencies[self.test_set.groups == group_name][0]
-            insample = group_values(self.training_set.values, self.test_set.groups, group_name)
-
-            model_mases[group_name] = np.mean([mase(forecast=model_forecast[i],
-                                                    insample=insample[i],
-                                                    outsample=target[i],
-                                                    frequency=frequency) for i in range(len(model_forecast))])
-            naive2_mases[group_name] = np.mean([mase(forecast=naive2_forecast[i],
-                                                     insample=insample[i],
-                                                     outsample=target[i],
-                                                     frequency=frequency) for i in range(len(model_forecast))])
-
-            naive2_smapes[group_name] = np.mean(smape_2(naive2_forecast, target))
-            grouped_smapes[group_name] = np.mean(smape_2(forecast=model_forecast, target=target))
-            grouped_mapes[group_name] = np.mean(mape(forecast=model_forecast, target=target))
+        groups = M4Meta.seasonal_patterns
+        if self.workers > 1:
+            # forked, the training scripts have no main guard to be spawned from, hence the single process default
+            with ProcessPoolExecutor(min(self.workers, len(groups)), mp_context=get_context('fork')) as pool:
+                scores = list(pool.map(score_group, [self.file_path] * len(groups), [self.root_path] * len(groups),
+                                       groups))
+        else:
+            scores = [score_group(self.file_path, self.root_path, group_name) for group_name in groups]
+        scores = dict(zip(groups, scores))
+
+        model_mases = {g: scores[g]['mase'] for g in groups}
+        naive2_smapes = {g: scores[g]['naive2_smape'] for g in groups}
+        naive2_mases = {g: scores[g]['naive2_mase'] for g in groups}
+        grouped_smapes = {g: scores[g]['smape'] for g in groups}
+        grouped_mapes = {g: scores[g]['mape'] for g in groups}
 
         grouped_smapes = self.summarize_groups(grouped_smapes)
         grouped_mapes = self.summarize_groups(grouped_mapes)
@@ -119,7 +182,7 @@ class M4Summary:
         scores_summary = OrderedDict()
 
         def group_count(group_name):
-            return len(np.where(self.test_set.groups == group_name)[0])
+            return len(np.where(self.groups == group_name)[0])
 
         weighted_score = {}
         for g in ['Yearly', 'Quarterly', 'Monthly']:
@@ -134,7 +197,7 @@ class M4Summary:
         weighted_score['Others'] = others_score
         scores_summary['Others'] = others_score / others_count
 
-        average = np.sum(list(weighted_score.values())) / len(self.test_set.groups)
+        average = np.sum(list(weighted_score.values())) / len(self.groups)
         scores_summary['Average'] = average
 
         return scores_summary
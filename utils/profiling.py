@@ -0,0 +1,299 @@
+import csv
+import json
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class StepTimer:
+    """
+    Per-phase wall-clock timer for the training loop.
+
+    Every step is split into the phases below. Each recorded span is kept as a Chrome trace event
+    (viewable in chrome://tracing or Perfetto) and the last `window` steps are kept for rolling
+    percentiles, so data-bound steps (large `data`) can be told apart from compute-bound ones.
+
+    Background phases run in the prefetch thread, overlapped with the steps: their spans are traced on
+    their own thread row and kept per batch rather than per step, so they do not add to the step time.
+    """
+    phases = ('data', 'forward', 'loss', 'backward', 'optim', 'sched')
+    background_phases = ('h2d',)
+
+    def __init__(self, enabled=True, window=100, sync=True, pid=0, max_events=1000000):
+        """
+        :param enabled: if False every method is a no-op, so the loops can call it unconditionally
+        :param window: number of most recent steps used for the rolling percentiles
+        :param sync: synchronize CUDA at span boundaries so asynchronous kernels are charged to their phase
+        :param pid: process id written to the trace, normally the accelerator process index
+        :param max_events: trace events kept in memory, older steps are still counted in the percentiles
+        """
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.pid = pid
+        self.max_events = max_events
+        self.history = defaultdict(lambda: deque(maxlen=window))
+        self.events = []
+        self.step = 0
+        self._spans = {}
+        self._origin = time.perf_counter()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _record(self, name, start, end, tid=0):
+        if tid == 0:
+            self._spans[name] = self._spans.get(name, 0.) + end - start
+        else:
+            self.history[name].append(end - start)
+        if len(self.events) < self.max_events:
+            self.events.append({
+                'name': name, 'cat': 'step', 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+                'args': {'step': self.step},
+            })
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._record(name, start, self._now())
+
+    @contextmanager
+    def background(self, name):
+        """
+        Time a background phase, e.g. the device copy of the next batch in the prefetch thread. Only the
+        current stream, the side stream of that thread, is synchronized so the steps are not stalled.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.current_stream().synchronize()
+            self._record(name, start, time.perf_counter(), tid=1)
+
+    def iterate(self, loader):
+        """
+        Iterate over a dataloader, recording the time spent waiting for each batch as the `data` phase.
+        """
+        iterator = iter(loader)
+        while True:
+            start = self._now() if self.enabled else None
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self._record('data', start, self._now())
+            yield batch
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        for name in self.phases:
+            self.history[name].append(self._spans.get(name, 0.))
+        self.history['step'].append(sum(self._spans.values()))
+        self._spans = {}
+        self.step += 1
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        :return: {phase: [seconds at each percentile of q]} over the rolling window
+        """
+        return {name: np.percentile(values, q).tolist() for name, values in self.history.items() if len(values)}
+
+    def summary(self, q=(50, 90, 99)):
+        stats = self.percentiles(q)
+        if 'step' not in stats:
+            return 'no steps recorded'
+        step_total = np.sum(self.history['step']) or 1.
+        parts = ['step ' + ' '.join('p{}={:.4f}s'.format(p, v) for p, v in zip(q, stats['step']))]
+        for name in self.phases:
+            if name in stats and np.sum(self.history[name]) > 0:
+                share = 100. * np.sum(self.history[name]) / step_total
+                parts.append('{} p{}={:.4f}s ({:.1f}%)'.format(name, q[0], stats[name][0], share))
+        for name in self.background_phases:
+            if name in stats:
+                parts.append('{} p{}={:.4f}s (overlapped)'.format(name, q[0], stats[name][0]))
+        return ' | '.join(parts)
+
+    def export_chrome_trace(self, path):
+        if not self.enabled:
+            return
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _nbytes(output):
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(_nbytes(o) for o in output)
+    if isinstance(output, dict):
+        return sum(_nbytes(o) for o in output.values())
+    return 0
+
+
+class ModuleProfiler:
+    """
+    Opt-in per-module profiler built on forward (and optionally backward) hooks.
+
+    Aggregates call count, inclusive and self wall time and output tensor bytes for every submodule
+    of a model. Helper methods that do the heavy lifting inside a module (AutoCorrelation's
+    time-delay aggregation, TimeLLM's reprogramming and lag computation) are timed as their own rows.
+    Backward hooks do not support modules that modify their outputs in-place, hence they are off by default.
+    """
+    methods = ('time_delay_agg_training', 'time_delay_agg_inference', 'time_delay_agg_full',
+               'reprogramming', 'calcute_lags')
+    columns = ('module', 'type', 'calls', 'total_ms', 'self_ms', 'mean_ms', 'out_mb', 'bwd_calls', 'bwd_ms')
+
+    def __init__(self, model, backward=False, sync=True, methods=None):
+        self.model = model
+        self.backward = backward
+        self.sync = sync and torch.cuda.is_available()
+        self.methods = self.methods if methods is None else methods
+        self.handles = []
+        self.patched = []
+        self.stats = {}
+        self._stack = []
+        self._bwd_start = {}
+        self.attach()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _row(self, name, kind):
+        if name not in self.stats:
+            self.stats[name] = {'type': kind, 'calls': 0, 'time': 0., 'self_time': 0., 'bytes': 0,
+                                'bwd_calls': 0, 'bwd_time': 0.}
+        return self.stats[name]
+
+    def _enter(self):
+        self._stack.append([self._now(), 0.])
+
+    def _exit(self, name, kind, output):
+        start, child_time = self._stack.pop()
+        elapsed = self._now() - start
+        if self._stack:
+            self._stack[-1][1] += elapsed
+        row = self._row(name, kind)
+        row['calls'] += 1
+        row['time'] += elapsed
+        row['self_time'] += elapsed - child_time
+        row['bytes'] += _nbytes(output)
+
+    def _wrap_method(self, name, kind, method):
+        def wrapper(*args, **kwargs):
+            self._enter()
+            output = None
+            try:
+                output = method(*args, **kwargs)
+            finally:
+                self._exit(name, kind, output)
+            return output
+
+        return wrapper
+
+    def attach(self):
+        for name, module in self.model.named_modules():
+            name = name or type(module).__name__
+            kind = type(module).__name__
+
+            def pre_hook(module, inputs):
+                self._enter()
+
+            def hook(module, inputs, output, name=name, kind=kind):
+                self._exit(name, kind, output)
+
+            self.handles.append(module.register_forward_pre_hook(pre_hook))
+            # also called when forward raises, so the frame pushed by the pre-hook is always popped
+            self.handles.append(module.register_forward_hook(hook, always_call=True))
+
+            if self.backward:
+                def backward_pre_hook(module, grad_output, name=name):
+                    self._bwd_start[name] = self._now()
+
+                def backward_hook(module, grad_input, grad_output, name=name, kind=kind):
+                    start = self._bwd_start.pop(name, None)
+                    if start is not None:
+                        row = self._row(name, kind)
+                        row['bwd_calls'] += 1
+                        row['bwd_time'] += self._now() - start
+
+                self.handles.append(module.register_full_backward_pre_hook(backward_pre_hook))
+                self.handles.append(module.register_full_backward_hook(backward_hook))
+
+            for method in self.methods:
+                if callable(getattr(module, method, None)):
+                    setattr(module, method, self._wrap_method(name + '.' + method, kind, getattr(module, method)))
+                    self.patched.append((module, method))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        for module, method in self.patched:
+            delattr(module, method)
+        self.handles = []
+        self.patched = []
+
+    def reset(self):
+        self.stats = {}
+        self._stack = []
+        self._bwd_start = {}
+
+    def rows(self, sort='self_ms'):
+        rows = []
+        for name, row in self.stats.items():
+            rows.append({
+                'module': name,
+                'type': row['type'],
+                'calls': row['calls'],
+                'total_ms': row['time'] * 1e3,
+                'self_ms': row['self_time'] * 1e3,
+                'mean_ms': row['time'] * 1e3 / max(row['calls'], 1),
+                'out_mb': row['bytes'] / 2 ** 20,
+                'bwd_calls': row['bwd_calls'],
+                'bwd_ms': row['bwd_time'] * 1e3,
+            })
+        return sorted(rows, key=lambda r: r[sort], reverse=True)
+
+    def table(self, top=30, sort='self_ms'):
+        rows = self.rows(sort)[:top]
+        if not rows:
+            return 'no module calls recorded'
+        width = max(len(r['module']) for r in rows)
+        lines = ['{:<{w}} {:>8} {:>12} {:>12} {:>10} {:>10} {:>12}'.format(
+            'module', 'calls', 'total_ms', 'self_ms', 'mean_ms', 'out_mb', 'bwd_ms', w=width)]
+        for r in rows:
+            lines.append('{:<{w}} {:>8d} {:>12.2f} {:>12.2f} {:>10.3f} {:>10.2f} {:>12.2f}'.format(
+                r['module'], r['calls'], r['total_ms'], r['self_ms'], r['mean_ms'], r['out_mb'], r['bwd_ms'],
+                w=width))
+        return '\n'.join(lines)
+
+    def dump_csv(self, path, sort='self_ms'):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns)
+            writer.writeheader()
+            writer.writerows(self.rows(sort))
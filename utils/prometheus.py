@@ -0,0 +1,193 @@
+"""
+Minimal Prometheus text-format exporter for training and evaluation.
+
+Metrics are kept in process and either written atomically to a file (for the node exporter textfile
+collector) or served over HTTP from a daemon thread, so no client library is required.
+"""
+import os
+import resource
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+def loader_queue_depth(iterator):
+    """
+    Number of batches prefetched by the DataLoader workers and waiting to be consumed, or -1 if unknown.
+    Accelerate wraps the torch iterator in a generator, in which case it is looked up in the generator frame.
+    The generator of a BatchPrefetcher also counts the batches of its own queue, see BatchPrefetcher.queue_depth.
+    """
+    if isinstance(iterator, types.GeneratorType):
+        frame = iterator.gi_frame
+        if frame is None:
+            return -1
+        owner = frame.f_locals.get('self')
+        if hasattr(type(owner), 'queue_depth'):
+            return owner.queue_depth()
+        for name in ('dataloader_iter', 'iterator'):
+            if name in frame.f_locals:
+                return loader_queue_depth(frame.f_locals[name])
+        return -1
+    queue = getattr(iterator, '_data_queue', None)
+    if queue is None:
+        return 0 if hasattr(iterator, '_dataset_fetcher') else -1
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return -1
+
+
+class MetricsExporter:
+    def __init__(self, path=None, port=0, prefix='timellm', labels=None, interval=5.):
+        """
+        :param path: text file rewritten atomically at most every `interval` seconds, None to disable
+        :param port: serve /metrics on this local port, 0 to disable
+        :param labels: constant labels added to every sample, e.g. the process rank
+        """
+        self.path = path
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.last_write = 0.
+        self.server = None
+        if port:
+            self.serve(port)
+
+    def _label_key(self, labels):
+        return tuple(sorted(dict(self.labels, **(labels or {})).items()))
+
+    def _metric(self, name, kind, help):
+        full_name = self.prefix + '_' + name
+        if full_name not in self.metrics:
+            self.metrics[full_name] = {'kind': kind, 'help': help, 'samples': {}}
+        return self.metrics[full_name]['samples']
+
+    def inc(self, name, value=1., labels=None, help=''):
+        with self.lock:
+            samples = self._metric(name, 'counter', help)
+            key = self._label_key(labels)
+            samples[key] = samples.get(key, 0.) + value
+
+    def set(self, name, value, labels=None, help=''):
+        with self.lock:
+            self._metric(name, 'gauge', help)[self._label_key(labels)] = float(value)
+
+    def observe(self, name, value, labels=None, help='', buckets=LATENCY_BUCKETS):
+        with self.lock:
+            samples = self._metric(name, 'histogram', help)
+            key = self._label_key(labels)
+            if key not in samples:
+                samples[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0., 'count': 0}
+            hist = samples[key]
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                if metric['help']:
+                    lines.append('# HELP {} {}'.format(name, metric['help']))
+                lines.append('# TYPE {} {}'.format(name, metric['kind']))
+                for key, value in metric['samples'].items():
+                    labels = dict(key)
+                    if metric['kind'] != 'histogram':
+                        lines.append('{}{} {}'.format(name, _format_labels(labels), repr(float(value))))
+                        continue
+                    for bound, count in zip(value['buckets'], value['counts']):
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le=repr(bound))), count))
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le='+Inf')), value['count']))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(value['sum'])))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, force=True):
+        if self.path is None or (not force and time.time() - self.last_write < self.interval):
+            return
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.path)
+        self.last_write = time.time()
+
+    def serve(self, port):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+    def iterate(self, loader, phase='train'):
+        """
+        Iterate over a dataloader, sampling the worker queue depth before every batch is taken.
+        """
+        iterator = iter(loader)
+        while True:
+            self.set('dataloader_queue_depth', loader_queue_depth(iterator), {'phase': phase},
+                     help='batches prefetched by the DataLoader and not yet consumed')
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            yield batch
+
+    def record_step(self, seconds, samples, backbone_tokens=0, lr=None, phase='train'):
+        labels = {'phase': phase}
+        self.inc('steps_total', 1, labels, help='optimization or evaluation steps')
+        self.inc('samples_total', samples, labels, help='samples processed')
+        self.inc('backbone_tokens_total', backbone_tokens, labels, help='tokens fed to the LLM backbone')
+        self.observe('step_seconds', seconds, labels, help='wall time per step including data loading')
+        if seconds > 0:
+            self.set('samples_per_second', samples / seconds, labels, help='throughput of the last step')
+        if lr is not None:
+            self.set('learning_rate', lr, help='current learning rate of the first param group')
+        if torch.cuda.is_available():
+            peak = torch.cuda.max_memory_allocated()
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.set('peak_memory_bytes', peak, help='peak device memory, host RSS without CUDA')
+        self.write(force=False)
+
+    def record_early_stopping(self, early_stopping):
+        self.set('early_stopping_counter', early_stopping.counter, help='epochs without improvement')
+        self.set('early_stopping_patience', early_stopping.patience)
+        self.set('early_stopping_stop', float(early_stopping.early_stop))
+        if early_stopping.best_score is not None:
+            self.set('early_stopping_best_loss', -early_stopping.best_score, help='best validation loss so far')
+        self.write()
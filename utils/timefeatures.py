@@ -1,16 +1,76 @@
-from typing import List
+import functools
+from typing import Dict, List
 
 import numpy as np
 import pandas as pd
 from pandas.tseries import offsets
 from pandas.tseries.frequencies import to_offset
 
+NANOS_PER_DAY = 86400 * 10 ** 9
+
+
+def _days_from_civil(year, month, day):
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+
+def _iso_weeks_in_year(year):
+    def jan1_shift(y):
+        return (y + y // 4 - y // 100 + y // 400) % 7
+    return 52 + ((jan1_shift(year) == 4) | (jan1_shift(year - 1) == 3))
+
+
+def as_stamps(dates) -> np.ndarray:
+    """
+    int64 nanoseconds since the epoch of the wall time of dates (strings, datetimes or datetime64 values).
+    """
+    if isinstance(dates, np.ndarray) and dates.dtype == np.int64:
+        return dates
+    index = pd.DatetimeIndex(pd.to_datetime(dates))
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.asi8
+
+
+def calendar_fields(stamps) -> Dict[str, np.ndarray]:
+    """
+    Calendar fields of int64 nanosecond timestamps with integer arithmetic only, the date from the day number
+    as in H. Hinnant's civil_from_days.
+
+    :return: year, month, day, weekday (Monday is 0), hour, minute, second, dayofyear and week (ISO 8601)
+    """
+    days, nanos = np.divmod(np.asarray(stamps, dtype=np.int64), NANOS_PER_DAY)
+    seconds = nanos // 10 ** 9
+    # days since 0000-03-01, in 400 year eras starting after a leap day
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    weekday = (days + 3) % 7
+    dayofyear = days - _days_from_civil(year, 1, 1) + 1
+    week = (dayofyear - weekday + 9) // 7
+    week = np.where(week > _iso_weeks_in_year(year), 1, week)
+    week = np.where(week < 1, _iso_weeks_in_year(year - 1), week)
+    return {'year': year, 'month': month, 'day': doy - (153 * mp + 2) // 5 + 1, 'weekday': weekday,
+            'hour': seconds // 3600, 'minute': seconds // 60 % 60, 'second': seconds % 60,
+            'dayofyear': dayofyear, 'week': week}
+
 
 class TimeFeature:
     def __init__(self):
         pass
 
     def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
+        return self.encode(calendar_fields(as_stamps(index)))
+
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
         pass
 
     def __repr__(self):
@@ -20,57 +80,57 @@ class TimeFeature:
 class SecondOfMinute(TimeFeature):
     """Minute of hour encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return index.second / 59.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return fields['second'] / 59.0 - 0.5
 
 
 class MinuteOfHour(TimeFeature):
     """Minute of hour encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return index.minute / 59.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return fields['minute'] / 59.0 - 0.5
 
 
 class HourOfDay(TimeFeature):
     """Hour of day encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return index.hour / 23.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return fields['hour'] / 23.0 - 0.5
 
 
 class DayOfWeek(TimeFeature):
     """Hour of day encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return index.dayofweek / 6.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return fields['weekday'] / 6.0 - 0.5
 
 
 class DayOfMonth(TimeFeature):
     """Day of month encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return (index.day - 1) / 30.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return (fields['day'] - 1) / 30.0 - 0.5
 
 
 class DayOfYear(TimeFeature):
     """Day of year encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return (index.dayofyear - 1) / 365.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return (fields['dayofyear'] - 1) / 365.0 - 0.5
 
 
 class MonthOfYear(TimeFeature):
     """Month of year encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return (index.month - 1) / 11.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return (fields['month'] - 1) / 11.0 - 0.5
 
 
 class WeekOfYear(TimeFeature):
     """Week of year encoded as value between [-0.5, 0.5]"""
 
-    def __call__(self, index: pd.DatetimeIndex) -> np.ndarray:
-        return (index.isocalendar().week - 1) / 52.0 - 0.5
+    def encode(self, fields: Dict[str, np.ndarray]) -> np.ndarray:
+        return (fields['week'] - 1) / 52.0 - 0.5
 
 
 def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
@@ -131,4 +191,59 @@ def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
 
 
 def time_features(dates, freq='h'):
-    return np.vstack([feat(dates) for feat in time_features_from_frequency_str(freq)])
\ No newline at end of file
+    fields = dates if isinstance(dates, dict) else calendar_fields(as_stamps(dates))
+    return np.vstack([feat.encode(fields) for feat in time_features_from_frequency_str(freq)])
+
+
+def calendar_features(stamps, timeenc, freq='h', minute=False):
+    """
+    Time features of every stamp: the integer month, day, weekday and hour (and 15 minute bucket if minute) for
+    timeenc 0, time_features(freq) for timeenc 1.
+    """
+    fields = calendar_fields(stamps)
+    if timeenc == 0:
+        columns = [fields['month'], fields['day'], fields['weekday'], fields['hour']]
+        if minute:
+            columns.append(fields['minute'] // 15)
+        return np.stack(columns, 1)
+    return time_features(fields, freq=freq).transpose(1, 0)
+
+
+@functools.lru_cache(maxsize=32)
+def _stamp_range(start, step, length, timeenc, freq, minute):
+    if isinstance(step, int):
+        stamps = start + step * np.arange(length, dtype=np.int64)
+    else:
+        stamps = pd.date_range(pd.Timestamp(start), periods=length, freq=step).asi8
+    features = calendar_features(stamps, timeenc, freq, minute)
+    # shared between the callers of the cache
+    features.flags.writeable = False
+    return features
+
+
+def _step(step):
+    offset = to_offset(step) if isinstance(step, str) else step
+    if isinstance(offset, offsets.Tick):
+        return int(offset.nanos)
+    return offset
+
+
+def stamp_range(start, length, timeenc, freq='h', minute=False, step=None):
+    """
+    calendar_features of length stamps spaced by step from start, memoised by (start, step, length) and the
+    encoding. The returned array is read-only.
+
+    :param step: spacing of the stamps as a frequency string, an offset or int nanoseconds, freq if None
+    """
+    step = _step(freq if step is None else step)
+    return _stamp_range(int(as_stamps([start])[0]), step, length, timeenc, freq, minute)
+
+
+def future_stamps(last, length, timeenc, freq='h', minute=False, step=None):
+    """
+    Time features of the length stamps following the stamp last, e.g. the marks of a forecast horizon.
+    """
+    step = _step(freq if step is None else step)
+    last = int(as_stamps([last])[0])
+    start = last + step if isinstance(step, int) else (pd.Timestamp(last) + step).value
+    return _stamp_range(start, step, length, timeenc, freq, minute)
\ No newline at end of file
@@ -2,9 +2,13 @@ import numpy as np
 import torch
 import matplotlib.pyplot as plt
 import shutil
+import time
 
 from tqdm import tqdm
 
+from data_provider.m4 import group_config
+from utils.checkpoint import CheckpointWriter, backbone_fingerprint, save_trainable
+
 plt.switch_backend('agg')
 
 
@@ -36,7 +40,8 @@ def adjust_learning_rate(accelerator, optimizer, scheduler, epoch, args, printou
 
 
 class EarlyStopping:
-    def __init__(self, accelerator=None, patience=7, verbose=False, delta=0, save_mode=True):
+    def __init__(self, accelerator=None, patience=7, verbose=False, delta=0, save_mode=True, async_save=True,
+                 keep_checkpoints=1):
         self.accelerator = accelerator
         self.patience = patience
         self.verbose = verbose
@@ -46,6 +51,9 @@ class EarlyStopping:
         self.val_loss_min = np.Inf
         self.delta = delta
         self.save_mode = save_mode
+        self.fingerprint = None
+        self.keep_checkpoints = keep_checkpoints
+        self.writer = CheckpointWriter(keep_checkpoints) if save_mode and async_save else None
 
     def __call__(self, val_loss, model, path):
         score = -val_loss
@@ -78,11 +86,39 @@ class EarlyStopping:
 
         if self.accelerator is not None:
             model = self.accelerator.unwrap_model(model)
-            torch.save(model.state_dict(), path + '/' + 'checkpoint')
-        else:
-            torch.save(model.state_dict(), path + '/' + 'checkpoint')
+        # only the trainable parameters change, the frozen backbone is identified by its fingerprint
+        if self.fingerprint is None:
+            self.fingerprint = backbone_fingerprint(model)
+        # the weights are replicated, one writer per node is enough
+        if self.accelerator is None or self.accelerator.is_local_main_process:
+            save_trainable(model, path + '/' + 'checkpoint', self.fingerprint, self.writer, self.keep_checkpoints)
         self.val_loss_min = val_loss
 
+    def state_dict(self):
+        return {'counter': self.counter, 'best_score': self.best_score, 'early_stop': self.early_stop,
+                'val_loss_min': self.val_loss_min}
+
+    def load_state_dict(self, state_dict):
+        self.counter = state_dict['counter']
+        self.best_score = state_dict['best_score']
+        self.early_stop = state_dict['early_stop']
+        self.val_loss_min = state_dict['val_loss_min']
+
+    def flush(self):
+        """
+        Wait until the background writer has written every submitted checkpoint to disk.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """
+        Flush and stop the background writer at the end of a run, later checkpoints are written synchronously.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
 
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
@@ -134,34 +170,93 @@ def del_files(dir_path):
     shutil.rmtree(dir_path)
 
 
-def vali(args, accelerator, model, vali_data, vali_loader, criterion, mae_metric):
+def batch_inputs(args, batch_y, batch_x_mark, batch_y_mark, device):
+    """
+    The marks and the decoder input of a batch on device, None for the inputs the model does not declare in
+    args.model_inputs.
+    """
+    inputs = getattr(args, 'model_inputs', ('x_enc', 'x_mark_enc', 'x_dec', 'x_mark_dec'))
+    batch_x_mark = batch_x_mark.float().to(device, non_blocking=True) if 'x_mark_enc' in inputs else None
+    batch_y_mark = batch_y_mark.float().to(device, non_blocking=True) if 'x_mark_dec' in inputs else None
+    dec_inp = None
+    if 'x_dec' in inputs:
+        dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :]).float()
+        dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1).float().to(device, non_blocking=True)
+    return batch_x_mark, batch_y_mark, dec_inp
+
+
+def model_kwargs(batch, device):
+    """
+    The inputs the loaders append to a batch after its four tensors, as keyword arguments of the model: the
+    prompt input_ids built by the DataLoader workers with --prompt_in_loader, and the {'group': pattern} of joint
+    M4 batches.
+    """
+    kwargs = {}
+    for extra in batch[4:]:
+        if isinstance(extra, dict):
+            kwargs.update(extra)
+        else:
+            kwargs['prompt'] = extra.to(device, non_blocking=True)
+    return kwargs
+
+
+def prepare_batch(args, batch, device):
+    """
+    A training batch on device with its decoder input and extra model inputs:
+    (batch_x, batch_y, batch_x_mark, batch_y_mark, dec_inp, kwargs).
+    """
+    batch_x, batch_y, batch_x_mark, batch_y_mark = batch[:4]
+    batch_x = batch_x.float().to(device, non_blocking=True)
+    batch_y = batch_y.float().to(device, non_blocking=True)
+    return ((batch_x, batch_y) + batch_inputs(args, batch_y, batch_x_mark, batch_y_mark, device)
+            + (model_kwargs(batch, device),))
+
+
+def prepare_m4_batch(args, batch, device):
+    """
+    An m4 training batch on device: (batch_x, batch_y, batch_y_mark, dec_inp, kwargs), the marks of m4 are the
+    outsample masks of the loss.
+    """
+    batch_x, batch_y, _, batch_y_mark = batch[:4]
+    batch_x = batch_x.float().to(device, non_blocking=True)
+    batch_y = batch_y.float().to(device, non_blocking=True)
+    batch_y_mark = batch_y_mark.float().to(device, non_blocking=True)
+    dec_inp = None
+    if 'x_dec' in args.model_inputs:
+        dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :]).float()
+        dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1).float()
+    return batch_x, batch_y, batch_y_mark, dec_inp, model_kwargs(batch, device)
+
+
+def vali(args, accelerator, model, vali_data, vali_loader, criterion, mae_metric, metrics=None):
     total_loss = []
     total_mae_loss = []
     model.eval()
+    if metrics is not None:
+        vali_loader = metrics.iterate(vali_loader, phase='eval')
+    step_end = time.time()
     with torch.no_grad():
-        for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in tqdm(enumerate(vali_loader)):
+        for i, batch in tqdm(enumerate(vali_loader)):
+            batch_x, batch_y, batch_x_mark, batch_y_mark = batch[:4]
             batch_x = batch_x.float().to(accelerator.device)
             batch_y = batch_y.float()
+            kwargs = model_kwargs(batch, accelerator.device)
 
-            batch_x_mark = batch_x_mark.float().to(accelerator.device)
-            batch_y_mark = batch_y_mark.float().to(accelerator.device)
-
-            # decoder input
-            dec_inp = torch.zeros_like(batch_y[:, -args.pred_len:, :]).float()
-            dec_inp = torch.cat([batch_y[:, :args.label_len, :], dec_inp], dim=1).float().to(
-                accelerator.device)
+            # marks and decoder input, if the model reads them
+            batch_x_mark, batch_y_mark, dec_inp = batch_inputs(args, batch_y, batch_x_mark, batch_y_mark,
+                                                               accelerator.device)
             # encoder - decoder
             if args.use_amp:
                 with torch.cuda.amp.autocast():
                     if args.output_attention:
-                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)[0]
                     else:
-                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                        outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)
             else:
                 if args.output_attention:
-                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)[0]
+                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)[0]
                 else:
-                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark)
+                    outputs = model(batch_x, batch_x_mark, dec_inp, batch_y_mark, **kwargs)
 
             outputs, batch_y = accelerator.gather_for_metrics((outputs, batch_y))
 
@@ -182,6 +277,11 @@ def vali(args, accelerator, model, vali_data, vali_loader, criterion, mae_metric
             total_loss.append(loss.item())
             total_mae_loss.append(mae_loss.item())
 
+            if metrics is not None:
+                metrics.record_step(time.time() - step_end, batch_x.shape[0],
+                                    getattr(accelerator.unwrap_model(model), 'backbone_tokens', 0), phase='eval')
+                step_end = time.time()
+
     total_loss = np.average(total_loss)
     total_mae_loss = np.average(total_mae_loss)
 
@@ -189,41 +289,78 @@ def vali(args, accelerator, model, vali_data, vali_loader, criterion, mae_metric
     return total_loss, total_mae_loss
 
 
-def test(args, accelerator, model, train_loader, vali_loader, criterion):
-    x, _ = train_loader.dataset.last_insample_window()
-    y = vali_loader.dataset.timeseries
-    x = torch.tensor(x, dtype=torch.float32).to(accelerator.device)
-    x = x.unsqueeze(-1)
-
+def m4_groups(args, train_set, test_set):
+    """
+    (seasonal pattern, its run arguments, train dataset, test dataset, model kwargs) of every pattern of an M4
+    run: the single pattern of the run, or the six of joint training (Dataset_M4_Joint).
+    """
+    if hasattr(train_set, 'datasets'):
+        return [(group, group_config(args, group), train_set.datasets[group], test_set.datasets[group],
+                 {'group': group}) for group in train_set.groups]
+    return [(args.seasonal_patterns, args, train_set, test_set, {})]
+
+
+def m4_forecast(args, accelerator, model, x, metrics=None, **kwargs):
+    """
+    Forecasts of the last insample windows x (series, seq_len, channels) of every M4 series. Every process runs
+    the model on its own contiguous shard of the series, in batches of eval_batch_size, and the shards are
+    gathered once at the end, so every process gets all the forecasts.
+
+    :param metrics: MetricsExporter recording every batch as an eval step
+    :param kwargs: extra model inputs, the group of joint M4 training
+    :return: (series, pred_len, channels) tensor on the device of the accelerator
+    """
+    # ranks run different numbers of batches, the unwrapped model does not synchronise between them
+    model = accelerator.unwrap_model(model)
+    B, _, C = x.shape
+    shard = -(-B // accelerator.num_processes)
+    start = min(accelerator.process_index * shard, B)
+    x = x[start:min(start + shard, B)].float().to(accelerator.device)
+    outputs = torch.zeros((shard, args.pred_len, C)).float().to(accelerator.device)
+    step_end = time.time()
+    for i in range(0, len(x), args.eval_batch_size):
+        batch_x = x[i:i + args.eval_batch_size]
+        dec_inp = None
+        if 'x_dec' in getattr(args, 'model_inputs', ('x_dec',)):
+            dec_inp = torch.zeros((len(batch_x), args.pred_len, C)).float().to(accelerator.device)
+            dec_inp = torch.cat([batch_x[:, -args.label_len:, :], dec_inp], dim=1)
+        outputs[i:i + len(batch_x)] = model(batch_x, None, dec_inp, None, **kwargs)[:, -args.pred_len:, :]
+        if metrics is not None:
+            metrics.record_step(time.time() - step_end, len(batch_x), getattr(model, 'backbone_tokens', 0),
+                                phase='eval')
+            step_end = time.time()
+    # the shards are padded to the same size, only the last ones are short, so the series are the first B rows
+    return accelerator.gather(outputs)[:B]
+
+
+def test(args, accelerator, model, train_loader, vali_loader, criterion, metrics=None):
+    losses = []
+    counts = []
     model.eval()
     with torch.no_grad():
-        B, _, C = x.shape
-        dec_inp = torch.zeros((B, args.pred_len, C)).float().to(accelerator.device)
-        dec_inp = torch.cat([x[:, -args.label_len:, :], dec_inp], dim=1)
-        outputs = torch.zeros((B, args.pred_len, C)).float().to(accelerator.device)
-        id_list = np.arange(0, B, args.eval_batch_size)
-        id_list = np.append(id_list, B)
-        for i in range(len(id_list) - 1):
-            outputs[id_list[i]:id_list[i + 1], :, :] = model(
-                x[id_list[i]:id_list[i + 1]],
-                None,
-                dec_inp[id_list[i]:id_list[i + 1]],
-                None
-            )
-        accelerator.wait_for_everyone()
-        outputs = accelerator.gather_for_metrics(outputs)
-        f_dim = -1 if args.features == 'MS' else 0
-        outputs = outputs[:, -args.pred_len:, f_dim:]
-        pred = outputs
-        true = torch.from_numpy(np.array(y)).to(accelerator.device)
-        batch_y_mark = torch.ones(true.shape).to(accelerator.device)
-        true = accelerator.gather_for_metrics(true)
-        batch_y_mark = accelerator.gather_for_metrics(batch_y_mark)
-
-        loss = criterion(x[:, :, 0], args.frequency_map, pred[:, :, 0], true, batch_y_mark)
+        for group, group_args, train_set, vali_set, kwargs in m4_groups(args, train_loader.dataset,
+                                                                        vali_loader.dataset):
+            x, _ = train_set.last_insample_window()
+            y = vali_set.timeseries
+            x = torch.tensor(x, dtype=torch.float32).unsqueeze(-1)
+
+            outputs = m4_forecast(group_args, accelerator, model, x, metrics, **kwargs)
+            f_dim = -1 if args.features == 'MS' else 0
+            pred = outputs[:, -group_args.pred_len:, f_dim:]
+            # every process holds all the series
+            true = torch.from_numpy(np.array(y)).to(accelerator.device)
+            batch_y_mark = torch.ones(true.shape).to(accelerator.device)
+
+            losses.append(criterion(x[:, :, 0].to(accelerator.device), group_args.frequency_map, pred[:, :, 0], true,
+                                    batch_y_mark))
+            counts.append(len(x))
+            if metrics is not None:
+                metrics.set('m4_vali_loss', losses[-1].item(), {'seasonal_patterns': group},
+                            help='validation loss of a seasonal pattern')
 
     model.train()
-    return loss
+    # the mean over the series of all the patterns of joint training
+    return sum(loss * count for loss, count in zip(losses, counts)) / sum(counts)
 
 
 def load_content(args):